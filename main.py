@@ -2,8 +2,10 @@ import torch
 from scripts.train_model import train_model
 from scripts.evaluate_model import evaluate_model
 from scripts.inference import predict
+from scripts.materialize_grids import materialize_grids
 from utils.config_handler import parse_arguments
-from utils.train_data_utils import load_parameters, load_model
+from utils.train_data_utils import load_parameters, load_model, DataSource
+from utils.las_io import set_laz_threads
 
 
 def main():
@@ -35,11 +37,31 @@ def main():
     perform_evaluation = args.perform_evaluation
     predict_labels = args.predict_labels
     file_to_predict = args.file_to_predict
+    approximate_grids = args.approximate_grids
+    
+    # grid store params
+    materialize = args.materialize_grids
+    grid_store_dir = args.grid_store_dir
+    grid_store_dtype = args.grid_store_dtype
+    grid_store_mode = args.grid_store_mode
+    spatial_block_size = args.spatial_block_size
+    index_cache_bytes = args.index_cache_mb * 2**20 if args.index_cache_mb is not None else None
     
     # feature images creation params
     features_to_use = args.features_to_use  # features to use during training
     window_sizes = args.window_sizes
     grid_resolution = 128   # hard-coded value, following reference article
+    neighbor_index_backend = args.neighbor_index_backend
+    tree_cache_dir = args.tree_cache_dir
+    precision = args.precision
+    ingest_cache_dir = args.ingest_cache_dir
+    
+    # LAS/LAZ params
+    laz_threads = args.laz_threads
+    compress_las = args.compress_las
+    inference_mode = args.inference_mode
+    inference_processes = args.inference_processes
+    set_laz_threads(laz_threads)    # the LAZ thread pool is shared by the whole run
     
     # Set device (GPU if available)
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -48,7 +70,31 @@ def main():
     if predict_labels and perform_evaluation:
         raise ValueError("You can either predict new labels or evaluate the model's performance. Please set only one among predict_labels and perform_evaluation as True.")
 
-    if not predict_labels and not perform_evaluation:
+    if materialize:
+        
+        if grid_store_dir is None:
+            raise ValueError("A grid_store_dir must be specified in order to materialize the feature images.")
+
+        # pre-compute feature images for the training and evaluation files (reading the full dataset only once)
+        data_source = DataSource(full_data_filepath, ingest_cache_dir=ingest_cache_dir, precision=precision)
+        for subset_file in [training_data_filepath, evaluation_data_filepath]:
+            materialize_grids(full_data_filepath=full_data_filepath,
+                              grid_store_dir=grid_store_dir,
+                              window_sizes=window_sizes,
+                              grid_resolution=grid_resolution,
+                              features_to_use=features_to_use,
+                              subset_file=subset_file,
+                              mode=grid_store_mode,
+                              dtype=grid_store_dtype,
+                              batch_size=batch_size,
+                              num_workers=num_workers,
+                              precision=precision,
+                              data_source=data_source)
+
+    elif not predict_labels and not perform_evaluation:
+
+        # load the full dataset once, in the precision policy, shared by training and evaluation
+        data_source = DataSource(full_data_filepath, ingest_cache_dir=ingest_cache_dir, precision=precision)
 
         # training
         model, model_save_folder = train_model(full_data_filepath=full_data_filepath,
@@ -65,7 +111,15 @@ def main():
                                                                 device = device,
                                                                 window_sizes=window_sizes,
                                                                 grid_resolution=grid_resolution,
-                                                                training_data_filepath=training_data_filepath)
+                                                                training_data_filepath=training_data_filepath,
+                                                                grid_store_dir=grid_store_dir,
+                                                                index_cache_bytes=index_cache_bytes,
+                                                                spatial_block_size=spatial_block_size,
+                                                                neighbor_index_backend=neighbor_index_backend,
+                                                                tree_cache_dir=tree_cache_dir,
+                                                                precision=precision,
+                                                                ingest_cache_dir=ingest_cache_dir,
+                                                                data_source=data_source)
         
         if evaluate_model_after_training:
             # perform evaluation after training 
@@ -78,7 +132,13 @@ def main():
                            model=model, 
                            device=device, 
                            model_save_folder=model_save_folder, 
-                           evaluation_data_filepath=evaluation_data_filepath)
+                           evaluation_data_filepath=evaluation_data_filepath,
+                           grid_store_dir=grid_store_dir,
+                           neighbor_index_backend=neighbor_index_backend,
+                           tree_cache_dir=tree_cache_dir,
+                           precision=precision,
+                           ingest_cache_dir=ingest_cache_dir,
+                           data_source=data_source)
 
     elif perform_evaluation:
 
@@ -97,7 +157,12 @@ def main():
                         model=loaded_model, 
                         device=device, 
                         model_save_folder=loaded_model_path, 
-                        evaluation_data_filepath=evaluation_data_filepath)
+                        evaluation_data_filepath=evaluation_data_filepath,
+                        grid_store_dir=grid_store_dir,
+                        neighbor_index_backend=neighbor_index_backend,
+                        tree_cache_dir=tree_cache_dir,
+                        precision=precision,
+                        ingest_cache_dir=ingest_cache_dir)
         
     elif predict_labels:
 
@@ -109,7 +174,14 @@ def main():
         # Run predictions
         predict(file_path=file_to_predict, model=loaded_model, model_path=loaded_model_path, device=device,
                 batch_size=batch_size, window_sizes=window_sizes, grid_resolution=grid_resolution, features_to_use=loaded_features,
-                num_workers=num_workers, tile_size=125)
+                num_workers=num_workers, tile_size=125, approximate_grids=approximate_grids,
+                neighbor_index_backend=neighbor_index_backend,
+                tree_cache_dir=tree_cache_dir,
+                precision=precision,
+                compress_las=compress_las,
+                laz_threads=laz_threads,
+                inference_mode=inference_mode,
+                num_processes=inference_processes)
         
 if __name__ == "__main__":
     main()
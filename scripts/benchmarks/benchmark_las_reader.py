@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import laspy
+import numpy as np
+from utils.point_cloud_data_utils import read_las_file_to_numpy
+from scripts.benchmarks.synthetic import write_synthetic_las
+
+
+def benchmark_las_reader(num_points=2000000, features_to_extract=('intensity', 'red', 'green', 'blue'), chunk_size=1000000):
+    """
+    Compares the time and the traced peak memory of a whole-file read (laspy.read and np.vstack, as done before streaming) 
+    and of the chunked read of read_las_file_to_numpy, on a synthetic LAS tile.
+
+    Args:
+    - num_points (int): Number of points of the synthetic tile. Default is 2000000.
+    - features_to_extract (tuple): Features read besides the coordinates. Default is ('intensity', 'red', 'green', 'blue').
+    - chunk_size (int): Number of points read at a time by the chunked reader. Default is 1000000.
+
+    Returns:
+    - results (dict): {reader: (seconds, peak bytes)}.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        las_file = os.path.join(tmp_dir, 'tile.las')
+        write_synthetic_las(las_file, num_points)
+
+        def whole_file_read():
+            las_data = laspy.read(las_file)
+            feature_names = ['x', 'y', 'z'] + list(features_to_extract) + ['segment_id', 'label']
+            return np.vstack([las_data[feature] for feature in feature_names]).T
+
+        def chunked_read():
+            return read_las_file_to_numpy(las_file, features_to_extract=list(features_to_extract), chunk_size=chunk_size)[0]
+
+        results = {}
+        for reader, read in (('whole file', whole_file_read), ('chunked', chunked_read)):
+            tracemalloc.start()
+            start = time.time()
+            data_array = read()
+            elapsed = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[reader] = (elapsed, peak)
+            print(f"{reader} read: {elapsed:.2f}s, output {data_array.nbytes / 2**20:.1f} MB, peak {peak / 2**20:.1f} MB")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_las_reader()
@@ -0,0 +1,44 @@
+import time
+import numpy as np
+from scripts.point_cloud_to_image import create_multiscale_grid_coords
+from utils.neighbor_index import build_neighbor_index
+
+
+def benchmark_neighbor_index(point_counts=(10000, 100000, 1000000), num_centers=32, grid_resolution=32, seed=0):
+    """
+    Compares the build time and the grid queries per second of the neighbor index backends ('kdtree' and 'voxel_hash'), 
+    for increasing point densities on a synthetic 100m x 100m tile.
+
+    Args:
+    - point_counts (tuple): Numbers of points of the synthetic tiles. Default is (10000, 100000, 1000000).
+    - num_centers (int): Number of grid centers queried. Default is 32.
+    - grid_resolution (int): Resolution of the grids. Default is 32.
+    - seed (int): Seed of the synthetic tiles. Default is 0.
+
+    Returns:
+    - timings (dict): {num_points: {backend: (build seconds, queries per second)}}.
+    """
+    rng = np.random.default_rng(seed)
+    window_sizes = [('small', 2.5), ('medium', 5.0), ('large', 10.0)]
+    timings = {}
+    for num_points in point_counts:
+        points = np.column_stack((rng.uniform(0, 100, num_points), rng.uniform(0, 100, num_points), rng.uniform(0, 5, num_points)))
+        grid_coords = create_multiscale_grid_coords(points[rng.choice(num_points, num_centers)], window_sizes, grid_resolution).reshape(-1, 3)
+
+        timings[num_points] = {}
+        for backend in ('kdtree', 'voxel_hash'):
+            start = time.time()
+            index = build_neighbor_index(points, backend=backend)
+            build_time = time.time() - start
+            start = time.time()
+            index.query(grid_coords)
+            timings[num_points][backend] = (build_time, len(grid_coords) / (time.time() - start))
+
+        print(f"{num_points / 1e4:.0f} pts/m^2: " + ", ".join(
+            f"{backend} build {build:.3f}s, {qps:.0f} queries/s" for backend, (build, qps) in timings[num_points].items()))
+
+    return timings
+
+
+if __name__ == '__main__':
+    benchmark_neighbor_index()
@@ -0,0 +1,42 @@
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+from utils.point_matching import PointKeyIndex
+from scripts.benchmarks.synthetic import synthetic_las_coordinates
+
+
+def benchmark_point_matching(point_counts=(100000, 1000000, 5000000), subset_fraction=0.2, seed=0):
+    """
+    Compares the time to match N points against a subset of them by packed keys (see PointKeyIndex) and by KDTree queries 
+    with a distance tolerance, on synthetic LAS-like coordinates.
+
+    Args:
+    - point_counts (tuple): Numbers of points. Default is (100000, 1000000, 5000000).
+    - subset_fraction (float): Size of the subset, as a fraction of the points. Default is 0.2.
+    - seed (int): Seed of the synthetic coordinates. Default is 0.
+
+    Returns:
+    - timings (dict): {num_points: (key matching seconds, KDTree matching seconds)}.
+    """
+    rng = np.random.default_rng(seed)
+    timings = {}
+    for num_points in point_counts:
+        points = synthetic_las_coordinates(num_points, rng)
+        subset = points[rng.choice(num_points, int(num_points * subset_fraction), replace=False)]
+
+        start = time.time()
+        PointKeyIndex(subset).contains(points)
+        key_time = time.time() - start
+
+        start = time.time()
+        cKDTree(subset).query(points, distance_upper_bound=1e-8)
+        tree_time = time.time() - start
+
+        timings[num_points] = (key_time, tree_time)
+        print(f"{num_points} points: keys {key_time:.2f}s, KDTree {tree_time:.2f}s")
+
+    return timings
+
+
+if __name__ == '__main__':
+    benchmark_point_matching()
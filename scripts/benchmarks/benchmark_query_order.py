@@ -0,0 +1,48 @@
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+from scripts.point_cloud_to_image import create_multiscale_grid_coords
+from utils.train_data_utils import MortonBlockSampler
+
+
+def benchmark_query_order(num_points=1000000, num_queries=4000, batch_size=64, grid_resolution=32, num_runs=2, seed=0):
+    """
+    Compares the KDTree queries per second of batches of grid centers visited in random order and in Morton block order 
+    (see MortonBlockSampler), on a synthetic 300m x 300m point cloud.
+
+    Args:
+    - num_points (int): Number of points of the synthetic cloud. Default is 1000000.
+    - num_queries (int): Number of grid centers. Default is 4000.
+    - batch_size (int): Number of grid centers queried at a time. Default is 64.
+    - grid_resolution (int): Resolution of the grids. Default is 32.
+    - num_runs (int): Number of runs of each order: the best one is kept, to reduce timing noise. Default is 2.
+    - seed (int): Seed of the synthetic cloud. Default is 0.
+
+    Returns:
+    - random_qps (float): Queries per second in random order.
+    - morton_qps (float): Queries per second in Morton block order.
+    """
+    rng = np.random.default_rng(seed)
+    points = np.column_stack((rng.uniform(0, 300, num_points), rng.uniform(0, 300, num_points), rng.uniform(0, 20, num_points)))
+    tree = cKDTree(points)
+    center_points = points[rng.choice(num_points, num_queries, replace=False)]
+    window_sizes = [('small', 2.5)]
+
+    def queries_per_second(order):
+        start = time.time()
+        for i in range(0, num_queries, batch_size):
+            grid_coords = create_multiscale_grid_coords(center_points[order[i:i + batch_size]], window_sizes, grid_resolution)
+            tree.query(grid_coords.reshape(-1, 3))
+        return num_queries * grid_resolution**2 / (time.time() - start)
+
+    random_order = rng.permutation(num_queries)
+    morton_order = np.array(list(MortonBlockSampler(center_points, block_size=1024, seed=seed)))
+    random_qps = max(queries_per_second(random_order) for _ in range(num_runs))
+    morton_qps = max(queries_per_second(morton_order) for _ in range(num_runs))
+    print(f"KDTree queries per second: random order {random_qps:.0f}, Morton block order {morton_qps:.0f} ({morton_qps / random_qps:.2f}x)")
+
+    return random_qps, morton_qps
+
+
+if __name__ == '__main__':
+    benchmark_query_order()
@@ -0,0 +1,78 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from utils.point_cloud_data_utils import reservoir_sample_data
+
+
+def loop_reservoir_sample(input_file, sample_size, chunk_size=100000):
+    """
+    Row-by-row reservoir sampling (Algorithm R) of a CSV file, as previously done by reservoir_sample_data.
+
+    Args:
+    - input_file (str): Path to the CSV file.
+    - sample_size (int): Number of rows sampled.
+    - chunk_size (int): Number of rows read at a time. Default is 100000.
+
+    Returns:
+    - sample (pd.DataFrame): The sampled rows.
+    """
+    reservoir = []
+    num_seen = 0
+    for chunk in pd.read_csv(input_file, chunksize=chunk_size):
+        for row in chunk.itertuples(index=False):
+            num_seen += 1
+            if len(reservoir) < sample_size:
+                reservoir.append(row)
+            else:
+                replace_idx = random.randint(0, num_seen - 1)
+                if replace_idx < sample_size:
+                    reservoir[replace_idx] = row
+    return pd.DataFrame(reservoir, columns=chunk.columns)
+
+
+def benchmark_reservoir_sampling(row_counts=(100000, 1000000), sample_fraction=0.1, seed=0):
+    """
+    Compares row-by-row reservoir sampling (see loop_reservoir_sample) and the random-key reservoir of reservoir_sample_data 
+    on synthetic CSV files.
+
+    Args:
+    - row_counts (tuple): Numbers of rows of the CSV files. Default is (100000, 1000000).
+    - sample_fraction (float): Size of the sample, as a fraction of the rows. Default is 0.1.
+    - seed (int): Seed of the synthetic files and of the sampling. Default is 0.
+
+    Returns:
+    - timings (dict): {num_rows: (row loop seconds, random keys seconds)}.
+    """
+    rng = np.random.default_rng(seed)
+    random.seed(seed)
+    tmp_dir = tempfile.mkdtemp()
+    timings = {}
+    try:
+        for num_rows in row_counts:
+            input_file = os.path.join(tmp_dir, f'data_{num_rows}.csv')
+            pd.DataFrame({'x': rng.uniform(0, 500, num_rows), 'y': rng.uniform(0, 500, num_rows), 'z': rng.uniform(0, 50, num_rows),
+                          'intensity': rng.uniform(0, 255, num_rows), 'label': rng.integers(0, 6, num_rows)}).to_csv(input_file, index=False)
+            sample_size = int(num_rows * sample_fraction)
+
+            start = time.time()
+            loop_reservoir_sample(input_file, sample_size)
+            loop_time = time.time() - start
+
+            start = time.time()
+            reservoir_sample_data(input_file, sample_size, seed=seed)
+            vectorized_time = time.time() - start
+
+            timings[num_rows] = (loop_time, vectorized_time)
+            print(f"{num_rows} rows: row loop {loop_time:.2f}s, random keys {vectorized_time:.2f}s")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return timings
+
+
+if __name__ == '__main__':
+    benchmark_reservoir_sampling()
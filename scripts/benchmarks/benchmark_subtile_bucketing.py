@@ -0,0 +1,42 @@
+import time
+import numpy as np
+from utils.point_cloud_data_utils import generate_subtile_indices
+from scripts.benchmarks.synthetic import mask_subtile_indices
+
+
+def benchmark_subtile_bucketing(num_points=5000000, tile_size=125, overlap_size=10, seed=0):
+    """
+    Compares the subtiling of a synthetic 500m x 500m tile with one mask of all points per subtile (see mask_subtile_indices) 
+    and with the single-sort bucketing of generate_subtile_indices.
+
+    Args:
+    - num_points (int): Number of points of the synthetic tile. Default is 5000000.
+    - tile_size (int): Size of each subtile in meters. Default is 125.
+    - overlap_size (int): Size of the overlap between subtiles in meters. Default is 10.
+    - seed (int): Seed of the synthetic tile. Default is 0.
+
+    Returns:
+    - mask_time (float): Seconds taken by the masks.
+    - bucket_time (float): Seconds taken by the bucketing.
+    """
+    rng = np.random.default_rng(seed)
+    x = 686000 + rng.uniform(0, 500, num_points)
+    y = 4929000 + rng.uniform(0, 500, num_points)
+
+    start = time.time()
+    for _ in mask_subtile_indices(x, y, 686000, 4929000, tile_size, overlap_size, 500):
+        pass
+    mask_time = time.time() - start
+
+    start = time.time()
+    for _ in generate_subtile_indices(x, y, (686000.0, 4929000.0), (x.max(), y.max()), tile_size, overlap_size):
+        pass
+    bucket_time = time.time() - start
+
+    print(f"{num_points} points, {tile_size} m subtiles: masks {mask_time:.2f}s, bucketing {bucket_time:.2f}s")
+
+    return mask_time, bucket_time
+
+
+if __name__ == '__main__':
+    benchmark_subtile_bucketing()
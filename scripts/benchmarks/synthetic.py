@@ -0,0 +1,73 @@
+import numpy as np
+import laspy
+
+
+def write_synthetic_las(file_path, num_points, seed=0):
+    """
+    Writes a LAS file with UTM-like coordinates, colors, a segment_id and a label, as the tiles used for training.
+
+    Args:
+    - file_path (str): Path of the .las file to write.
+    - num_points (int): Number of points of the file.
+    - seed (int): Seed of the random generator. Default is 0.
+    """
+    rng = np.random.default_rng(seed)
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.offsets = np.array([686000.0, 4929000.0, 0.0])
+    header.scales = np.array([0.01, 0.01, 0.01])
+    header.add_extra_dims([laspy.ExtraBytesParams(name='segment_id', type=np.int32),
+                           laspy.ExtraBytesParams(name='label', type=np.int32)])
+    las = laspy.LasData(header)
+    las.x = 686000.0 + rng.uniform(0, 500, num_points)
+    las.y = 4929000.0 + rng.uniform(0, 500, num_points)
+    las.z = rng.uniform(0, 50, num_points)
+    las.intensity = rng.integers(0, 2**16, num_points)
+    las.red = rng.integers(0, 2**16, num_points)
+    las.green = rng.integers(0, 2**16, num_points)
+    las.blue = rng.integers(0, 2**16, num_points)
+    las.segment_id = rng.integers(0, 1000, num_points)
+    las.label = rng.integers(0, 5, num_points)
+    las.write(file_path)
+
+
+def synthetic_las_coordinates(num_points, rng, scale=0.01):
+    """
+    Generates UTM-like coordinates stored as scaled integers, as in LAS files.
+
+    Args:
+    - num_points (int): Number of points.
+    - rng (numpy.random.Generator): Random generator.
+    - scale (float): Scale of the stored integers. Default is 0.01.
+
+    Returns:
+    - numpy.ndarray: Array of shape (num_points, 3) with the x, y, z coordinates.
+    """
+    return np.column_stack((686000 + rng.integers(0, 50000, num_points) * scale,
+                            4929000 + rng.integers(0, 50000, num_points) * scale,
+                            rng.integers(0, 5000, num_points) * scale))
+
+
+def mask_subtile_indices(x, y, lower_left_x, lower_left_y, tile_size, overlap_size, total_size):
+    """
+    Reference subtiling with one mask of all points per subtile, as previously done by subtiler (see generate_subtile_indices).
+
+    Args:
+    - x, y (numpy.ndarray): Coordinates of the points.
+    - lower_left_x, lower_left_y (float): Lower-left corner of the tile.
+    - tile_size (int): Size of each subtile.
+    - overlap_size (int): Overlap between adjacent subtiles.
+    - total_size (int): Size of the tile.
+
+    Yields:
+    - tuple: Lower-left corner (x0, y0) of each non-empty subtile and the indices of its points.
+    """
+    steps = (total_size - overlap_size) // (tile_size - overlap_size)
+    for i in range(steps + 1):
+        for j in range(steps + 1):
+            x0 = lower_left_x + i * (tile_size - overlap_size)
+            y0 = lower_left_y + j * (tile_size - overlap_size)
+            x1 = lower_left_x + total_size if i == steps else x0 + tile_size
+            y1 = lower_left_y + total_size if j == steps else y0 + tile_size
+            indices = np.flatnonzero((x >= x0) & (x < x1) & (y >= y0) & (y < y1))
+            if len(indices) > 0:
+                yield x0, y0, indices
@@ -2,7 +2,7 @@ from utils.train_data_utils import prepare_dataloader
 from scripts.inference import perform_evaluation
 
 
-def evaluate_model(batch_size, full_data_filepath, window_sizes, grid_resolution, features_to_use, num_workers, model, device, model_save_folder, evaluation_data_filepath):
+def evaluate_model(batch_size, full_data_filepath, window_sizes, grid_resolution, features_to_use, num_workers, model, device, model_save_folder, evaluation_data_filepath, grid_store_dir=None, neighbor_index_backend='kdtree', tree_cache_dir=None, precision='float64', ingest_cache_dir=None, data_source=None):
     """
     Evaluates the performance of a trained model on a given dataset and generates a confusion matrix and classification report.
 
@@ -18,7 +18,13 @@ def evaluate_model(batch_size, full_data_filepath, window_sizes, grid_resolution
         - model (torch.nn.Module): The trained PyTorch model to evaluate.
         - device (torch.device): The device (CPU or GPU) to run the evaluation on.
         - model_save_folder (str): Directory where the model is saved and where the evaluation results will be stored.
-        - evaluation_data_filepath (str): Path to the evaluation dataset file.
+        - evaluation_data_filepath (str): Path to the evaluation dataset file (or to a .npy file of its row indices in the full dataset).
+        - grid_store_dir (str, optional): Root directory of the materialized grid stores. If a matching store exists, grids are read from it.
+        - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'. Default is 'kdtree'.
+        - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+        - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
+        - ingest_cache_dir (str, optional): Directory where .las and .csv inputs are converted to memory-mapped column-major .npy files on first use (see read_file_to_numpy). Default is None.
+        - data_source (DataSource, optional): Already loaded full dataset (see DataSource), shared to avoid reading the file again. Default is None.
 
 
     Returns:
@@ -39,7 +45,13 @@ def evaluate_model(batch_size, full_data_filepath, window_sizes, grid_resolution
             train_split=None,   # prepare the dataloader with the full data for inference (no train/eval split)
             num_workers=num_workers,
             shuffle_train=False,  # we dont want to shuffle data for inference
-            subset_file=evaluation_data_filepath    # select points specified by evaluation file to perform evaluation
+            subset_file=evaluation_data_filepath,    # select points specified by evaluation file to perform evaluation
+            grid_store_dir=grid_store_dir,
+            neighbor_index_backend=neighbor_index_backend,
+            tree_cache_dir=tree_cache_dir,
+            precision=precision,
+            ingest_cache_dir=ingest_cache_dir,
+            data_source=data_source
         )
     
     conf_matrix, class_report = perform_evaluation(
@@ -2,8 +2,9 @@ import torch
 import numpy as np
 import pandas as pd
 import laspy
-from utils.train_data_utils import prepare_dataloader
-from utils.point_cloud_data_utils import subtiler, stitch_subtiles
+from utils.train_data_utils import PointCloudDataset, create_dataloader
+from utils.point_cloud_data_utils import las_data_to_numpy, remap_labels, clean_nan_values, generate_core_halo_indices, prediction_filepath
+from utils.las_io import read_las, write_las
 from datetime import datetime
 import os
 import matplotlib.pyplot as plt
@@ -11,18 +12,23 @@ from sklearn.metrics import confusion_matrix, classification_report
 from tqdm import tqdm
 import torch.multiprocessing as mp
 import sys
-import shutil
 import time
+import queue
+import traceback
 
 
 
-def predict(file_path, model, model_path, device, batch_size, window_sizes, grid_resolution, features_to_use, num_workers, min_points=1000000, tile_size=50):
+def predict(file_path, model, model_path, device, batch_size, window_sizes, grid_resolution, features_to_use, num_workers, min_points=1000000, tile_size=50, approximate_grids=False, neighbor_index_backend='kdtree', tree_cache_dir=None, precision='float64', compress_las=True, laz_threads=None, inference_mode='streaming', num_processes=None):
     """
-    Checks if a LAS file is large, eventually subtiles it, performs inference on each subtile, 
-    and return the predictions stitched together. The function also deletes the subtiles once they have been processed. 
+    Performs inference on a LAS file and saves the points with their predictions in a single file, inside the model directory. 
+    The file is read once. With inference_mode='streaming' (see predict_streaming), a single neighbor index is built over the whole file 
+    and points are predicted in spatially ordered batches: no subtiling is needed, whatever the size of the file. 
+    With inference_mode='subtiles', files larger than min_points are subtiled in memory (see predict_subtiles_in_memory), every point 
+    being owned by the core of exactly one subtile, while smaller files are predicted as a whole, as in streaming mode. 
+    With inference_mode='parallel_subtiles', subtiles are predicted in parallel by a pool of worker processes (see predict_subtiles_parallel).
     
     Args:
-    - file_path (str): Path to the input LAS file.
+    - file_path (str): Path to the input LAS (or LAZ) file.
     - model (nn.Module): The trained PyTorch model.
     - model_path (str): File path to where the trained PyTorch model is stored.
     - device (torch.device): Device (CPU or GPU) to perform inference on.
@@ -31,20 +37,32 @@ def predict(file_path, model, model_path, device, batch_size, window_sizes, grid
     - grid_resolution (int): Grid resolution used for data preprocessing.
     - features_to_use (list): List of features used for training.
     - num_workers (int): Number of workers for loading data.
-    - min_points (int): Minimum number of points to decide if the file should be subtiled. Default is 1 million.
-    - tile_size (int): Size of each subtile in meters.
-    - overlap_size (int): Size of the overlap between subtiles in meters.
+    - min_points (int): Minimum number of points to decide if the file should be subtiled (subtiles modes only). Default is 1 million.
+    - tile_size (int): Size of each subtile in meters (subtiles modes only).
+    - approximate_grids (bool): If True, grids are sliced from per-scale rasters, built once, instead of being 
+                                queried cell by cell (positional error of at most half a cell). Default is False.
+    - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'. Default is 'kdtree'.
+    - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+    - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
+    - compress_las (bool): If True, the predicted file is saved as a compressed .laz file, else as a .las file. Default is True.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression. If None, all cores are used. Default is None.
+    - inference_mode (str): 'streaming' (one neighbor index over the whole file), 'subtiles' (one per subtile) or 'parallel_subtiles' 
+                            (subtiles predicted by a pool of processes). Default is 'streaming'.
+    - num_processes (int, optional): Number of worker processes in parallel_subtiles mode. If None, one per available core. Default is None.
 
     Returns:
     - None: This function performs inference and saves results to disk.
     """
+    if inference_mode not in ('streaming', 'subtiles', 'parallel_subtiles'):
+        raise ValueError(f"Unknown inference mode '{inference_mode}'. Choose 'streaming', 'subtiles' or 'parallel_subtiles'.")
+
     start_time = time.time()
 
     # get the model direcotry from its path
     model_directory = os.path.dirname(model_path)
     
     # Load the original LAS file
-    las_file = laspy.read(file_path)
+    las_file = read_las(file_path, laz_threads=laz_threads)
     total_points = len(las_file.x)
 
     # get overlap size from window sizes: it's the dimension of the largest window size
@@ -52,42 +70,56 @@ def predict(file_path, model, model_path, device, batch_size, window_sizes, grid
 
     # print(f"Total points in the file: {total_points}")
     
-    # If the file has more than 'min_points', we proceed with subtile logic
-    if total_points > min_points:
+    # In subtiles modes, if the file has more than 'min_points', we proceed with subtile logic
+    if inference_mode == 'parallel_subtiles' and total_points > min_points:
+        print(f"File is too big to be processed in one go. Subtiles are predicted in parallel...\n")
+        label_array = predict_subtiles_parallel(las_file, model, device, batch_size, window_sizes, grid_resolution, features_to_use, tile_size=tile_size, overlap_size=overlap_size, num_processes=num_processes, approximate_grids=approximate_grids, neighbor_index_backend=neighbor_index_backend, tree_cache_dir=tree_cache_dir, precision=precision)
+
+    elif inference_mode == 'subtiles' and total_points > min_points:
         print(f"File is too big to be processed in one go. Subtiling is needed before processing...\n")
         
-        # Call subtiler function to split the file into subtiles and save them
-        subtile_folder = subtiler(file_path, tile_size, overlap_size) 
-        
-        # Once subtiles are generated, we perform inference on each of them
-        prediction_folder = predict_subtiles(subtile_folder, model, device, batch_size, window_sizes, grid_resolution, features_to_use, num_workers)
+        # Subtile the file in memory and perform inference on each subtile, collecting the predictions of the whole file
+        label_array = predict_subtiles_in_memory(las_file, model, device, batch_size, window_sizes, grid_resolution, features_to_use, num_workers, tile_size=tile_size, overlap_size=overlap_size, approximate_grids=approximate_grids, neighbor_index_backend=neighbor_index_backend, tree_cache_dir=tree_cache_dir, precision=precision)
+            
+    else:
+        print(f"Performing inference directly on the entire file ({total_points} points), in spatially ordered batches.")
+        label_array = predict_streaming(las_file, model, device, batch_size, window_sizes, grid_resolution, features_to_use, num_workers, approximate_grids=approximate_grids, neighbor_index_backend=neighbor_index_backend, tree_cache_dir=tree_cache_dir, precision=precision)
 
-        # stitch subtiles back together to construct final file with predictions
-        output_filepath = stitch_subtiles(subtile_folder=prediction_folder, original_las=las_file, original_filename=file_path, model_directory=model_directory, overlap_size=overlap_size)
+    # save the points with their predictions in a single file, inside the model directory
+    output_filepath = save_predictions(las_file, label_array, original_filename=file_path, model_directory=model_directory, compress=compress_las, laz_threads=laz_threads)
 
-        # Teardown: Remove the subtile folder and its content
-        shutil.rmtree(subtile_folder)  # Removes the entire sub-tile folder
+    end_time=time.time()
 
-        end_time=time.time()
+    print(f'\nInference completed succesfully in {((end_time-start_time)/3600):.2f} hours. File saved at {output_filepath}')
 
-        print(f'\nInference completed succesfully in {((end_time-start_time)/3600):.2f} hours. File saved at {output_filepath}')
-            
-    else:
-        print(f"File has less than {min_points} points. Performing inference directly on the entire file.")
-        
-        # adapt predict_subtiles logic to handle a file with less than min points
-    
-    
 
+def load_points_for_inference(las_file):
+    """
+    Converts the points of a loaded LAS file to a data array, as DataSource does for files (labels are remapped, nan/inf values are cleaned).
 
+    Args:
+    - las_file (laspy.LasData): The loaded LAS (or LAZ) file.
 
-def predict_subtiles(subtile_folder, model, device, batch_size, window_sizes, grid_resolution, features_to_use, num_workers):
+    Returns:
+    - data_array (numpy.ndarray): The points of the file.
+    - known_features (list): Names of the columns of data_array.
+    """
+    data_array, known_features = las_data_to_numpy(las_file)
+    if 'label' in known_features:
+        data_array, _ = remap_labels(data_array)
+    data_array = clean_nan_values(data_array)
+    return data_array, known_features
+
+
+def predict_streaming(las_file, model, device, batch_size, window_sizes, grid_resolution, features_to_use, num_workers, approximate_grids=False, neighbor_index_backend='kdtree', tree_cache_dir=None, precision='float64'):
     """
-    Prepares the DataLoader for the given subtile file, runs inference and updates
-    the labels of the file with the predicted labels.
+    Runs inference on every point of a loaded LAS file without subtiling it: a single neighbor index is built over all the points 
+    of the file, and points are visited in spatially ordered (Z-order) batches, whose grids are generated, predicted and discarded 
+    one batch at a time. Memory is thus the points and the neighbor index of the file, plus the grids of a single batch (per loader worker).
+    Every point, including those close to the bounds of the file, is predicted exactly once, with all its neighbors available.
 
     Args:
-    - subtile_folder (str): Directory where the subtiles are stored.
+    - las_file (laspy.LasData): The loaded LAS (or LAZ) file.
     - model (nn.Module): The trained PyTorch model.
     - device (torch.device): Device (CPU or GPU) to perform inference on.
     - batch_size (int): The batch size to use for inference.
@@ -95,85 +127,321 @@ def predict_subtiles(subtile_folder, model, device, batch_size, window_sizes, gr
     - grid_resolution (int): Grid resolution used for data preprocessing.
     - features_to_use (list): List of features used for training.
     - num_workers (int): Number of workers for loading data.
+    - approximate_grids (bool): If True, grids are sliced from per-scale rasters of the file (see PointCloudDataset). Default is False.
+    - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'. Default is 'kdtree'.
+    - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+    - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
 
     Returns:
-    - prediction_folder (str): subfolder where the predicted subtiles have been saved.
+    - label_array (numpy.ndarray): Predicted label of each point of the file.
+    """
+    data_array, known_features = load_points_for_inference(las_file)
+    label_array = np.full(len(data_array), -1, dtype=np.int8)   # -1 = not classified
+
+    dataset = PointCloudDataset(
+        full_data_array=data_array,
+        window_sizes=window_sizes,
+        grid_resolution=grid_resolution,
+        features_to_use=features_to_use,
+        known_features=known_features,
+        approximate_grids=approximate_grids,
+        neighbor_index_backend=neighbor_index_backend,
+        tree_cache_dir=tree_cache_dir,
+        precision=precision,
+        selected_indices=np.arange(len(data_array))     # every point is predicted, even close to the bounds
+    )
+    inference_loader = create_dataloader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, 
+                                         spatial_block_size=batch_size)  # strict Z-order (cache-friendly neighbor queries)
+
+    run_inference(model, inference_loader, device, label_array)
+
+    return label_array
+
+
+def predict_subtiles_in_memory(las_file, model, device, batch_size, window_sizes, grid_resolution, features_to_use, num_workers, tile_size=50, overlap_size=30, approximate_grids=False, neighbor_index_backend='kdtree', tree_cache_dir=None, precision='float64'):
     """
+    Subdivides a loaded LAS file into subtiles in memory (as index arrays on its points), runs inference on each subtile and 
+    writes the predictions directly into a single label array for the whole file.
+    Each subtile is made of a core of size tile_size - overlap_size and of a halo of width overlap_size/2 around it (see generate_core_halo_indices): 
+    every point is owned by exactly one core and is predicted once, while halo points are only neighbors of the core points 
+    (in the KDTree of the subtile) and are never predicted.
 
-    # Get all subtile files from the subtile folder
-    subtile_files = [os.path.join(subtile_folder, f) for f in os.listdir(subtile_folder) if f.endswith('.las')]
+    Args:
+    - las_file (laspy.LasData): The loaded LAS (or LAZ) file, whose header gives the bounds of the tile.
+    - model (nn.Module): The trained PyTorch model.
+    - device (torch.device): Device (CPU or GPU) to perform inference on.
+    - batch_size (int): The batch size to use for inference.
+    - window_sizes (list): List of window sizes for grid preparation.
+    - grid_resolution (int): Grid resolution used for data preprocessing.
+    - features_to_use (list): List of features used for training.
+    - num_workers (int): Number of workers for loading data.
+    - tile_size (int): Size of each subtile (core and halo) in meters. Default is 50.
+    - overlap_size (int): Size of the overlap between subtiles in meters, i.e. twice the width of the halos. Default is 30.
+    - approximate_grids (bool): If True, grids are sliced from per-scale rasters of each subtile (see PointCloudDataset). Default is False.
+    - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'. Default is 'kdtree'.
+    - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+    - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
 
-    # Create a subfolder for predicted subtiles
-    predictions_folder = os.path.join(subtile_folder, 'subtiles_predicted')
-    os.makedirs(predictions_folder, exist_ok=True)
-    
-    file_counter = 0
-    total_files = len(subtile_files)
-    
-    # Iterate over all subtiles and run inference
-    for file_path in subtile_files: 
-        file_counter += 1 
-        
-        print(f'Processing subtile {file_path} : {file_counter}/{total_files}')
-        
-        # Prepare the DataLoader for the current file
-        inference_loader, _ = prepare_dataloader(
-            batch_size=batch_size,
-            data_filepath=file_path,
+    Returns:
+    - label_array (numpy.ndarray): Predicted label of each point of the file.
+    """
+    # Convert the points once (see load_points_for_inference)
+    data_array, known_features = load_points_for_inference(las_file)
+
+    label_array = np.full(len(data_array), -1, dtype=np.int8)   # -1 = not classified
+
+    # subtiles over the bounds in the header of the file
+    subtiles = list(generate_core_halo_indices(data_array[:, 0], data_array[:, 1], las_file.header.mins, las_file.header.maxs, 
+                                               core_size=tile_size - overlap_size, halo_size=overlap_size / 2))
+    for subtile_counter, (core_lower_left_x, core_lower_left_y, indices, core_mask) in enumerate(subtiles, start=1):
+        print(f'Processing subtile {core_lower_left_x}_{core_lower_left_y} : {subtile_counter}/{len(subtiles)}')
+
+        # Dataset on the points of the subtile (its neighbor index is built on core and halo points), with grids for the core points only
+        dataset = PointCloudDataset(
+            full_data_array=data_array[indices],
             window_sizes=window_sizes,
             grid_resolution=grid_resolution,
             features_to_use=features_to_use,
-            train_split=None,  # no train/eval split
-            num_workers=num_workers,
-            shuffle_train=False,  # don't shuffle data for inference
-            subset_file=None    # no subset selection, we want to predict the full subtile
+            known_features=known_features,
+            approximate_grids=approximate_grids,
+            neighbor_index_backend=neighbor_index_backend,
+            tree_cache_dir=tree_cache_dir,
+            precision=precision,
+            selected_indices=np.flatnonzero(core_mask)
         )
+        inference_loader = create_dataloader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, 
+                                             spatial_block_size=batch_size)  # strict Z-order (cache-friendly KDTree queries)
+
+        subtile_labels = np.full(len(indices), -1, dtype=np.int8)
+        run_inference(model, inference_loader, device, subtile_labels)
+        label_array[indices[core_mask]] = subtile_labels[core_mask]
+
+    return label_array
+
+
+def predict_subtiles_parallel(las_file, model, device, batch_size, window_sizes, grid_resolution, features_to_use, tile_size=50, overlap_size=30, num_processes=None, approximate_grids=False, neighbor_index_backend='kdtree', tree_cache_dir=None, precision='float64'):
+    """
+    Same as predict_subtiles_in_memory, with the subtiles predicted in parallel by a pool of num_processes worker processes (meant for CPU inference).
+    Subtiles are assigned up front, largest first, to the worker with the fewest points so far: each worker owns its queue of subtiles 
+    and predicts them one after another, with an in-process loader (no DataLoader workers are spun up per subtile). 
+    Workers are forked from the current process, so they share the points of the file and the model weights (in shared memory, 
+    read-only) instead of copying them. The torch threads of the process are split among the workers (see torch.set_num_threads).
+    Only the labels of the core points of each subtile are sent back, and the throughput of each worker is printed at the end.
+
+    Args:
+    - las_file (laspy.LasData): The loaded LAS (or LAZ) file, whose header gives the bounds of the tile.
+    - model (nn.Module): The trained PyTorch model.
+    - device (torch.device): Device to perform inference on. Must be the CPU: workers are forked, and CUDA cannot be used in forked processes.
+    - batch_size (int): The batch size to use for inference.
+    - window_sizes (list): List of window sizes for grid preparation.
+    - grid_resolution (int): Grid resolution used for data preprocessing.
+    - features_to_use (list): List of features used for training.
+    - tile_size (int): Size of each subtile (core and halo) in meters. Default is 50.
+    - overlap_size (int): Size of the overlap between subtiles in meters, i.e. twice the width of the halos. Default is 30.
+    - num_processes (int, optional): Number of worker processes. If None, one per available core. Default is None.
+    - approximate_grids (bool): If True, grids are sliced from per-scale rasters of each subtile (see PointCloudDataset). Default is False.
+    - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'. Default is 'kdtree'.
+    - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+    - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
 
-        # Open the subtile file to copy header information
-        original_subtile_file = laspy.read(file_path)
-        header = original_subtile_file.header
+    Returns:
+    - label_array (numpy.ndarray): Predicted label of each point of the file.
+    """
+    if num_processes is None:
+        num_processes = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if num_processes < 1:
+        raise ValueError(f"num_processes must be a positive integer, got {num_processes}.")
+    if torch.device(device).type != 'cpu':
+        raise ValueError(f"Parallel subtile inference runs on CPU only (got device '{device}'): CUDA cannot be used in forked worker processes. "
+                         f"Use inference_mode='streaming' or 'subtiles' on GPU.")
+    if 'fork' not in mp.get_all_start_methods():
+        raise ValueError("Parallel subtile inference needs the 'fork' start method, which is not available on this platform.")
+
+    data_array, known_features = load_points_for_inference(las_file)
+    label_array = np.full(len(data_array), -1, dtype=np.int8)   # -1 = not classified
+
+    subtiles = list(generate_core_halo_indices(data_array[:, 0], data_array[:, 1], las_file.header.mins, las_file.header.maxs, 
+                                               core_size=tile_size - overlap_size, halo_size=overlap_size / 2))
+    num_processes = max(min(num_processes, len(subtiles)), 1)
+
+    # queues of subtiles, balanced on their number of points (largest subtiles first, to the least loaded worker)
+    worker_queues, worker_loads = [[] for _ in range(num_processes)], [0] * num_processes
+    for subtile_idx in sorted(range(len(subtiles)), key=lambda subtile_idx: len(subtiles[subtile_idx][2]), reverse=True):
+        worker = int(np.argmin(worker_loads))
+        worker_queues[worker].append(subtile_idx)
+        worker_loads[worker] += len(subtiles[subtile_idx][2])
+
+    threads_per_worker = max(torch.get_num_threads() // num_processes, 1)
+    print(f"Predicting {len(subtiles)} subtiles with {num_processes} worker process(es), {threads_per_worker} torch thread(s) each")
 
-        # Check and add 'label' as needed
-        if 'label' not in header.point_format.dimension_names:
-            extra_dims = [laspy.ExtraBytesParams(name="label", type=np.int8)]
-            header.add_extra_dims(extra_dims)
+    model.eval()
+    model.share_memory()    # weights are shared by the workers, not copied
+    context = mp.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=subtile_worker, 
+                               args=(worker, worker_queues[worker], subtiles, data_array, known_features, model, device, batch_size, window_sizes, 
+                                     grid_resolution, features_to_use, approximate_grids, neighbor_index_backend, tree_cache_dir, precision, threads_per_worker, results), 
+                               daemon=True)
+               for worker in range(num_processes)]
+    for process in workers:
+        process.start()
+
+    worker_stats, num_done = {}, 0
+    try:
+        while len(worker_stats) < num_processes:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                failed = [worker for worker, process in enumerate(workers) if worker not in worker_stats and process.exitcode is not None]
+                if failed:
+                    raise RuntimeError(f"Worker {failed[0]} exited with code {workers[failed[0]].exitcode} before predicting all its subtiles.")
+                continue
 
-        # Initialize the label field with -1 values (-1 = not classified)
-        label_array = np.full(len(original_subtile_file.x), -1, dtype=np.int8)
+            kind, worker, payload = message
+            if kind == 'subtile':
+                subtile_idx, core_labels = payload
+                _, _, indices, core_mask = subtiles[subtile_idx]
+                label_array[indices[core_mask]] = core_labels
+                num_done += 1
+                print(f"[{num_done}/{len(subtiles)}] subtile {subtiles[subtile_idx][0]}_{subtiles[subtile_idx][1]} predicted by worker {worker}")
+            elif kind == 'error':
+                raise RuntimeError(f"Worker {worker} failed:\n{payload}")
+            else:
+                worker_stats[worker] = payload
+    finally:
+        for process in workers:
+            if process.is_alive() and len(worker_stats) < num_processes:
+                process.terminate()
+            process.join()
+
+    for worker in range(num_processes):
+        num_subtiles, num_points, elapsed = worker_stats[worker]
+        print(f"Worker {worker}: {num_subtiles} subtiles, {num_points} points in {elapsed:.1f}s ({num_points / max(elapsed, 1e-9):.0f} points/s)")
+
+    return label_array
+
+
+def subtile_worker(worker, subtile_queue, subtiles, data_array, known_features, model, device, batch_size, window_sizes, grid_resolution, features_to_use, approximate_grids, neighbor_index_backend, tree_cache_dir, precision, num_threads, results):
+    """
+    Worker process of predict_subtiles_parallel: predicts the core points of the subtiles of its queue, one after another, 
+    and puts ('subtile', worker, (subtile index, core labels)) messages on the results queue, then ('done', worker, 
+    (number of subtiles, number of points, seconds)). On failure, it puts ('error', worker, traceback) instead.
 
-        # Perform inference 
-        model.eval()  # Set model to evaluation mode
+    Args:
+    - worker (int): Index of the worker.
+    - subtile_queue (list): Indices of the subtiles (in subtiles) to predict.
+    - subtiles (list): Subtiles of the file, as yielded by generate_core_halo_indices.
+    - data_array (numpy.ndarray): The points of the file (see load_points_for_inference).
+    - known_features (list): Names of the columns of data_array.
+    - model (nn.Module): The trained PyTorch model, in shared memory.
+    - device (torch.device): Device to perform inference on.
+    - batch_size (int): The batch size to use for inference.
+    - window_sizes (list): List of window sizes for grid preparation.
+    - grid_resolution (int): Grid resolution used for data preprocessing.
+    - features_to_use (list): List of features used for training.
+    - approximate_grids (bool): If True, grids are sliced from per-scale rasters of each subtile (see PointCloudDataset).
+    - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'.
+    - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index).
+    - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset).
+    - num_threads (int): Number of torch threads of the worker.
+    - results (multiprocessing.Queue): Queue the results are sent back on.
+    """
+    try:
+        torch.set_num_threads(num_threads)
+        start_time = time.time()
+        num_points = 0
+        for subtile_idx in subtile_queue:
+            _, _, indices, core_mask = subtiles[subtile_idx]
+            dataset = PointCloudDataset(
+                full_data_array=data_array[indices],
+                window_sizes=window_sizes,
+                grid_resolution=grid_resolution,
+                features_to_use=features_to_use,
+                known_features=known_features,
+                approximate_grids=approximate_grids,
+                neighbor_index_backend=neighbor_index_backend,
+                tree_cache_dir=tree_cache_dir,
+                precision=precision,
+                selected_indices=np.flatnonzero(core_mask)
+            )
+            inference_loader = create_dataloader(dataset, batch_size=batch_size, shuffle=False, num_workers=0, spatial_block_size=batch_size)
 
-        with torch.no_grad():  # No gradient calculation during inference
-            for batch in tqdm(inference_loader, desc="Performing inference"):
-                if batch is None:
-                    continue
+            subtile_labels = np.full(len(indices), -1, dtype=np.int8)
+            run_inference(model, inference_loader, device, subtile_labels, progress=False)
+            results.put(('subtile', worker, (subtile_idx, subtile_labels[core_mask])))
+            num_points += int(np.sum(core_mask))
 
-                # Unpack the batch and move to the correct device
-                small_grids, medium_grids, large_grids, _, indices = batch
-                small_grids, medium_grids, large_grids = (
-                    small_grids.to(device), medium_grids.to(device), large_grids.to(device)
-                )
+        results.put(('done', worker, (len(subtile_queue), num_points, time.time() - start_time)))
+    except Exception:
+        results.put(('error', worker, traceback.format_exc()))
 
-                # Run model inference on the current batch
-                outputs = model(small_grids, medium_grids, large_grids)
-                preds = torch.argmax(outputs, dim=1)  # Get predicted labels
 
-                # Assign predictions directly to the label array for the current subtile
-                cpu_preds = preds.cpu()
-                label_array[indices] = cpu_preds.numpy()   
+def save_predictions(las_file, label_array, original_filename, model_directory, compress=False, laz_threads=None):
+    """
+    Saves the points of a LAS file with the predicted labels written into their 'label' field.
 
-        # Save the updated subtile with predictions written into the 'label' field
-        new_las = laspy.LasData(header)
-        new_las.points = original_subtile_file.points  # Copy original points
-        new_las.label = label_array  # Assign the labels to the new dimension
-        
-        # Save the file to the predictions folder with a '_pred' suffix
-        base_name, ext = os.path.splitext(os.path.basename(file_path))
-        pred_file_path = os.path.join(predictions_folder, f"{base_name}_pred{ext}")
-        new_las.write(pred_file_path)
+    Args:
+    - las_file (laspy.LasData): The loaded LAS (or LAZ) file.
+    - label_array (numpy.ndarray): Predicted label of each point of the file.
+    - original_filename (str): File name of the original file, used to name the prediction file (see prediction_filepath).
+    - model_directory (str): Directory where the trained PyTorch model is stored.
+    - compress (bool): If True, the predictions are saved as a compressed .laz file. Default is False.
+    - laz_threads (int, optional): Number of threads used for LAZ compression. If None, all cores are used. Default is None.
+
+    Returns:
+    - output_filepath (str): Path to the file with the predictions.
+    """
+    header = laspy.LasHeader(point_format=las_file.header.point_format, version=las_file.header.version)
+    header.offsets = las_file.header.offsets
+    header.scales = las_file.header.scales
+
+    # Check and add 'label' as needed
+    if 'label' not in header.point_format.dimension_names:
+        header.add_extra_dims([laspy.ExtraBytesParams(name="label", type=np.int8)])
+
+    predicted_las = laspy.LasData(header)
+    predicted_las.points = laspy.ScaleAwarePointRecord.zeros(len(las_file.points), header=header)
+    predicted_las.points.copy_fields_from(las_file.points)
+    predicted_las.label = label_array
+    predicted_las.update_header()
+
+    output_filepath = prediction_filepath(original_filename, model_directory, compress=compress)
+    write_las(predicted_las, output_filepath, laz_threads=laz_threads)
+    print(f"Total points: {len(predicted_las.points)}")
+
+    return output_filepath
+
+
+def run_inference(model, inference_loader, device, label_array, progress=True):
+    """
+    Runs the model on the batches of a loader and writes the predicted labels into label_array, at the indices returned with each batch.
+
+    Args:
+    - model (nn.Module): The trained PyTorch model.
+    - inference_loader (DataLoader): Loader of the points to classify (see PointCloudDataset).
+    - device (torch.device): Device (CPU or GPU) to perform inference on.
+    - label_array (numpy.ndarray): Array of labels, updated in place.
+    - progress (bool): If True, a progress bar is shown. Default is True.
+    """
+    model.eval()  # Set model to evaluation mode
+
+    with torch.no_grad():  # No gradient calculation during inference
+        for batch in tqdm(inference_loader, desc="Performing inference", disable=not progress):
+            if batch is None:
+                continue
+
+            # Unpack the batch and move to the correct device
+            small_grids, medium_grids, large_grids, _, indices = batch
+            small_grids, medium_grids, large_grids = (
+                small_grids.to(device).float(), medium_grids.to(device).float(), large_grids.to(device).float()
+            )
+
+            # Run model inference on the current batch
+            outputs = model(small_grids, medium_grids, large_grids)
+            preds = torch.argmax(outputs, dim=1)  # Get predicted labels
 
-    return predictions_folder
+            # Assign predictions directly to the label array
+            label_array[indices] = preds.cpu().numpy()
 
 
 def perform_evaluation(model, dataloader, device, class_names, model_save_folder, inference_file_path, save=False):
@@ -215,7 +483,7 @@ def perform_evaluation(model, dataloader, device, class_names, model_save_folder
             # Unpack the batch
             small_grids, medium_grids, large_grids, labels, _ = batch
             small_grids, medium_grids, large_grids, labels = (
-                small_grids.to(device), medium_grids.to(device), large_grids.to(device), labels.to(device)
+                small_grids.to(device).float(), medium_grids.to(device).float(), large_grids.to(device).float(), labels.to(device)
             )
 
             # Forward pass to get outputs
@@ -364,7 +632,7 @@ def inference_without_ground_truth(model, dataloader, device, data_file, model_p
 
             small_grids, medium_grids, large_grids, _, indices = batch
             small_grids, medium_grids, large_grids = (
-                small_grids.to(device), medium_grids.to(device), large_grids.to(device)
+                small_grids.to(device).float(), medium_grids.to(device).float(), large_grids.to(device).float()
             )
 
             # Run model inference
@@ -0,0 +1,57 @@
+from utils.train_data_utils import create_point_cloud_dataset
+from utils.grid_store import grid_store_params, write_grid_store
+import time
+
+
+def materialize_grids(full_data_filepath, grid_store_dir, window_sizes, grid_resolution, features_to_use, subset_file=None, mode='features', dtype='float32', shard_size=1024, batch_size=64, num_workers=0, precision='float64', data_source=None):
+    """
+    Generates the multiscale grids of every selected point once and saves them into a grid store, so that
+    training and evaluation can read them from disk instead of regenerating them at every epoch.
+
+    With mode='indices' only the nearest-neighbor index grids are saved: they are valid for any feature selection, so the same
+    store can be reused e.g. across feature-ablation runs, and they are C times smaller than the feature grids.
+
+    The store is saved inside grid_store_dir, in a subdirectory keyed by the path, modification time and size of the source files and by the grid parameters:
+    passing the same grid_store_dir to training or evaluation makes them automatically pick up the matching store, as long as
+    dtype matches the features of their precision policy ('float16' for precision='float16', 'float32' otherwise).
+
+    Args:
+        - full_data_filepath (str): Path to the full dataset.
+        - grid_store_dir (str): Root directory where the grid stores are saved.
+        - window_sizes (list): List of tuples for grid window sizes (e.g., [('small', 2.5), ('medium', 5.0), ('large', 10.0)]).
+        - grid_resolution (int): Resolution of the grids.
+        - features_to_use (list): Features to use for feature images generation.
+        - subset_file (str, optional): Path to the file containing the points to be selected from the full data. If None, all are selected.
+        - mode (str): 'features' to save the feature grids, 'indices' to save the nearest-neighbor index grids. Default is 'features'.
+        - dtype (str): Data type of the stored grids, 'float32' or 'float16' (ignored in 'indices' mode). Default is 'float32'.
+        - shard_size (int): Number of points per shard file. Default is 1024.
+        - batch_size (int): Number of points generated at a time. Default is 64.
+        - num_workers (int): Number of CPU workers used to generate the grids. Default is 0.
+        - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
+        - data_source (DataSource, optional): Already loaded full dataset (see DataSource), shared to avoid reading the file again. Default is None.
+
+    Returns:
+        - store_dir (str): Directory where the grid store has been saved.
+    """
+    print(f"\nMaterializing grids for file {full_data_filepath}" + (f" (subset: {subset_file})" if subset_file is not None else ""))
+    start_time = time.time()
+
+    # Ensure (additional check) that x, y, z are not included in the selected features
+    features_to_use = [feature for feature in features_to_use if feature not in ['x', 'y', 'z']]
+
+    params = grid_store_params(full_data_filepath, window_sizes, grid_resolution, features_to_use, subset_file=subset_file, mode=mode, dtype=dtype)
+
+    dataset = create_point_cloud_dataset(data_filepath=full_data_filepath,
+                                         window_sizes=window_sizes,
+                                         grid_resolution=grid_resolution,
+                                         features_to_use=features_to_use,
+                                         subset_file=subset_file,
+                                         precision=precision,
+                                         data_source=data_source)
+
+    store_dir = write_grid_store(dataset, grid_store_dir, params, shard_size=shard_size, batch_size=batch_size, num_workers=num_workers)
+
+    elapsed_time = (time.time() - start_time) / 60
+    print(f"Grids materialized in {elapsed_time:.2f} minutes.")
+
+    return store_dir
@@ -1,7 +1,8 @@
 import numpy as np
+from scipy.spatial import cKDTree
 
 
-def create_feature_grid(center_point, window_size, grid_resolution=128, channels=3):
+def create_feature_grid(center_point, window_size, grid_resolution=128, channels=3, dtype=np.float32):
     """
     Creates a grid around the center point and initializes cells to store feature values.
     Args:
@@ -9,6 +10,7 @@ def create_feature_grid(center_point, window_size, grid_resolution=128, channels
     - window_size (float): The size of the square window around the center point (in meters).
     - grid_resolution (int): The number of cells in one dimension of the grid (e.g., 128 for a 128x128 grid).
     - channels (int): The number of channels in the resulting image.
+    - dtype (numpy.dtype): Data type of the grid, float32 or float16 (see PRECISION_POLICIES). Default is float32.
 
     Returns:
     - grid (numpy.ndarray): A 2D grid initialized to zeros, which will store feature values.
@@ -21,7 +23,7 @@ def create_feature_grid(center_point, window_size, grid_resolution=128, channels
     cell_size = window_size / grid_resolution
 
     # Initialize the grid to zeros; each cell will eventually hold feature values
-    grid = np.zeros((grid_resolution, grid_resolution, channels))
+    grid = np.zeros((grid_resolution, grid_resolution, channels), dtype=dtype)
 
     # Generate cell coordinates for the grid based on the center point
     i_indices = np.arange(grid_resolution)
@@ -43,7 +45,7 @@ def assign_features_to_grid(tree, data_array, grid, x_coords, y_coords, constant
     Assigns features from the nearest point in the dataset to each cell in the grid using a pre-built KDTree.
 
     Args:
-    - tree (KDTree): Pre-built KDTree for efficient nearest-neighbor search.
+    - tree (KDTree): Pre-built KDTree (or any neighbor index of utils/neighbor_index.py) for efficient nearest-neighbor search.
     - data_array (numpy.ndarray): Array where each row represents a point with its x, y, z coordinates and features.
     - grid (numpy.ndarray): A 2D grid initialized to zeros, which will store feature values.
     - x_coords (numpy.ndarray): Array of x coordinates for the centers of the grid cells.
@@ -62,7 +64,8 @@ def assign_features_to_grid(tree, data_array, grid, x_coords, y_coords, constant
     # Query the KDTree in bulk using all grid coordinates
     _, indices = tree.query(grid_coords)
     
-    selected_features = data_array[indices, :][:, feature_indices]
+    # Gather only the selected columns of the nearest points (no full-row copy)
+    selected_features = data_array[indices[:, None], feature_indices]
     
     assert selected_features.shape[1] == len(feature_indices), (f"Shape mismatch: Selected features have {selected_features.shape[1]} channels, "
                                                                 f"but expected {len(feature_indices)} channels.")
@@ -131,7 +134,7 @@ def old_generate_multiscale_grids(center_point, data_array, window_sizes, grid_r
     return grids_dict, status
 
 
-def generate_multiscale_grids_masked(center_point, data_array, window_sizes, grid_resolution, feature_indices, kdtree):
+def generate_multiscale_grids_masked(center_point, data_array, window_sizes, grid_resolution, feature_indices, kdtree, dtype=np.float32):
 
     grids_dict = {}  # To store grids for each scale
     channels = len(feature_indices)
@@ -140,7 +143,7 @@ def generate_multiscale_grids_masked(center_point, data_array, window_sizes, gri
 
         # Generate the grid for the current scale
         grid, _, x_coords, y_coords, z_coord = create_feature_grid(
-            center_point, window_size, grid_resolution, channels
+            center_point, window_size, grid_resolution, channels, dtype=dtype
         )
 
         # Assign features from the nearest point in the data array using the KDTree
@@ -152,6 +155,227 @@ def generate_multiscale_grids_masked(center_point, data_array, window_sizes, gri
     return grids_dict
 
 
+def create_multiscale_grid_coords(center_points, window_sizes, grid_resolution=128):
+    """
+    Computes the cell center coordinates of the grids of every scale for a whole batch of center points.
+    Cell coordinates follow the same convention as create_feature_grid (x_k = x_pk - (64.5 - j) * w).
+
+    Args:
+    - center_points (numpy.ndarray): Array of shape (batch_size, 3) with the (x, y, z) coordinates of the center points.
+    - window_sizes (list): List of tuples where each tuple contains (scale_label, window_size).
+                           Example: [('small', 2.5), ('medium', 5.0), ('large', 10.0)].
+    - grid_resolution (int): The number of cells in one dimension of the grid (e.g., 128 for a 128x128 grid).
+
+    Returns:
+    - grid_coords (numpy.ndarray): Cell coordinates of shape (batch_size, scales, grid_resolution, grid_resolution, 3),
+                                   indexed as [point, scale, x index, y index, xyz].
+    """
+    center_points = np.asarray(center_points, dtype=np.float64).reshape(-1, 3)
+    num_points = center_points.shape[0]
+    cell_sizes = np.array([window_size for _, window_size in window_sizes], dtype=np.float64) / grid_resolution
+
+    half_resolution_minus_half = (grid_resolution / 2) - 0.5
+    offsets = half_resolution_minus_half - np.arange(grid_resolution)  # same offsets for x (j) and y (i) indices
+
+    # following x_k = x_pk - (64.5 - j) * w, for every point and scale at once. Shape: (batch_size, scales, grid_resolution)
+    x_coords = center_points[:, 0, None, None] - offsets[None, None, :] * cell_sizes[None, :, None]
+    y_coords = center_points[:, 1, None, None] - offsets[None, None, :] * cell_sizes[None, :, None]
+
+    grid_coords = np.empty((num_points, len(cell_sizes), grid_resolution, grid_resolution, 3), dtype=np.float64)
+    grid_coords[..., 0] = x_coords[:, :, :, None]
+    grid_coords[..., 1] = y_coords[:, :, None, :]
+    grid_coords[..., 2] = center_points[:, 2, None, None, None]  # Z coordinate is constant for all cells of a point
+
+    return grid_coords
+
+
+def compute_neighbor_index_grids(center_points, window_sizes, grid_resolution, kdtree):
+    """
+    Computes, for every cell of every grid of a batch of points, the index of the nearest point in the point cloud.
+    Index grids do not depend on the selected features, so they can be cached and reused across different feature sets.
+
+    Args:
+    - center_points (numpy.ndarray): Array of shape (batch_size, 3) with the (x, y, z) coordinates of the center points.
+    - window_sizes (list): List of tuples where each tuple contains (scale_label, window_size).
+                           Example: [('small', 2.5), ('medium', 5.0), ('large', 10.0)].
+    - grid_resolution (int): Resolution of the grid (e.g., 128 for 128x128 grids).
+    - kdtree (KDTree): Prebuilt KDTree (or any neighbor index of utils/neighbor_index.py) for nearest neighbor search.
+
+    Returns:
+    - index_grids (numpy.ndarray): int32 array of shape (batch_size, scales, grid_resolution, grid_resolution), indexed as [point, scale, x index, y index].
+    """
+    if kdtree.n > np.iinfo(np.int32).max:
+        raise ValueError(f"Point cloud has {kdtree.n} points: too many to be indexed with int32 index grids.")
+
+    grid_coords = create_multiscale_grid_coords(center_points, window_sizes, grid_resolution)
+
+    # Query the KDTree in bulk using the cells of every grid of every point
+    _, indices = kdtree.query(grid_coords.reshape(-1, 3))
+
+    return indices.astype(np.int32).reshape(grid_coords.shape[:-1])
+
+
+def build_raster_pyramid(data_array, window_sizes, grid_resolution, chunk_cells=2**22):
+    """
+    Rasterizes the whole point cloud once per scale, at that scale's cell size (window_size / grid_resolution), storing in each
+    raster cell the index of the nearest point (planimetric distance, i.e. z is not considered).
+    The grids of every point can then be sliced out of these rasters (see compute_neighbor_index_grids_from_rasters) instead of
+    querying the KDTree for every cell of every grid.
+    Rasters are padded by half a grid (plus one cell) on each side, so that the grids of border points are always inside the raster.
+    Notice that each raster has about (extent / cell_size)^2 int32 cells: this is meant for tiles (or subtiles) of limited extent.
+
+    Args:
+    - data_array (numpy.ndarray): 2D array containing the point cloud data (x, y in the first two columns).
+    - window_sizes (list): List of tuples where each tuple contains (scale_label, window_size).
+                           Example: [('small', 2.5), ('medium', 5.0), ('large', 10.0)].
+    - grid_resolution (int): Resolution of the grid (e.g., 128 for 128x128 grids).
+    - chunk_cells (int): Number of raster cells queried at a time, to bound the memory used while rasterizing. Default is 2^22.
+
+    Returns:
+    - raster_pyramid (dict): Dictionary with the int32 rasters of each scale ('rasters'), the (x, y) coordinates of
+                             their lower-left corner ('origins') and their cell sizes ('cell_sizes').
+    """
+    if data_array.shape[0] > np.iinfo(np.int32).max:
+        raise ValueError(f"Point cloud has {data_array.shape[0]} points: too many to be indexed with int32 rasters.")
+
+    xy = data_array[:, :2]
+    tree = cKDTree(xy)
+    xy_min, xy_max = xy.min(axis=0), xy.max(axis=0)
+    pad = grid_resolution // 2 + 1
+
+    rasters, origins, cell_sizes = [], [], []
+    for _, window_size in window_sizes:
+        cell_size = window_size / grid_resolution
+        origin = xy_min - pad * cell_size
+        nx, ny = (np.ceil((xy_max - xy_min) / cell_size).astype(np.int64) + 1 + 2 * pad)
+
+        raster = np.empty((nx, ny), dtype=np.int32)
+        y_centers = origin[1] + (np.arange(ny) + 0.5) * cell_size
+
+        # rasterize a block of rows at a time
+        rows_per_chunk = max(1, chunk_cells // ny)
+        for start in range(0, nx, rows_per_chunk):
+            stop = min(nx, start + rows_per_chunk)
+            x_centers = origin[0] + (np.arange(start, stop) + 0.5) * cell_size
+            cell_x, cell_y = np.meshgrid(x_centers, y_centers, indexing='ij')
+            _, indices = tree.query(np.column_stack((cell_x.ravel(), cell_y.ravel())), workers=-1)
+            raster[start:stop] = indices.reshape(stop - start, ny)
+
+        rasters.append(raster)
+        origins.append(origin)
+        cell_sizes.append(cell_size)
+
+    return {'rasters': rasters, 'origins': np.array(origins), 'cell_sizes': np.array(cell_sizes)}
+
+
+def compute_neighbor_index_grids_from_rasters(center_points, raster_pyramid, grid_resolution):
+    """
+    Approximates the index grids of a batch of points by slicing them out of the raster pyramid (see build_raster_pyramid).
+    Each grid is the grid_resolution x grid_resolution block of raster cells closest to the exact grid, so every cell 
+    is sampled at most half a cell away (along x and y) from its exact position. Also, the nearest point is 
+    found in the plane, instead of at the height of the center point as in compute_neighbor_index_grids.
+
+    Args:
+    - center_points (numpy.ndarray): Array of shape (batch_size, 3) with the (x, y, z) coordinates of the center points.
+    - raster_pyramid (dict): Raster pyramid of the point cloud, as returned by build_raster_pyramid.
+    - grid_resolution (int): Resolution of the grid (e.g., 128 for 128x128 grids).
+
+    Returns:
+    - index_grids (numpy.ndarray): int32 array of shape (batch_size, scales, grid_resolution, grid_resolution), indexed as [point, scale, x index, y index].
+    """
+    center_points = np.asarray(center_points, dtype=np.float64).reshape(-1, 3)
+    rasters = raster_pyramid['rasters']
+    offsets = np.arange(grid_resolution)
+
+    index_grids = np.empty((center_points.shape[0], len(rasters), grid_resolution, grid_resolution), dtype=np.int32)
+    for scale, raster in enumerate(rasters):
+        origin, cell_size = raster_pyramid['origins'][scale], raster_pyramid['cell_sizes'][scale]
+
+        # raster cell of the first grid cell: the exact grid starts half a window (minus half a cell) before the center point
+        first_cells = np.rint((center_points[:, :2] - origin) / cell_size - grid_resolution / 2).astype(np.int64)
+        first_cells = np.clip(first_cells, 0, np.array(raster.shape) - grid_resolution)
+
+        x_cells = first_cells[:, 0, None] + offsets
+        y_cells = first_cells[:, 1, None] + offsets
+        index_grids[:, scale] = raster[x_cells[:, :, None], y_cells[:, None, :]]
+
+    return index_grids
+
+
+def build_feature_matrix(data_array, feature_indices, dtype=np.float32, feature_names=None):
+    """
+    Projects the point cloud data onto the selected features, in a C-contiguous float32 (or float16) matrix.
+    Gathering the rows of this matrix only moves the selected channels, instead of every column of the data array.
+    Features out of the range of dtype (e.g., LAS intensities above 65504 in float16) are refused instead of becoming inf.
+
+    Args:
+    - data_array (numpy.ndarray): 2D array containing the point cloud data.
+    - feature_indices (list): List of feature indices to be selected from the full list of features.
+    - dtype (numpy.dtype): Data type of the features, float32 or float16 (see PRECISION_POLICIES). Default is float32.
+    - feature_names (list, optional): Names of the selected features, used in error messages. Default is None.
+
+    Returns:
+    - feature_matrix (numpy.ndarray): Array of shape (num_points, channels), of the given dtype.
+    """
+    selected = data_array[:, feature_indices]
+    max_value = np.finfo(dtype).max
+    if len(selected) > 0 and (not np.issubdtype(selected.dtype, np.floating) or np.finfo(selected.dtype).max > max_value):
+        finite = np.where(np.isfinite(selected), selected, 0)   # inf/nan values are cleaned upstream (see clean_nan_values)
+        out_of_range = np.flatnonzero(np.abs(finite).max(axis=0) > max_value)
+        if len(out_of_range) > 0:
+            names = [feature_names[i] if feature_names is not None else f"column {feature_indices[i]}" for i in out_of_range]
+            raise ValueError(f"Features {names} exceed the largest {np.dtype(dtype).name} value ({max_value}): "
+                             f"use a wider precision policy (e.g., 'float32') or rescale them.")
+    return np.ascontiguousarray(selected, dtype=dtype)
+
+
+def gather_grids_from_neighbor_indices(index_grids, feature_matrix, out=None):
+    """
+    Builds the feature grids from index grids by gathering the features of the nearest points with a single np.take,
+    written straight into the output buffer.
+
+    Args:
+    - index_grids (numpy.ndarray): Index grids of shape (batch_size, scales, grid_resolution, grid_resolution).
+    - feature_matrix (numpy.ndarray): Selected features of the point cloud, as returned by build_feature_matrix.
+    - out (numpy.ndarray, optional): Preallocated buffer of shape (batch_size, scales, grid_resolution, grid_resolution, channels),
+                                     with the dtype of the feature matrix.
+
+    Returns:
+    - grids (numpy.ndarray): Grids of shape (batch_size, scales, channels, grid_resolution, grid_resolution), with the dtype of the feature matrix.
+                             The grids are a channels-last view on the output buffer.
+    """
+    channels = feature_matrix.shape[1]
+    if out is None:
+        out = np.empty(index_grids.shape + (channels,), dtype=feature_matrix.dtype)
+
+    np.take(feature_matrix, index_grids.ravel(), axis=0, out=out.reshape(-1, channels))
+
+    # (batch, scales, x, y, channels) -> (batch, scales, channels, x, y), i.e. channels first (Torch format)
+    return np.transpose(out, (0, 1, 4, 2, 3))
+
+
+def generate_multiscale_grids_batched(center_points, data_array, window_sizes, grid_resolution, feature_indices, kdtree):
+    """
+    Generates the multiscale grids for a whole batch of points, querying the KDTree once for all cells of all scales
+    and gathering the features in a single pass. Equivalent to calling generate_multiscale_grids_masked on each point.
+
+    Args:
+    - center_points (numpy.ndarray): Array of shape (batch_size, 3) with the (x, y, z) coordinates of the center points.
+    - data_array (numpy.ndarray): 2D array containing the point cloud data.
+    - window_sizes (list): List of tuples where each tuple contains (scale_label, window_size).
+                           Example: [('small', 2.5), ('medium', 5.0), ('large', 10.0)].
+    - grid_resolution (int): Resolution of the grid (e.g., 128 for 128x128 grids).
+    - feature_indices (list): List of feature indices to be selected from the full list of features.
+    - kdtree (KDTree): Prebuilt KDTree for nearest neighbor search.
+
+    Returns:
+    - grids (numpy.ndarray): Grids of shape (batch_size, scales, channels, grid_resolution, grid_resolution), in float32.
+    """
+    index_grids = compute_neighbor_index_grids(center_points, window_sizes, grid_resolution, kdtree)
+
+    return gather_grids_from_neighbor_indices(index_grids, build_feature_matrix(data_array, feature_indices))
+
+
 
 
 
@@ -37,8 +37,9 @@ def train(model, dataloader, criterion, optimizer, device):
         small_grids, medium_grids, large_grids, labels, _ = batch
 
         
+        # float16 grids (see PRECISION_POLICIES) are cast to float32 once on the device: the model runs in float32
         small_grids, medium_grids, large_grids, labels = (
-            small_grids.to(device), medium_grids.to(device), large_grids.to(device), labels.to(device)
+            small_grids.to(device).float(), medium_grids.to(device).float(), large_grids.to(device).float(), labels.to(device)
         )
         
         batch_size = labels.size(0) # get the actual batch size
@@ -102,7 +103,7 @@ def validate(model, dataloader, criterion, device):
             small_grids, medium_grids, large_grids, labels, _ = batch
 
             small_grids, medium_grids, large_grids, labels = (
-                small_grids.to(device), medium_grids.to(device), large_grids.to(device), labels.to(device)
+                small_grids.to(device).float(), medium_grids.to(device).float(), large_grids.to(device).float(), labels.to(device)
             )
 
             # Get the batch size
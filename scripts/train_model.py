@@ -1,13 +1,13 @@
 import torch.nn as nn
 import torch.optim as optim
 from models.mcnn import MultiScaleCNN
-from utils.train_data_utils import prepare_dataloader
+from utils.train_data_utils import prepare_dataloader, DataSource
+from utils.point_cloud_data_utils import is_subset_index_file, load_subset_indices
 from scripts.train import train_epochs
-from utils.point_cloud_data_utils import extract_num_classes, read_file_to_numpy
 import time
 
 
-def train_model(full_data_filepath, features_to_use, batch_size, epochs, patience, learning_rate, momentum, step_size, learning_rate_decay_factor, num_workers, save_dir, device, window_sizes, grid_resolution=128, training_data_filepath=None):
+def train_model(full_data_filepath, features_to_use, batch_size, epochs, patience, learning_rate, momentum, step_size, learning_rate_decay_factor, num_workers, save_dir, device, window_sizes, grid_resolution=128, training_data_filepath=None, grid_store_dir=None, index_cache_bytes=None, spatial_block_size=None, neighbor_index_backend='kdtree', tree_cache_dir=None, precision='float64', ingest_cache_dir=None, data_source=None):
     """
     Trains a MultiScaleCNN (MCNN) model for point cloud classification using the provided training data and hyperparameters.
 
@@ -29,7 +29,15 @@ def train_model(full_data_filepath, features_to_use, batch_size, epochs, patienc
         - device (torch.device): Device on which to train the model (CPU or GPU).
         - window_sizes (list): List of tuples for grid window sizes (e.g., [('small', 2.5), ('medium', 5.0), ('large', 10.0)]).
         - grid_resolution (int): Resolution of the grid used for preparing input data for the model.
-        - training_data_filepath (str, optional): Path to the CSV training file containing coordinates of points to be selected from the full data. If None, all are selected.
+        - training_data_filepath (str, optional): Path to the CSV training file containing coordinates of points to be selected from the full data, or to a .npy file of their row indices (see save_subset_indices). If None, all are selected.
+        - grid_store_dir (str, optional): Root directory of the materialized grid stores. If a matching store exists, grids are read from it.
+        - index_cache_bytes (int, optional): Memory budget (in bytes) to cache the nearest-neighbor index grids across epochs. If None, no cache is used.
+        - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'. Default is 'kdtree'.
+        - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+        - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
+        - ingest_cache_dir (str, optional): Directory where .las and .csv inputs are converted to memory-mapped column-major .npy files on first use (see read_file_to_numpy). Default is None.
+        - data_source (DataSource, optional): Already loaded full dataset (see DataSource), shared to avoid reading the file again. Default is None.
+        - spatial_block_size (int, optional): If set, training points are sampled in Z-order, shuffled in blocks of this many points. If None, points are shuffled individually.
 
 
     Returns:
@@ -39,7 +47,10 @@ def train_model(full_data_filepath, features_to_use, batch_size, epochs, patienc
     # Ensure (additional check) that x, y, z are not included in the selected features
     features_to_use = [feature for feature in features_to_use if feature not in ['x', 'y', 'z']]    
     
-    num_classes = extract_num_classes(raw_file_path=full_data_filepath)   # determine the number of classes from the full dataset   
+    # Load the full dataset once: the dataloaders and the metadata below all use the same data source
+    if data_source is None:
+        data_source = DataSource(full_data_filepath, ingest_cache_dir=ingest_cache_dir, precision=precision)
+    num_classes = data_source.num_classes   # determine the number of classes from the full dataset   
     num_channels = len(features_to_use)  # Determine the number of channels based on selected features  
 
     # Prepare DataLoaders for training and validation
@@ -52,11 +63,19 @@ def train_model(full_data_filepath, features_to_use, batch_size, epochs, patienc
         train_split=0.8,
         num_workers=num_workers,
         shuffle_train=True,
-        subset_file=training_data_filepath
+        subset_file=training_data_filepath,
+        grid_store_dir=grid_store_dir,
+        index_cache_bytes=index_cache_bytes,
+        spatial_block_size=spatial_block_size,
+        neighbor_index_backend=neighbor_index_backend,
+        tree_cache_dir=tree_cache_dir,
+        precision=precision,
+        ingest_cache_dir=ingest_cache_dir,
+        data_source=data_source
     )
     
-    full_data_array, full_known_features = read_file_to_numpy(data_dir=full_data_filepath, features_to_use=None)   # get the known features from the full dataset
-    total_num_points = full_data_array.shape[0]
+    full_known_features = data_source.known_features   # get the known features from the full dataset
+    total_num_points = data_source.num_points
 
     print(f'Loaded full point cloud data with {total_num_points} points')
 
@@ -67,10 +86,14 @@ def train_model(full_data_filepath, features_to_use, batch_size, epochs, patienc
     print(f'Number of unique classes read from full data file: {num_classes}\n')
 
 
-    if training_data_filepath is not None: # check subset file 
-        subset_array, subset_features = read_file_to_numpy(data_dir=training_data_filepath, features_to_use=None)
-        num_subset = subset_array.shape[0]
-        num_subset_classes = extract_num_classes(raw_file_path=training_data_filepath)
+    if training_data_filepath is not None and is_subset_index_file(training_data_filepath):  # rows of the full dataset: no points to check
+        num_subset = len(load_subset_indices(training_data_filepath, num_points=total_num_points))
+        print(f"\nSince a subset of the full dataset was selected, feature images will be generated only for the rows listed in {training_data_filepath}, corresponding to {num_subset} / {total_num_points} points.")
+    elif training_data_filepath is not None: # check subset file 
+        subset_source = DataSource(training_data_filepath, ingest_cache_dir=ingest_cache_dir)
+        subset_features = subset_source.known_features
+        num_subset = subset_source.num_points
+        num_subset_classes = subset_source.num_classes
         print(f"\nSince a subset of the full dataset was selected, feature images will be generated only for points contained in {training_data_filepath}, corresponding to {num_subset} / {total_num_points} points.")
         assert full_known_features == subset_features, f"Full training data features do not match the features from the subset."
         assert num_subset_classes == num_classes, f"Number of unique classes (labels) doesn't match between full data file and subset file."
@@ -1,8 +1,9 @@
 import unittest
 import os
 import shutil
+import tempfile
 from collections import defaultdict
-from utils.create_dataset import pair_ground_and_offgrounds, stitch_pairs, create_train_eval_datasets
+from utils.create_dataset import pair_ground_and_offgrounds, stitch_pairs, create_train_eval_datasets, create_dataset, process_file_pairs, estimate_pair_memory
 from utils.point_cloud_data_utils import las_to_csv, read_file_to_numpy, clean_and_combine_csv_files
 import laspy
 import numpy as np
@@ -213,4 +214,75 @@ class TestCreateDataset(unittest.TestCase):
             self.assertTrue((train_class_counts <= max_points_per_class).all(), "Some classes in training set exceed max_points_per_class.")
             self.assertTrue((eval_class_counts <= max_points_per_class).all(), "Some classes in evaluation set exceed max_points_per_class.")
 
-            print("\nTrain/Eval dataset creation test passed successfully!")
\ No newline at end of file
+            print("\nTrain/Eval dataset creation test passed successfully!")
+
+
+def write_synthetic_tile(file_path, num_points, xmin=686000.0, ymin=4929000.0, seed=0):
+    # ground or off-ground tile, with the dimensions stitched by stitch_pair and coordinates within the tile named in the file
+    rng = np.random.default_rng(seed)
+    header = laspy.LasHeader(point_format=8, version="1.4")
+    header.offsets = np.array([686000.0, 4929000.0, 0.0])
+    header.scales = np.array([0.01, 0.01, 0.01])
+    header.add_extra_dims([laspy.ExtraBytesParams(name='label', type=np.int32)])
+    las = laspy.LasData(header)
+    las.x = xmin + rng.uniform(0, 500, num_points)
+    las.y = ymin + rng.uniform(0, 500, num_points)
+    las.z = rng.uniform(0, 50, num_points)
+    for dimension in ('intensity', 'red', 'green', 'blue', 'nir'):
+        setattr(las, dimension, rng.integers(0, 2**16, num_points))
+    las.return_number = rng.integers(1, 3, num_points)
+    las.number_of_returns = np.full(num_points, 2)
+    las.label = rng.choice([3, 5, 6, 10], num_points)
+    las.write(file_path)
+
+
+class TestParallelCreateDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_folders = []
+        for tile_idx in range(4):
+            xmin = 686000 + 500 * tile_idx
+            folder = os.path.join(self.tmp_dir, 'tiles', f'32_{xmin}_4929000')
+            os.makedirs(folder)
+            write_synthetic_tile(os.path.join(folder, f'32_{xmin}_4929000_FGLn.las'), 3000 + 1000 * tile_idx, xmin=xmin, seed=tile_idx)
+            for part in range(2):
+                write_synthetic_tile(os.path.join(folder, f'32_{xmin}_4929000_{part}_FSLn.las'), 1500, xmin=xmin, seed=10 * tile_idx + part + 1)
+            self.input_folders.append(folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parallel_matches_sequential(self):
+        datasets = []
+        for num_workers, max_memory_mb in ((1, None), (3, None), (2, 1)):
+            output_folder = os.path.join(self.tmp_dir, f'dataset_{num_workers}')
+            create_dataset(self.input_folders, os.path.join(self.tmp_dir, f'fused_{num_workers}'), max_points_per_class=2000, 
+                           output_dataset_folder=output_folder, chosen_classes=[3, 5, 6], file_format='csv', 
+                           num_workers=num_workers, max_memory_mb=max_memory_mb)
+            datasets.append([pd.read_csv(os.path.join(output_folder, f'{split}_dataset.csv')) for split in ('full', 'train', 'eval')])
+
+        for dataset in datasets[1:]:
+            for split_df, reference_df in zip(dataset, datasets[0]):
+                pd.testing.assert_frame_equal(split_df, reference_df)
+        full_df = datasets[0][0]
+        self.assertEqual(len(full_df), np.sum([len(pd.read_csv(path)) for path in 
+                                               process_file_pairs(pair_ground_and_offgrounds(self.input_folders), os.path.join(self.tmp_dir, 'fused_check'), chosen_classes=[3, 5, 6])]))
+        self.assertEqual(set(full_df['label']), {3, 5, 6})
+
+    def test_stitch_pairs_keeps_all_dimensions(self):
+        file_pairs = pair_ground_and_offgrounds(self.input_folders[:1])
+        fused_file = stitch_pairs(file_pairs, os.path.join(self.tmp_dir, 'fused'), compress=True)[0]
+        fused = laspy.read(fused_file)
+        inputs = [laspy.read(file) for file in [file_pairs[0][0]] + file_pairs[0][1]]
+        self.assertEqual(list(fused.point_format.dimension_names), list(inputs[0].point_format.dimension_names))
+        for dimension in fused.point_format.dimension_names:
+            np.testing.assert_array_equal(fused[dimension], np.concatenate([las[dimension] for las in inputs]), err_msg=dimension)
+
+    def test_memory_estimate_and_errors(self):
+        file_pairs = pair_ground_and_offgrounds(self.input_folders)
+        memory = [estimate_pair_memory(file_pair) for file_pair in file_pairs]
+        self.assertTrue(np.all(np.diff(memory) > 0))     # larger ground tiles in later folders
+        self.assertGreater(min(memory), 6000 * laspy.LasHeader(point_format=8).point_format.size)
+        with self.assertRaises(ValueError):
+            process_file_pairs(file_pairs, os.path.join(self.tmp_dir, 'fused'), num_workers=0)
@@ -0,0 +1,336 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import laspy
+import pandas as pd
+from utils.point_cloud_data_utils import read_las_file_to_numpy, read_file_to_numpy, read_csv_file_to_numpy, extract_num_classes, clean_and_combine_csv_files, filter_features_in_csv
+from utils.ingest_cache import load_or_ingest_columns, INGEST_CACHE_STATS
+from utils.table_io import read_table, read_table_columns, iter_table_chunks, write_table
+from utils.create_dataset import create_train_eval_datasets
+from utils.las_io import read_las, write_las, laz_backend, concatenate_las
+from utils.point_cloud_data_utils import subtiler, stitch_subtiles
+from scripts.benchmarks.synthetic import write_synthetic_las
+
+
+class TestChunkedLasReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.las_file = os.path.join(self.tmp_dir, 'tile.las')
+        self.num_points = 100000
+        write_synthetic_las(self.las_file, self.num_points)
+        self.features_to_extract = ['intensity', 'red', 'green', 'blue']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_reference(self, feature_names):
+        # whole-file read, as done before streaming
+        las_data = laspy.read(self.las_file)
+        return np.vstack([las_data[feature] for feature in feature_names]).T
+
+    def test_matches_whole_file_read(self):
+        for chunk_size in (999, 30000, 10**6):
+            data_array, feature_names = read_las_file_to_numpy(self.las_file, features_to_extract=self.features_to_extract, chunk_size=chunk_size)
+            self.assertEqual(feature_names, ['x', 'y', 'z', 'intensity', 'red', 'green', 'blue', 'segment_id', 'label'])
+            self.assertEqual(data_array.dtype, np.float64)
+            np.testing.assert_array_equal(data_array, self.read_reference(feature_names))
+
+        # all dimensions, as read by read_file_to_numpy
+        data_array, feature_names = read_file_to_numpy(self.las_file)
+        np.testing.assert_array_equal(data_array, self.read_reference(feature_names))
+
+    def test_missing_features_and_column_selection(self):
+        data_array, feature_names = read_las_file_to_numpy(self.las_file, features_to_extract=['red', 'nir'])
+        self.assertEqual(feature_names, ['x', 'y', 'z', 'red', 'segment_id', 'label'])
+        self.assertEqual(data_array.shape, (self.num_points, 6))
+
+    def test_early_stop(self):
+        data_array, feature_names = read_las_file_to_numpy(self.las_file, features_to_extract=self.features_to_extract, chunk_size=3000, max_points=10001)
+        self.assertEqual(len(data_array), 10001)
+        np.testing.assert_array_equal(data_array, self.read_reference(feature_names)[:10001])
+
+    def test_memmap_output(self):
+        out_file = os.path.join(self.tmp_dir, 'tile.npy')
+        data_array, feature_names = read_las_file_to_numpy(self.las_file, features_to_extract=self.features_to_extract, out_file=out_file)
+        self.assertIsInstance(data_array, np.memmap)
+        np.testing.assert_array_equal(np.load(out_file), self.read_reference(feature_names))
+
+    def test_reads_one_chunk_at_a_time(self):
+        chunk_size = 10000
+        chunk_lengths = []
+        chunk_iterator = laspy.LasReader.chunk_iterator
+
+        def recording_chunk_iterator(las_reader, points_per_iteration):
+            for points in chunk_iterator(las_reader, points_per_iteration):
+                chunk_lengths.append(len(points))
+                yield points
+
+        # the file is decoded chunk by chunk into the preallocated output, never as a whole
+        with mock.patch.object(laspy.LasReader, 'chunk_iterator', autospec=True, side_effect=recording_chunk_iterator), \
+             mock.patch.object(laspy.LasReader, 'read', autospec=True) as read_mock:
+            data_array, _ = read_las_file_to_numpy(self.las_file, features_to_extract=self.features_to_extract, chunk_size=chunk_size)
+        read_mock.assert_not_called()
+        self.assertEqual(sum(chunk_lengths), self.num_points)
+        self.assertLessEqual(max(chunk_lengths), chunk_size)
+        self.assertEqual(len(data_array), self.num_points)
+
+
+class TestIngestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'ingest_cache')
+        self.las_file = os.path.join(self.tmp_dir, 'tile.las')
+        write_synthetic_las(self.las_file, 20000)
+        self.csv_file = os.path.join(self.tmp_dir, 'tile.csv')
+        data_array, feature_names = read_file_to_numpy(self.las_file)
+        pd.DataFrame(data_array, columns=feature_names).to_csv(self.csv_file, index=False, float_format='%.17g')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hit_and_miss(self):
+        for file_path in (self.las_file, self.csv_file):
+            expected, expected_features = read_file_to_numpy(file_path)
+            hits, misses = INGEST_CACHE_STATS['hits'], INGEST_CACHE_STATS['misses']
+            for _ in range(2):
+                data_array, feature_names = read_file_to_numpy(file_path, ingest_cache_dir=self.cache_dir)
+                self.assertEqual(feature_names, expected_features)
+                np.testing.assert_array_equal(data_array, expected)
+            self.assertEqual(INGEST_CACHE_STATS['misses'], misses + 1)
+            self.assertEqual(INGEST_CACHE_STATS['hits'], hits + 1)
+
+        # a different selection of features is a different ingested copy
+        data_array, feature_names = read_file_to_numpy(self.csv_file, features_to_use=['red'], ingest_cache_dir=self.cache_dir)
+        self.assertEqual(feature_names, ['x', 'y', 'z', 'red', 'segment_id', 'label'])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_memory_mapped_columns(self):
+        columns, feature_names = load_or_ingest_columns(self.csv_file, self.cache_dir, reader=read_file_to_numpy, columns=['x', 'label'])
+        self.assertEqual(list(columns), ['x', 'label'])
+        self.assertIsInstance(columns['x'], np.memmap)
+        self.assertFalse(columns['x'].flags.writeable)
+        self.assertEqual(len(columns['label']), 20000)
+        self.assertEqual(extract_num_classes(self.csv_file, ingest_cache_dir=self.cache_dir), extract_num_classes(self.csv_file))
+
+        with self.assertRaises(ValueError):
+            load_or_ingest_columns(self.csv_file, self.cache_dir, reader=read_file_to_numpy, columns=['nir'])
+
+    def test_ingested_array_is_not_copied(self):
+        read_file_to_numpy(self.las_file, ingest_cache_dir=self.cache_dir)
+        data_array, feature_names = read_file_to_numpy(self.las_file, ingest_cache_dir=self.cache_dir)
+        self.assertIsInstance(data_array, np.memmap)
+        self.assertTrue(data_array.flags.f_contiguous)
+
+        # copy-on-write: modifying the array does not modify the ingested copy
+        expected = data_array[:, -1].copy()
+        data_array[:, -1] = -1
+        np.testing.assert_array_equal(read_file_to_numpy(self.las_file, ingest_cache_dir=self.cache_dir)[0][:, -1], expected)
+
+    def test_modified_source_is_ingested_again(self):
+        read_file_to_numpy(self.csv_file, ingest_cache_dir=self.cache_dir)
+        df = pd.read_csv(self.csv_file)
+        df['label'] = 0
+        df.to_csv(self.csv_file, index=False, float_format='%.17g')
+        os.utime(self.csv_file, ns=(os.stat(self.csv_file).st_atime_ns, os.stat(self.csv_file).st_mtime_ns + 10**9))
+
+        data_array, _ = read_file_to_numpy(self.csv_file, ingest_cache_dir=self.cache_dir)
+        self.assertTrue(np.all(data_array[:, -1] == 0))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+
+class TestParquetSupport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(1)
+        num_points = 30000
+        self.df = pd.DataFrame({'x': rng.uniform(0, 100, num_points), 'y': rng.uniform(0, 100, num_points), 'z': rng.uniform(0, 10, num_points),
+                                'intensity': rng.uniform(0, 255, num_points), 'red_b': rng.uniform(0, 255, num_points),
+                                'red_a': rng.uniform(0, 255, num_points), 'segment_id': rng.integers(0, 50, num_points),
+                                'label': np.sort(rng.choice([3, 5, 6, 10], num_points))})
+        self.csv_file = os.path.join(self.tmp_dir, 'data.csv')
+        self.parquet_file = os.path.join(self.tmp_dir, 'data.parquet')
+        self.df.to_csv(self.csv_file, index=False)
+        self.df.to_parquet(self.parquet_file, index=False, row_group_size=5000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_file_to_numpy(self):
+        self.assertEqual(read_table_columns(self.parquet_file), read_table_columns(self.csv_file))
+        parquet_array, parquet_features = read_file_to_numpy(self.parquet_file, features_to_use=['red_b', 'intensity'])
+        csv_array, csv_features = read_file_to_numpy(self.csv_file, features_to_use=['red_b', 'intensity'])
+        self.assertEqual(parquet_features, ['x', 'y', 'z', 'red_b', 'intensity', 'segment_id', 'label'])
+        self.assertEqual(parquet_features, csv_features)
+        np.testing.assert_allclose(parquet_array, csv_array, rtol=1e-12)
+        np.testing.assert_array_equal(parquet_array[:, 3], self.df['red_b'].values)
+
+    def test_label_filter(self):
+        for file_path in (self.csv_file, self.parquet_file):
+            data_array, feature_names = read_csv_file_to_numpy(file_path, features_to_extract=['intensity'], label_filter=[5, 10])
+            expected = self.df[self.df['label'].isin([5, 10])]
+            self.assertEqual(len(data_array), len(expected))
+            np.testing.assert_array_equal(data_array[:, -1], expected['label'].values)
+
+            chunks = list(iter_table_chunks(file_path, chunk_size=4000, columns=['x', 'intensity'], label_filter=[6]))
+            self.assertTrue(all(list(chunk.columns) == ['x', 'intensity'] for chunk in chunks))
+            self.assertEqual(sum(len(chunk) for chunk in chunks), (self.df['label'] == 6).sum())
+
+    def test_combine_filter_and_split(self):
+        combined_file = os.path.join(self.tmp_dir, 'out', 'combined.parquet')
+        clean_and_combine_csv_files([self.csv_file, self.parquet_file], output_csv=combined_file)
+        combined = read_table(combined_file)
+        self.assertEqual(len(combined), 2 * len(self.df))
+
+        filtered_file = os.path.join(self.tmp_dir, 'out', 'filtered.parquet')
+        filter_features_in_csv(combined_file, filtered_file, required_columns=['x', 'y', 'z', 'label'])
+        self.assertEqual(read_table_columns(filtered_file), ['x', 'y', 'z', 'red', 'label'])
+        np.testing.assert_array_equal(read_table(filtered_file, columns=['red'])['red'].values[len(self.df):], self.df['red_b'].values)
+
+        train_df, eval_df = create_train_eval_datasets(combined_file, max_points_per_class=3000, chosen_classes=[3, 6], 
+                                                       output_dataset_folder=os.path.join(self.tmp_dir, 'dataset'), file_format='parquet')
+        self.assertEqual(set(train_df['label']) | set(eval_df['label']), {3, 6})
+        self.assertEqual(len(read_table(os.path.join(self.tmp_dir, 'dataset', 'train_dataset.parquet'))), len(train_df))
+
+    def test_write_table(self):
+        output_file = os.path.join(self.tmp_dir, 'written.parquet')
+        write_table(self.df, output_file)
+        pd.testing.assert_frame_equal(read_table(output_file), self.df)
+        with self.assertRaises(ValueError):
+            write_table(self.df, os.path.join(self.tmp_dir, 'written.txt'))
+
+
+@unittest.skipIf(not laspy.LazBackend.detect_available(), "no LAZ backend installed")
+class TestConcatenateLas(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = [os.path.join(self.tmp_dir, f'tile_686000_4929000_{idx}.las') for idx in range(3)]
+        for idx, file_path in enumerate(self.files):
+            write_synthetic_las(file_path, 30000 + 5000 * idx, seed=idx)
+        # the second file has other offsets, and is compressed
+        las = read_las(self.files[1])
+        las.change_scaling(offsets=[686100.0, 4929100.0, 10.0])
+        self.files[1] = os.path.join(self.tmp_dir, 'tile_686000_4929000_1.laz')
+        write_las(las, self.files[1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_concatenation_keeps_all_dimensions(self):
+        reference = [read_las(file_path) for file_path in self.files]
+        for output_name in ('merged.las', 'merged.laz'):
+            output_file = os.path.join(self.tmp_dir, output_name)
+            num_points = concatenate_las(self.files, output_file, chunk_size=7000)
+            merged = read_las(output_file)
+            self.assertEqual(num_points, sum(len(las.points) for las in reference))
+            self.assertEqual(len(merged.points), num_points)
+            for dimension in merged.point_format.dimension_names:
+                if dimension not in ('X', 'Y', 'Z'):
+                    np.testing.assert_array_equal(merged[dimension], np.concatenate([las[dimension] for las in reference]), err_msg=dimension)
+            np.testing.assert_allclose(merged.x, np.concatenate([las.x for las in reference]), atol=1e-6)
+            np.testing.assert_allclose(merged.header.mins, np.min([las.header.mins for las in reference], axis=0), atol=1e-6)
+
+    def test_filter_and_point_format_conversion(self):
+        # points of another format are converted, with missing dimensions set to zero
+        other_format = os.path.join(self.tmp_dir, 'other.las')
+        source = read_las(self.files[2])
+        las = laspy.LasData(laspy.LasHeader(point_format=2, version="1.2"))
+        las.header.offsets, las.header.scales = source.header.offsets, source.header.scales
+        las.x, las.y, las.z, las.intensity = source.x, source.y, source.z, source.intensity
+        las.write(other_format)
+
+        output_file = os.path.join(self.tmp_dir, 'merged.las')
+        concatenate_las([self.files[0], other_format], output_file, point_filter=lambda points, header: points.x < header.mins[0] + 250)
+        merged, first, second = read_las(output_file), read_las(self.files[0]), read_las(other_format)
+        expected_x = np.concatenate((first.x[first.x < first.x.min() + 250], second.x[second.x < second.x.min() + 250]))
+        np.testing.assert_allclose(merged.x, expected_x, atol=1e-6)
+        num_first = np.sum(first.x < first.x.min() + 250)
+        np.testing.assert_array_equal(merged.label[:num_first], first.label[first.x < first.x.min() + 250])
+        np.testing.assert_array_equal(merged.intensity[num_first:], second.intensity[second.x < second.x.min() + 250])
+        self.assertFalse(np.any(merged.label[num_first:]))
+
+        with self.assertRaises(ValueError):
+            concatenate_las([], output_file)
+        with self.assertRaises(ValueError):
+            concatenate_las(self.files, os.path.join(self.tmp_dir, 'merged.csv'))
+
+    def test_stitch_subtiles(self):
+        original_file = self.files[0]
+        subtile_folder = subtiler(original_file, tile_size=200, overlap_size=20)
+        for file in os.listdir(subtile_folder):     # stand-ins for predicted subtiles
+            os.rename(os.path.join(subtile_folder, file), os.path.join(subtile_folder, file.replace('.las', '_pred.las')))
+
+        output_file = stitch_subtiles(subtile_folder, read_las(original_file), original_file, self.tmp_dir, overlap_size=20)
+        stitched = read_las(output_file)
+        expected = []
+        for file in os.listdir(subtile_folder):
+            subtile = read_las(os.path.join(subtile_folder, file))
+            mask = ((subtile.x < subtile.x.max() - 10) & (subtile.y < subtile.y.max() - 10) & 
+                    (subtile.x > subtile.x.min() + 10) & (subtile.y > subtile.y.min() + 10))
+            expected.append(subtile.segment_id[mask])
+        np.testing.assert_array_equal(np.sort(stitched.segment_id), np.sort(np.concatenate(expected)))
+        self.assertEqual(list(stitched.point_format.dimension_names), list(read_las(original_file).point_format.dimension_names))
+
+
+class TestLazSupport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.las_file = os.path.join(self.tmp_dir, 'tile_686000_4929000_pc.las')
+        self.laz_file = os.path.join(self.tmp_dir, 'tile_686000_4929000_pc.laz')
+        write_synthetic_las(self.las_file, 200000)
+        write_las(read_las(self.las_file), self.laz_file, laz_threads=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_matches_las(self):
+        self.assertLess(os.path.getsize(self.laz_file), os.path.getsize(self.las_file))
+        expected, expected_features = read_file_to_numpy(self.las_file)
+        for laz_threads in (1, 2, None):
+            data_array, feature_names = read_file_to_numpy(self.laz_file, laz_threads=laz_threads)
+            self.assertEqual(feature_names, expected_features)
+            np.testing.assert_array_equal(data_array, expected)
+
+        # streamed reads with early stop, and ingested copies of LAZ files
+        data_array, _ = read_las_file_to_numpy(self.laz_file, chunk_size=70000, max_points=150001)
+        np.testing.assert_array_equal(data_array, expected[:150001])
+        data_array, _ = read_file_to_numpy(self.laz_file, ingest_cache_dir=os.path.join(self.tmp_dir, 'ingest_cache'))
+        np.testing.assert_array_equal(data_array, expected)
+        self.assertEqual(extract_num_classes(self.laz_file), extract_num_classes(self.las_file))
+
+    def test_compressed_subtiles(self):
+        subtile_folder = subtiler(self.laz_file, tile_size=250, overlap_size=10, compress=True, laz_threads=2)
+        subtile_files = sorted(os.listdir(subtile_folder))
+        self.assertEqual(len(subtile_files), 9)
+        self.assertTrue(all(file.endswith('.laz') for file in subtile_files))
+
+        # every point falls in at least one subtile, and points keep their dimensions
+        num_points = sum(len(read_las(os.path.join(subtile_folder, file)).points) for file in subtile_files)
+        self.assertGreaterEqual(num_points, 200000)
+        subtile = read_las(os.path.join(subtile_folder, subtile_files[0]))
+        self.assertEqual(list(subtile.point_format.dimension_names), list(read_las(self.las_file).point_format.dimension_names))
+
+    def test_write_las(self):
+        self.assertIn(laz_backend(1), (laspy.LazBackend.Lazrs, None))
+        with self.assertRaises(ValueError):
+            write_las(read_las(self.las_file), os.path.join(self.tmp_dir, 'tile.txt'))
+        with self.assertRaises(ValueError):
+            laz_backend(0)
+
+        # the thread pool size is set once at startup (see set_laz_threads), never by reads and writes
+        with mock.patch.dict(os.environ, clear=False):
+            os.environ.pop('RAYON_NUM_THREADS', None)
+            laz_backend(4)
+            write_las(read_las(self.las_file, laz_threads=3), os.path.join(self.tmp_dir, 'tile.laz'), laz_threads=2)
+            self.assertNotIn('RAYON_NUM_THREADS', os.environ)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+import torch
+from scripts.materialize_grids import materialize_grids
+from utils.grid_store import GridStoreDataset, grid_store_params, find_grid_store, compute_file_hash
+from utils.train_data_utils import create_point_cloud_dataset, prepare_dataloader
+
+
+class TestGridStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        # synthetic point cloud saved as csv
+        rng = np.random.default_rng(0)
+        num_points = 3000
+        df = pd.DataFrame({
+            'x': rng.uniform(0, 40, num_points),
+            'y': rng.uniform(0, 40, num_points),
+            'z': rng.uniform(0, 5, num_points),
+            'intensity': rng.uniform(0, 255, num_points),
+            'red': rng.uniform(0, 255, num_points),
+            'green': rng.uniform(0, 255, num_points),
+            'label': rng.integers(0, 3, num_points),
+        })
+        self.data_filepath = os.path.join(self.temp_dir, 'full.csv')
+        df.to_csv(self.data_filepath, index=False)
+
+        self.subset_file = os.path.join(self.temp_dir, 'subset.csv')
+        df.sample(200, random_state=0)[['x', 'y', 'z']].to_csv(self.subset_file, index=False)
+
+        self.grid_store_dir = os.path.join(self.temp_dir, 'grid_store')
+        self.window_sizes = [('small', 2.5), ('medium', 5.0), ('large', 10.0)]
+        self.grid_resolution = 32
+        self.features_to_use = ['intensity', 'red', 'green']
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def materialize(self, dtype, mode='features'):
+        return materialize_grids(full_data_filepath=self.data_filepath, grid_store_dir=self.grid_store_dir,
+                                 window_sizes=self.window_sizes, grid_resolution=self.grid_resolution,
+                                 features_to_use=self.features_to_use, subset_file=self.subset_file,
+                                 mode=mode, dtype=dtype, shard_size=50, batch_size=16)
+
+    def test_store_matches_generated_grids(self):
+        store_dir = self.materialize('float32')
+        store = GridStoreDataset(store_dir)
+        dataset = create_point_cloud_dataset(self.data_filepath, self.window_sizes, self.grid_resolution,
+                                             self.features_to_use, subset_file=self.subset_file)
+        self.assertEqual(len(store), len(dataset))
+
+        indices = list(range(0, len(dataset), 7))
+        stored = store[indices]
+        generated = dataset[indices]
+        for stored_item, generated_item in zip(stored, generated):
+            torch.testing.assert_close(stored_item, generated_item)
+
+        # single item access
+        small_grid, medium_grid, large_grid, label, original_idx = store[3]
+        torch.testing.assert_close(large_grid, dataset[3][2])
+        self.assertEqual(original_idx, dataset.original_indices[3])
+
+    def test_float16_store(self):
+        store = GridStoreDataset(self.materialize('float16'))
+        dataset = create_point_cloud_dataset(self.data_filepath, self.window_sizes, self.grid_resolution,
+                                             self.features_to_use, subset_file=self.subset_file)
+        indices = list(range(10))
+        small_stored = store[indices][0]
+        self.assertEqual(small_stored.dtype, torch.float32)
+        torch.testing.assert_close(small_stored, dataset[indices][0], rtol=1e-3, atol=0.2)
+
+    def test_store_lookup(self):
+        params = grid_store_params(self.data_filepath, self.window_sizes, self.grid_resolution, self.features_to_use, subset_file=self.subset_file)
+        self.assertIsNone(find_grid_store(self.grid_store_dir, params))
+
+        store_dir = self.materialize('float32')
+        self.assertEqual(find_grid_store(self.grid_store_dir, params), store_dir)
+
+        # different grid parameters must not match the store
+        other_params = grid_store_params(self.data_filepath, self.window_sizes, 64, self.features_to_use, subset_file=self.subset_file)
+        self.assertIsNone(find_grid_store(self.grid_store_dir, other_params))
+
+        loader, _ = prepare_dataloader(batch_size=16, data_filepath=self.data_filepath, window_sizes=self.window_sizes,
+                                       grid_resolution=self.grid_resolution, features_to_use=self.features_to_use,
+                                       num_workers=0, shuffle_train=False, subset_file=self.subset_file,
+                                       grid_store_dir=self.grid_store_dir)
+        self.assertIsInstance(loader.dataset, GridStoreDataset)
+        small_grids, _, _, labels, _ = next(iter(loader))
+        self.assertEqual(small_grids.shape, (16, len(self.features_to_use), self.grid_resolution, self.grid_resolution))
+
+    def test_store_lookup_does_not_read_source(self):
+        store_dir = self.materialize('float32')
+        with open(os.path.join(store_dir, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['source_hash'], compute_file_hash(self.data_filepath))
+        self.assertEqual(manifest['subset_hash'], compute_file_hash(self.subset_file))
+
+        # the lookup only stats the files
+        with mock.patch('utils.grid_store.compute_file_hash') as hash_mock:
+            params = grid_store_params(self.data_filepath, self.window_sizes, self.grid_resolution, self.features_to_use, subset_file=self.subset_file)
+            self.assertEqual(find_grid_store(self.grid_store_dir, params), store_dir)
+            hash_mock.assert_not_called()
+
+        # a modified subset file no longer matches the store
+        with open(self.subset_file, 'a') as f:
+            f.write('1.0,1.0,1.0\n')
+        params = grid_store_params(self.data_filepath, self.window_sizes, self.grid_resolution, self.features_to_use, subset_file=self.subset_file)
+        self.assertIsNone(find_grid_store(self.grid_store_dir, params))
+
+    def test_store_dtype_follows_precision(self):
+        store_dir = self.materialize('float16')
+        for precision, expected_dir in (('float64', None), ('float32', None), ('float16', store_dir)):
+            params = grid_store_params(self.data_filepath, self.window_sizes, self.grid_resolution, self.features_to_use, subset_file=self.subset_file,
+                                       dtype='float16' if precision == 'float16' else 'float32')
+            self.assertEqual(find_grid_store(self.grid_store_dir, params), expected_dir)
+
+            loader, _ = prepare_dataloader(batch_size=16, data_filepath=self.data_filepath, window_sizes=self.window_sizes,
+                                           grid_resolution=self.grid_resolution, features_to_use=self.features_to_use,
+                                           num_workers=0, shuffle_train=False, subset_file=self.subset_file,
+                                           grid_store_dir=self.grid_store_dir, precision=precision)
+            self.assertEqual(isinstance(loader.dataset, GridStoreDataset), expected_dir is not None)
+
+    def test_index_store_reused_across_features(self):
+        store_dir = self.materialize('float32', mode='indices')
+        self.assertEqual(np.load(os.path.join(store_dir, 'indices_00000.npy')).dtype, np.int32)
+
+        # the same index store serves any feature selection
+        for features_to_use in (['intensity', 'red', 'green'], ['green', 'intensity']):
+            loader, _ = prepare_dataloader(batch_size=16, data_filepath=self.data_filepath, window_sizes=self.window_sizes,
+                                           grid_resolution=self.grid_resolution, features_to_use=features_to_use,
+                                           num_workers=0, shuffle_train=False, subset_file=self.subset_file,
+                                           grid_store_dir=self.grid_store_dir)
+            self.assertIsInstance(loader.dataset, GridStoreDataset)
+            self.assertEqual(loader.dataset.store_dir, store_dir)
+
+            dataset = create_point_cloud_dataset(self.data_filepath, self.window_sizes, self.grid_resolution,
+                                                 features_to_use, subset_file=self.subset_file)
+            stored = next(iter(loader))
+            generated = dataset[list(range(16))]
+            for stored_item, generated_item in zip(stored, generated):
+                torch.testing.assert_close(stored_item, generated_item)
@@ -1,10 +1,15 @@
 import unittest
+from unittest import mock
 import torch
 import numpy as np
 import laspy
-from scripts.inference import predict, predict_subtiles
-from utils.train_data_utils import prepare_dataloader, load_model, load_parameters
-from utils.point_cloud_data_utils import stitch_subtiles, read_file_to_numpy, numpy_to_dataframe, clean_nan_values
+import shutil
+import tempfile
+from scripts.inference import predict, predict_subtiles_in_memory, predict_subtiles_parallel, predict_streaming, save_predictions, run_inference
+from utils.train_data_utils import prepare_dataloader, load_model, load_parameters, PointCloudDataset, create_dataloader
+from utils.point_cloud_data_utils import read_file_to_numpy, numpy_to_dataframe, clean_nan_values, generate_core_halo_indices, generate_subtile_indices
+from utils.las_io import read_las
+from scripts.benchmarks.synthetic import write_synthetic_las, mask_subtile_indices
 from models.mcnn import MultiScaleCNN
 import glob
 import os
@@ -43,10 +48,6 @@ class TestPredictFunction(unittest.TestCase):
         
         print(f'window sizes: {self.window_sizes}\n')
         self.overlap_size = int([value for label, value in self.window_sizes if label == 'large'][0])   # size of the largest window 
-        self.cut_off = self.overlap_size/2
-        
-        self.subtile_test_dir = 'tests/test_inference/two_subtiles/'  # contains two subtile from one of the 'chosen tiles'
-        os.makedirs(self.subtile_test_dir, exist_ok=True)
         
     def test_inspect_data_for_bad_values(self):
         
@@ -68,124 +69,87 @@ class TestPredictFunction(unittest.TestCase):
             print(f"\nFeature '{feature}': NaNs: {nan_count}, Infs: {inf_count}")
         
 
-    def test_predict_subtiles(self):
+    def test_predict_subtiles_in_memory(self):
         """
-        Test the predict_subtiles function for correctness and consistency in label assignment.
+        Test the predict_subtiles_in_memory function for correctness and consistency in label assignment.
         """
+        original_las = read_las(self.original_las_path)
 
-        # Run predict_subtiles on the test subtile directory
-        prediction_folder = predict_subtiles(
-            subtile_folder=self.subtile_test_dir,
+        # Run predict_subtiles_in_memory on the original tile
+        label_array = predict_subtiles_in_memory(
+            las_file=original_las,
             model=self.model,
             device=self.device,
             batch_size=self.batch_size,
             window_sizes=self.window_sizes,
             grid_resolution=self.grid_resolution,
             features_to_use=self.features_to_use,
-            num_workers=self.num_workers
+            num_workers=self.num_workers,
+            overlap_size=self.overlap_size
         )
+        self.assertEqual(len(label_array), len(original_las.x))
 
-        predicted_subtiles = [os.path.join(prediction_folder, f) for f in os.listdir(prediction_folder) if f.endswith('_pred.las')]
-        print(f"Subtiles to predict encountered: {len(predicted_subtiles)}")
-        # predicted_subtiles = [os.path.join(prediction_folder, f) for f in os.listdir(prediction_folder) if f.endswith('.las')]
-
-        for subtile_path in predicted_subtiles:
-
-            labeled_las = laspy.read(subtile_path)
-            # Verify the label field was added and populated
-            self.assertIn('label', labeled_las.point_format.dimension_names, "Label field not added to LAS file header.")
-
-            # Define upper bounds based on tile size (to cut off strips of unlabeled points)
-            cut_off = self.overlap_size/2
+        # Check unprocessed labels (-1): every point is owned by one subtile core
+        unprocessed_labels = np.sum(label_array == -1)
+        total_points = len(label_array)
+        print(f"Unprocessed labels: {unprocessed_labels} / {total_points}")
 
-            min_x = labeled_las.x.min()
-            max_x = labeled_las.x.max()
-            min_y = labeled_las.y.min()
-            max_y = labeled_las.y.max()
-            
-            upper_bound_x = max_x - cut_off    
-            upper_bound_y = max_y - cut_off
-            lower_bound_x = min_x + cut_off
-            lower_bound_y = min_y + cut_off
-
-            mask = (
-            (labeled_las.x < upper_bound_x) &  
-            (labeled_las.y < upper_bound_y ) &  
-            (labeled_las.x > lower_bound_x) &
-            (labeled_las.y > lower_bound_y)
-            )
-
-            subtile_masked = labeled_las.points[mask]   # get the 'inside' of the subtiles, without borders of -1 labels
-
-            label_array = labeled_las.label
-            # Check unprocessed labels (-1) considering borders
-            unprocessed_labels = np.sum(label_array == -1)
-            total_points = len(label_array)
-            print(f"Unprocessed labels with borders: {unprocessed_labels} / {total_points}")
-
-            label_array_no_borders = subtile_masked.label
-            #print(f"Number of points before masking: {len(label_array)}")
-            #print(f"Number of points after masking (inside borders): {len(subtile_masked)}")
-            # Check unprocessed labels without borders  
-            unprocessed_labels_no_borders = np.sum(label_array_no_borders == -1)
-            total_points_no_borders = len(label_array_no_borders)
-            print(f"Unprocessed labels without borders: {unprocessed_labels_no_borders} / {total_points_no_borders}")
+    def test_predict_subtiles_and_save(self):
 
-        
-    def test_predict_subtiles_and_stitching(self):
+        original_las = read_las(self.original_las_path)
 
-        # Run predict_subtiles on the test subtile directory
-        prediction_folder = predict_subtiles(
-            subtile_folder=self.subtile_test_dir,
+        # Run predict_subtiles_in_memory on the original tile
+        label_array = predict_subtiles_in_memory(
+            las_file=original_las,
             model=self.model,
             device=self.device,
             batch_size=self.batch_size,
             window_sizes=self.window_sizes,
             grid_resolution=self.grid_resolution,
             features_to_use=self.features_to_use,
-            num_workers=self.num_workers
+            num_workers=self.num_workers,
+            overlap_size=self.overlap_size
         )
 
-        original_las = laspy.read(self.original_las_path)
         out_dir = 'tests/test_inference/'
-        # stitch predictions back together
-        predicted_filepath = stitch_subtiles(subtile_folder=prediction_folder,
-                        original_las=original_las,
-                        original_filename=self.original_las_path, 
-                        model_directory=out_dir, 
-                        overlap_size=self.overlap_size)
+        os.makedirs(out_dir, exist_ok=True)
+        # save the predictions of the whole tile
+        predicted_filepath = save_predictions(las_file=original_las,
+                                              label_array=label_array,
+                                              original_filename=self.original_las_path,
+                                              model_directory=out_dir)
         
-        # inspect stitched file output and compare it to the original las file
+        # inspect saved file output and compare it to the original las file
         predicted_las = laspy.read(predicted_filepath)
 
-        # Check that the header was correctly updated in predictions to the new number of points
+        # Check that the header was correctly updated in predictions to the number of points
         print("=== Header Checks ===")
         print(f"Original LAS point count: {original_las.header.point_count}")
         print(f"Predicted LAS point count: {predicted_las.header.point_count}")
         assert predicted_las.header.point_count == len(predicted_las.x), "Mismatch between header point count and actual points!"
-        self.assertNotEqual(original_las.header.point_count, predicted_las.header.point_count,
-                        "Point count in the stitched file should differ due to overlap removal.")
+        self.assertEqual(original_las.header.point_count, predicted_las.header.point_count,
+                         "Every point of the original file should be saved with its prediction.")
 
         # Check offsets and scales
         print(f"Original Offsets: {original_las.header.offsets}")
         print(f"Predicted Offsets: {predicted_las.header.offsets}")
         self.assertTrue(np.allclose(original_las.header.offsets, predicted_las.header.offsets, atol=1e-6),
-                    "Offsets in stitched LAS file should be consistent with the original.")
+                    "Offsets in saved LAS file should be consistent with the original.")
 
         print(f"Original Scales: {original_las.header.scales}")
         print(f"Predicted Scales: {predicted_las.header.scales}")
         self.assertTrue(np.allclose(original_las.header.scales, predicted_las.header.scales, atol=1e-9),
-                    "Scales in stitched LAS file should be consistent with the original.")
+                    "Scales in saved LAS file should be consistent with the original.")
         
         # Ensure the label field exists
         self.assertIn('label', predicted_las.point_format.dimension_names, 
-                    "Label field is missing in the stitched LAS file.")
+                    "Label field is missing in the saved LAS file.")
 
-        # check how many -1 labels (unclassified points) are present in stitching
+        # check how many -1 labels (unclassified points) are present
         label_array = predicted_las.label
         total_points = len(label_array)
         unprocessed_labels = np.sum(label_array == -1)
-        print(f"Unprocessed labels without borders: {unprocessed_labels} / {total_points}")
+        print(f"Unprocessed labels: {unprocessed_labels} / {total_points}")
 
 
     '''def test_predict(self):
@@ -276,4 +240,178 @@ class TestInferenceWithDummyModel(unittest.TestCase):
             self.assertEqual(rows[0], ['True Label', 'Predicted Label'], "CSV header is incorrect.")
             self.assertEqual(len(rows) - 1, num_valid_predictions, f"Expected {num_valid_predictions} rows in the CSV, but got {len(rows) - 1}.")
             
-'''
\ No newline at end of file
+'''
+
+
+class GridMeanModel(torch.nn.Module):
+    # deterministic stand-in for a trained model: one logit per scale, the mean of its grid
+    def __init__(self):
+        super().__init__()
+        self.num_predicted = 0
+
+    def forward(self, small_grids, medium_grids, large_grids):
+        self.num_predicted += len(small_grids)
+        return torch.stack([grids.flatten(1).mean(dim=1) for grids in (small_grids, medium_grids, large_grids)], dim=1)
+
+
+class TestCoreHaloSubtiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'tile_686000_4929000_pc.las')
+        write_synthetic_las(self.file_path, 30000)
+        self.window_sizes = [('small', 2.0), ('medium', 5.0), ('large', 10.0)]
+        self.params = dict(device=torch.device('cpu'), batch_size=256, window_sizes=self.window_sizes, 
+                           grid_resolution=8, features_to_use=['intensity', 'red', 'green'], num_workers=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_every_point_owned_once(self):
+        rng = np.random.default_rng(0)
+        # points on core boundaries and outside the tile are owned too
+        x = np.concatenate((686000 + rng.uniform(0, 500, 20000), [686000, 686090, 686499.99, 685990, 686510]))
+        y = np.concatenate((4929000 + rng.uniform(0, 500, 20000), [4929000, 4929270, 4929500, 4929600, 4928000]))
+        owners = np.zeros(len(x), dtype=int)
+        mins, maxs = (686000.0, 4929000.0), (686500.0, 4929500.0)
+        num_halo_points = 0
+        for core_x, core_y, indices, core_mask in generate_core_halo_indices(x, y, mins, maxs, core_size=90, halo_size=5):
+            self.assertTrue(np.all(np.diff(indices) > 0))
+            owners[indices[core_mask]] += 1
+            # halo points are exactly the points within halo_size of the core, owned by other cores
+            in_box = (x >= core_x - 5) & (x < core_x + 95) & (y >= core_y - 5) & (y < core_y + 95)
+            halo = indices[~core_mask]
+            np.testing.assert_array_equal(halo, np.setdiff1d(np.flatnonzero(in_box), indices[core_mask]))
+            num_halo_points += len(halo)
+        np.testing.assert_array_equal(owners, 1)
+        self.assertGreater(num_halo_points, 0)
+
+        with self.assertRaises(ValueError):
+            next(generate_core_halo_indices(x, y, mins, maxs, core_size=0))
+
+    def test_every_point_labeled_once(self):
+        model = GridMeanModel()
+        las_file = read_las(self.file_path)
+        label_array = predict_subtiles_in_memory(las_file, model, tile_size=100, overlap_size=10, **self.params)
+        self.assertTrue(np.all(label_array >= 0))
+        self.assertEqual(model.num_predicted, len(las_file.points))     # one forward pass per point
+
+        predicted = read_las(save_predictions(las_file, label_array, self.file_path, self.tmp_dir, compress=True))
+        self.assertEqual(len(predicted.points), len(las_file.points))
+        np.testing.assert_array_equal(predicted.segment_id, las_file.segment_id)
+        np.testing.assert_array_equal(predicted.label, label_array)
+
+    def test_core_predictions_match_subtile_files(self):
+        # an interior core with its halo, read from the file on its own, gets the same labels as in memory
+        model = GridMeanModel()
+        las_file = read_las(self.file_path)
+        label_array = predict_subtiles_in_memory(las_file, model, tile_size=100, overlap_size=10, **self.params)
+
+        _, _, indices, core_mask = [subtile for subtile in generate_core_halo_indices(las_file.x, las_file.y, las_file.header.mins, las_file.header.maxs, core_size=90, halo_size=5)
+                                    if subtile[:2] == (686180, 4929180)][0]
+        data_array, known_features = read_file_to_numpy(self.file_path)
+        dataset = PointCloudDataset(data_array[indices], self.window_sizes, 8, ['intensity', 'red', 'green'], known_features, 
+                                    selected_indices=np.flatnonzero(core_mask))
+        loader = create_dataloader(dataset, batch_size=256)
+        subtile_labels = np.full(len(indices), -1, dtype=np.int8)
+        run_inference(model, loader, torch.device('cpu'), subtile_labels)
+        np.testing.assert_array_equal(subtile_labels[core_mask], label_array[indices[core_mask]])
+        self.assertTrue(np.all(subtile_labels[~core_mask] == -1))   # halo points are not predicted
+
+
+
+class TestStreamingInference(unittest.TestCase):
+
+    setUp = TestCoreHaloSubtiling.setUp
+    tearDown = TestCoreHaloSubtiling.tearDown
+
+    def test_every_point_labeled_once(self):
+        model = GridMeanModel()
+        las_file = read_las(self.file_path)
+        label_array = predict_streaming(las_file, model, **self.params)
+        self.assertTrue(np.all(label_array >= 0))
+        self.assertEqual(model.num_predicted, len(las_file.points))
+
+        # a single subtile covering the whole tile (without halo) is the same dataset: same labels
+        subtile_labels = predict_subtiles_in_memory(las_file, GridMeanModel(), tile_size=600, overlap_size=10, **self.params)
+        np.testing.assert_array_equal(label_array, subtile_labels)
+
+    def test_small_files_are_predicted(self):
+        # files under min_points are predicted in every mode, through the streaming path
+        model_path = os.path.join(self.tmp_dir, 'model', 'model.pth')
+        os.makedirs(os.path.dirname(model_path))
+        for inference_mode in ('streaming', 'subtiles', 'parallel_subtiles'):
+            predict(self.file_path, GridMeanModel(), model_path, min_points=1000000, tile_size=100, 
+                    inference_mode=inference_mode, **self.params)
+            predicted_files = glob.glob(os.path.join(self.tmp_dir, 'model', '**', '*_pred*.laz'), recursive=True)
+            self.assertEqual(len(predicted_files), 1)
+            predicted = read_las(predicted_files[0])
+            self.assertEqual(len(predicted.points), 30000)
+            self.assertTrue(np.all(predicted.label >= 0))
+            os.remove(predicted_files[0])
+
+        with self.assertRaises(ValueError):
+            predict(self.file_path, GridMeanModel(), model_path, inference_mode='tiles', **self.params)
+
+
+
+class FailingModel(torch.nn.Module):
+    def forward(self, small_grids, medium_grids, large_grids):
+        raise RuntimeError("model failure")
+
+
+class TestParallelSubtiles(unittest.TestCase):
+
+    setUp = TestCoreHaloSubtiling.setUp
+    tearDown = TestCoreHaloSubtiling.tearDown
+
+    def test_matches_sequential_subtiles(self):
+        las_file = read_las(self.file_path)
+        params = dict(self.params)
+        params.pop('num_workers')
+        sequential = predict_subtiles_in_memory(las_file, GridMeanModel(), tile_size=100, overlap_size=10, **self.params)
+        for num_processes in (1, 3):
+            parallel = predict_subtiles_parallel(las_file, GridMeanModel(), tile_size=100, overlap_size=10, num_processes=num_processes, **params)
+            np.testing.assert_array_equal(parallel, sequential)
+
+    def test_worker_errors(self):
+        las_file = read_las(self.file_path)
+        params = dict(self.params)
+        params.pop('num_workers')
+        with self.assertRaises(RuntimeError):
+            predict_subtiles_parallel(las_file, FailingModel(), tile_size=100, overlap_size=10, num_processes=2, **params)
+        with self.assertRaises(ValueError):
+            predict_subtiles_parallel(las_file, GridMeanModel(), num_processes=0, **params)
+
+    def test_cpu_only(self):
+        # workers are forked: a CUDA device is refused before any worker is started
+        las_file = read_las(self.file_path)
+        params = dict(self.params)
+        params.pop('num_workers')
+        params['device'] = torch.device('cuda:0')
+        with mock.patch('scripts.inference.mp.get_context') as get_context:
+            with self.assertRaises(ValueError):
+                predict_subtiles_parallel(las_file, GridMeanModel(), tile_size=100, overlap_size=10, num_processes=2, **params)
+            get_context.assert_not_called()
+        with self.assertRaises(ValueError):
+            predict(self.file_path, GridMeanModel(), os.path.join(self.tmp_dir, 'model.pth'), num_workers=0, min_points=0, 
+                    inference_mode='parallel_subtiles', **params)
+
+
+class TestSubtileBucketing(unittest.TestCase):
+
+    def test_matches_masks(self):
+        rng = np.random.default_rng(0)
+        x = 686000 + rng.uniform(0, 500, 100000)
+        y = 4929000 + rng.uniform(0, 500, 100000)
+        x[:3], y[:3] = [686000, 686115, 686230], [4929000, 4929125, 4929345]     # points on subtile bounds
+        mins, maxs = (686000.0, 4929000.0), (686499.0, 4929499.0)     # bounds of a 500 m tile
+        for tile_size, overlap_size in ((125, 10), (50, 30), (200, 20), (600, 10)):
+            bucketed = list(generate_subtile_indices(x, y, mins, maxs, tile_size, overlap_size))
+            masked = list(mask_subtile_indices(x, y, 686000, 4929000, tile_size, overlap_size, 500))
+            self.assertEqual([subtile[:2] for subtile in bucketed], [subtile[:2] for subtile in masked])
+            for (_, _, bucketed_indices), (_, _, masked_indices) in zip(bucketed, masked):
+                np.testing.assert_array_equal(bucketed_indices, masked_indices)
+
+        with self.assertRaises(ValueError):
+            next(generate_subtile_indices(x, y, mins, maxs, 10, 10))
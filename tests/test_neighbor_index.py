@@ -0,0 +1,107 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from scipy.spatial import cKDTree
+from utils.neighbor_index import build_neighbor_index, load_or_build_neighbor_index, neighbor_index_cache_key, KDTreeIndex, VoxelHashIndex, NEIGHBOR_INDEX_CACHE_STATS
+from scripts.point_cloud_to_image import compute_neighbor_index_grids
+
+
+class TestNeighborIndexParity(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def assert_parity(self, points, queries, distance_upper_bound=np.inf, **kwargs):
+        expected_distances, expected_indices = cKDTree(points).query(queries, distance_upper_bound=distance_upper_bound)
+        for backend in ('kdtree', 'voxel_hash'):
+            index = build_neighbor_index(points, backend=backend, **(kwargs if backend == 'voxel_hash' else {}))
+            self.assertEqual(index.n, len(points))
+            distances, indices = index.query(queries, distance_upper_bound=distance_upper_bound)
+            np.testing.assert_allclose(distances, expected_distances, rtol=1e-12, atol=1e-12)
+            np.testing.assert_array_equal(indices, expected_indices)
+
+    def test_uniform_cloud(self):
+        points = np.column_stack((self.rng.uniform(0, 50, 20000), self.rng.uniform(0, 50, 20000), self.rng.uniform(0, 5, 20000)))
+        queries = np.column_stack((self.rng.uniform(0, 50, 5000), self.rng.uniform(0, 50, 5000), self.rng.uniform(0, 5, 5000)))
+        self.assert_parity(points, queries)
+
+    def test_clustered_cloud(self):
+        centers = self.rng.uniform(0, 100, (20, 3))
+        points = np.concatenate([center + self.rng.normal(0, 0.5, (1000, 3)) for center in centers])
+        queries = self.rng.uniform(-10, 110, (5000, 3))
+        self.assert_parity(points, queries)
+
+    def test_flat_cloud_and_outside_queries(self):
+        points = np.column_stack((self.rng.uniform(0, 20, 5000), self.rng.uniform(0, 20, 5000), np.zeros(5000)))
+        queries = np.column_stack((self.rng.uniform(-30, 50, 2000), self.rng.uniform(-30, 50, 2000), self.rng.uniform(-5, 5, 2000)))
+        self.assert_parity(points, queries)
+
+    def test_explicit_cell_size(self):
+        points = self.rng.uniform(0, 10, (3000, 3))
+        queries = self.rng.uniform(0, 10, (1000, 3))
+        for cell_size in (0.05, 0.5, 5.0):
+            self.assert_parity(points, queries, cell_size=cell_size)
+
+    def test_distance_upper_bound(self):
+        points = self.rng.uniform(0, 10, (3000, 3))
+        queries = np.concatenate((points[:500] + 1e-10, self.rng.uniform(0, 10, (500, 3))))
+        self.assert_parity(points, queries, distance_upper_bound=1e-8)
+
+    def test_grid_queries(self):
+        points = np.column_stack((self.rng.uniform(0, 30, 20000), self.rng.uniform(0, 30, 20000), self.rng.uniform(0, 3, 20000)))
+        center_points = points[:16]
+        window_sizes = [('small', 2.5), ('medium', 5.0), ('large', 10.0)]
+        expected = compute_neighbor_index_grids(center_points, window_sizes, 32, KDTreeIndex(points))
+        index_grids = compute_neighbor_index_grids(center_points, window_sizes, 32, VoxelHashIndex(points))
+        np.testing.assert_array_equal(index_grids, expected)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            build_neighbor_index(np.zeros((10, 3)), backend='octree')
+
+
+class TestNeighborIndexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.points = rng.uniform(0, 50, (20000, 3))
+        self.queries = rng.uniform(0, 50, (2000, 3))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache_hit_and_miss(self):
+        for backend in ('kdtree', 'voxel_hash'):
+            hits, misses = NEIGHBOR_INDEX_CACHE_STATS['hits'], NEIGHBOR_INDEX_CACHE_STATS['misses']
+            built = load_or_build_neighbor_index(self.points, backend=backend, cache_dir=self.cache_dir)
+            loaded = load_or_build_neighbor_index(self.points.copy(), backend=backend, cache_dir=self.cache_dir)
+            self.assertEqual(NEIGHBOR_INDEX_CACHE_STATS['misses'], misses + 1)
+            self.assertEqual(NEIGHBOR_INDEX_CACHE_STATS['hits'], hits + 1)
+
+            self.assertIsInstance(loaded, type(built))
+            for built_result, loaded_result in zip(built.query(self.queries), loaded.query(self.queries)):
+                np.testing.assert_array_equal(built_result, loaded_result)
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_cached_kdtree_is_memory_mapped(self):
+        load_or_build_neighbor_index(self.points, cache_dir=self.cache_dir)
+        loaded = load_or_build_neighbor_index(self.points, cache_dir=self.cache_dir)
+        self.assertFalse(loaded.tree.data.flags.writeable)
+
+    def test_cache_key(self):
+        key = neighbor_index_cache_key(self.points)
+        self.assertEqual(key, neighbor_index_cache_key(self.points.copy()))
+        self.assertNotEqual(key, neighbor_index_cache_key(self.points, leafsize=32))
+        self.assertNotEqual(key, neighbor_index_cache_key(self.points, backend='voxel_hash'))
+
+        moved_points = self.points.copy()
+        moved_points[0, 0] += 1e-6
+        self.assertNotEqual(key, neighbor_index_cache_key(moved_points))
+
+
+if __name__ == '__main__':
+    unittest.main()
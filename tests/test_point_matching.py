@@ -0,0 +1,133 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from utils.point_matching import PointKeyIndex
+from utils.point_cloud_data_utils import apply_masks_KDTree, apply_precision_policy, reservoir_sample_with_subset, reservoir_sample_data, sample_data, save_subset_indices, load_subset_indices
+from utils.create_dataset import create_train_eval_datasets
+from utils.train_data_utils import PointCloudDataset
+from scripts.benchmarks.synthetic import synthetic_las_coordinates
+
+
+class TestPointKeyIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.points = synthetic_las_coordinates(200000, self.rng)
+
+    def test_matches_exact_neighbor_query(self):
+        subset = self.points[self.rng.choice(len(self.points), 30000, replace=False)]
+        queries = np.concatenate((self.points, synthetic_las_coordinates(50000, self.rng), subset + 0.01))
+        distances, _ = cKDTree(subset).query(queries, distance_upper_bound=1e-8)
+
+        index = PointKeyIndex(subset)
+        np.testing.assert_array_equal(index.contains(queries), distances <= 1e-8)
+
+        # matched indices point to identical coordinates
+        indices = index.lookup(queries)
+        found = indices < index.n
+        np.testing.assert_array_equal(subset[indices[found]], queries[found])
+
+    def test_outside_queries_and_duplicates(self):
+        index = PointKeyIndex(np.concatenate((self.points[:10], self.points[:10])), chunk_size=7)
+        self.assertTrue(np.all(index.contains(self.points[:10])))
+        self.assertFalse(np.any(index.contains(self.points[:10] + 1000.0)))
+        self.assertFalse(np.any(index.contains(self.points[:10] - 1000.0)))
+        self.assertFalse(np.any(PointKeyIndex(np.empty((0, 3))).contains(self.points[:10])))
+
+    def test_float32_shifted_coordinates(self):
+        data_array, origin = apply_precision_policy(self.points, precision='float32')
+        subset = (self.points[:5000] - origin).astype(np.float32)
+        np.testing.assert_array_equal(PointKeyIndex(subset).contains(data_array), PointKeyIndex(self.points[:5000]).contains(self.points))
+
+    def test_invalid_scale(self):
+        with self.assertRaises(ValueError):
+            PointKeyIndex(self.points, scale=0.0)
+        with self.assertRaises(ValueError):
+            PointKeyIndex(self.points * 1e6, scale=1e-9)
+
+
+class TestSubsetMatching(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(1)
+        coordinates = synthetic_las_coordinates(100000, rng)
+        self.full_data_array = np.column_stack((coordinates, rng.uniform(0, 255, len(coordinates)), rng.integers(0, 5, len(coordinates))))
+        self.columns = ['x', 'y', 'z', 'intensity', 'label']
+        self.subset_file = os.path.join(self.tmp_dir, 'subset.csv')
+        self.full_file = os.path.join(self.tmp_dir, 'full.csv')
+        pd.DataFrame(self.full_data_array[rng.choice(100000, 20000, replace=False)], columns=self.columns).to_csv(self.subset_file, index=False)
+        pd.DataFrame(self.full_data_array, columns=self.columns).to_csv(self.full_file, index=False)
+        self.window_sizes = [('small', 2.5), ('medium', 5.0), ('large', 10.0)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_key_and_neighbor_index_matching(self):
+        key_array, key_mask, _ = apply_masks_KDTree(self.full_data_array, self.window_sizes, subset_file=self.subset_file)
+        tree_array, tree_mask, _ = apply_masks_KDTree(self.full_data_array, self.window_sizes, subset_file=self.subset_file, subset_matching='neighbor_index')
+        np.testing.assert_array_equal(key_mask, tree_mask)
+        np.testing.assert_array_equal(key_array, tree_array)
+
+        with self.assertRaises(ValueError):
+            apply_masks_KDTree(self.full_data_array, self.window_sizes, subset_file=self.subset_file, subset_matching='octree')
+
+    def test_reservoir_sample_excludes_subset(self):
+        sampled = reservoir_sample_with_subset(self.full_file, sample_size=30000, subset_file=self.subset_file, feature_to_use=self.columns)
+        self.assertEqual(len(sampled), 30000)
+        # no subset point is sampled twice
+        self.assertEqual(len(sampled.drop_duplicates(subset=['x', 'y', 'z'])), len(sampled))
+
+
+class TestSubsetIndexFiles(unittest.TestCase):
+
+    setUp = TestSubsetMatching.setUp
+    tearDown = TestSubsetMatching.tearDown
+
+    def test_split_index_files(self):
+        dataset_folder = os.path.join(self.tmp_dir, 'dataset')
+        train_df, eval_df = create_train_eval_datasets(self.full_file, max_points_per_class=5000, chosen_classes=[1, 3, 4], output_dataset_folder=dataset_folder)
+        for split_df, split in ((train_df, 'train'), (eval_df, 'eval')):
+            row_indices = load_subset_indices(os.path.join(dataset_folder, f'{split}_indices.npy'), num_points=len(self.full_data_array))
+            self.assertEqual(row_indices.dtype, np.int64)
+            np.testing.assert_array_equal(self.full_data_array[np.sort(split_df.index.values)], self.full_data_array[row_indices])
+
+            # row indices select the same points as the coordinates of the split file, without matching
+            _, index_mask, _ = apply_masks_KDTree(self.full_data_array, self.window_sizes, subset_file=os.path.join(dataset_folder, f'{split}_indices.npy'))
+            _, key_mask, _ = apply_masks_KDTree(self.full_data_array, self.window_sizes, subset_file=os.path.join(dataset_folder, f'{split}_dataset.csv'))
+            np.testing.assert_array_equal(index_mask, key_mask)
+
+        dataset = PointCloudDataset(self.full_data_array, self.window_sizes, 32, ['intensity'], self.columns, subset_file=os.path.join(dataset_folder, 'eval_indices.npy'))
+        np.testing.assert_array_equal(dataset.original_indices, np.flatnonzero(index_mask))
+
+    def test_sampler_index_files(self):
+        save_dir = os.path.join(self.tmp_dir, 'sampled')
+        full_df = pd.read_csv(self.full_file)
+        for sampled in (reservoir_sample_data(self.full_file, sample_size=3000, save=True, save_dir=save_dir, feature_to_use=self.columns),
+                        reservoir_sample_with_subset(self.full_file, sample_size=25000, subset_file=self.subset_file, save=True, save_dir=save_dir, feature_to_use=self.columns)):
+            row_indices = np.load(os.path.join(save_dir, f'sampled_indices_{len(sampled)}.npy'))
+            self.assertEqual(len(row_indices), len(sampled))
+            pd.testing.assert_frame_equal(full_df.iloc[row_indices].sort_values(['x', 'y', 'z']).reset_index(drop=True),
+                                          sampled.sort_values(['x', 'y', 'z']).reset_index(drop=True), check_dtype=False)
+
+        sampled = sample_data(self.full_file, sample_size=2000, save=True, save_dir=save_dir)
+        np.testing.assert_allclose(np.sort(self.full_data_array[np.load(os.path.join(save_dir, 'sampled_indices_2000.npy'))], axis=0), np.sort(sampled, axis=0), rtol=1e-12)
+
+    def test_invalid_index_files(self):
+        index_file = save_subset_indices([5, 1, 3], os.path.join(self.tmp_dir, 'indices.npy'))
+        np.testing.assert_array_equal(load_subset_indices(index_file), [1, 3, 5])
+        with self.assertRaises(ValueError):
+            load_subset_indices(index_file, num_points=4)
+        np.save(os.path.join(self.tmp_dir, 'points.npy'), self.full_data_array[:10])
+        with self.assertRaises(ValueError):
+            load_subset_indices(os.path.join(self.tmp_dir, 'points.npy'))
+        with self.assertRaises(ValueError):
+            save_subset_indices([1, 2], os.path.join(self.tmp_dir, 'indices.csv'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from utils.sampling import RandomKeyReservoir, hash_to_unit_interval
+from utils.point_cloud_data_utils import reservoir_sample_data
+from utils.table_io import read_table, iter_table_chunks, write_table
+from utils.create_dataset import create_train_eval_datasets
+
+
+class TestRandomKeyReservoir(unittest.TestCase):
+
+    def stream(self, reservoir, num_rows, chunk_size):
+        for start in range(0, num_rows, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, num_rows))
+            reservoir.add(pd.DataFrame({'value': rows * 10}), rows)
+        return reservoir.sample()
+
+    def test_sample_is_consistent(self):
+        for capacity, chunk_size in ((100, 7), (100, 1000), (1, 50), (5000, 333)):
+            rows, row_indices = self.stream(RandomKeyReservoir(capacity, rng=np.random.default_rng(0)), 3000, chunk_size)
+            self.assertEqual(len(rows), min(capacity, 3000))
+            self.assertEqual(len(np.unique(row_indices)), len(row_indices))
+            self.assertTrue(np.all(np.diff(row_indices) > 0))      # order of the stream
+            np.testing.assert_array_equal(rows['value'].values, row_indices * 10)
+
+        rows, row_indices = RandomKeyReservoir(10).sample()
+        self.assertIsNone(rows)
+        self.assertEqual(len(row_indices), 0)
+
+    def test_seed(self):
+        first = self.stream(RandomKeyReservoir(50, rng=np.random.default_rng(7)), 10000, 999)[1]
+        second = self.stream(RandomKeyReservoir(50, rng=np.random.default_rng(7)), 10000, 999)[1]
+        third = self.stream(RandomKeyReservoir(50, rng=np.random.default_rng(8)), 10000, 999)[1]
+        np.testing.assert_array_equal(first, second)
+        self.assertFalse(np.array_equal(first, third))
+
+    def test_uniform_inclusion(self):
+        # every row is sampled with probability capacity / num_rows, whatever its position in the stream and chunk size
+        num_rows, capacity, num_trials = 200, 40, 1500
+        counts = np.zeros(num_rows)
+        rng = np.random.default_rng(0)
+        for trial in range(num_trials):
+            _, row_indices = self.stream(RandomKeyReservoir(capacity, rng=rng), num_rows, chunk_size=[13, 64, 200][trial % 3])
+            counts[row_indices] += 1
+
+        expected = num_trials * capacity / num_rows
+        chi_square = np.sum((counts - expected) ** 2 / expected)
+        self.assertLess(chi_square, 280)    # ~ 99.9th percentile of a chi-square with 199 degrees of freedom
+        self.assertLess(abs(counts[:100].sum() - counts[100:].sum()) / counts.sum(), 0.02)
+
+    def test_invalid_capacity(self):
+        with self.assertRaises(ValueError):
+            RandomKeyReservoir(-1)
+
+
+class TestReservoirSampleData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sample_of_csv_file(self):
+        rng = np.random.default_rng(0)
+        input_file = os.path.join(self.tmp_dir, 'data.csv')
+        df = pd.DataFrame({'x': rng.uniform(0, 500, 20000), 'y': rng.uniform(0, 500, 20000), 'label': rng.integers(0, 6, 20000)})
+        df.to_csv(input_file, index=False)
+        df = pd.read_csv(input_file)
+
+        sample = reservoir_sample_data(input_file, 2000, chunk_size=3000, seed=0)
+        self.assertEqual(len(sample), 2000)
+        self.assertEqual(len(sample.drop_duplicates()), 2000)
+        self.assertEqual(len(sample.merge(df, on=['x', 'y', 'label'])), 2000)     # rows of the file
+        pd.testing.assert_frame_equal(sample, reservoir_sample_data(input_file, 2000, chunk_size=3000, seed=0))
+
+
+class TestStreamingSplit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(2)
+        num_rows = 60000
+        self.df = pd.DataFrame({'x': rng.uniform(0, 500, num_rows), 'y': rng.uniform(0, 500, num_rows), 'z': rng.uniform(0, 50, num_rows),
+                                'label': rng.choice([0, 1, 2, 5], num_rows, p=[0.6, 0.3, 0.07, 0.03])})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hash_to_unit_interval(self):
+        values = np.arange(1000000)
+        numbers = hash_to_unit_interval(values, seed=3)
+        self.assertTrue(np.all((numbers >= 0) & (numbers < 1)))
+        self.assertAlmostEqual(np.mean(numbers < 0.8), 0.8, delta=0.002)
+        # numbers only depend on the value and the seed
+        np.testing.assert_array_equal(hash_to_unit_interval(values[::-1][:1000], seed=3), numbers[::-1][:1000])
+        self.assertFalse(np.array_equal(hash_to_unit_interval(values[:1000], seed=4), numbers[:1000]))
+
+    def test_chunks_with_row_indices(self):
+        for file_format in ('csv', 'parquet'):
+            input_file = os.path.join(self.tmp_dir, f'data.{file_format}')
+            write_table(self.df, input_file)
+            chunks = list(iter_table_chunks(input_file, chunk_size=7000, label_filter=[2, 5], with_row_indices=True))
+            row_indices = np.concatenate([rows for _, rows in chunks])
+            np.testing.assert_array_equal(row_indices, np.flatnonzero(self.df['label'].isin([2, 5])))
+            filtered = pd.concat([chunk for chunk, _ in chunks], ignore_index=True)
+            pd.testing.assert_frame_equal(filtered, read_table(input_file, label_filter=[2, 5]).reset_index(drop=True), check_dtype=False)
+
+    def test_rebalanced_split(self):
+        max_points_per_class = 5000
+        for file_format in ('csv', 'parquet'):
+            input_file = os.path.join(self.tmp_dir, f'data.{file_format}')
+            write_table(self.df, input_file)
+            output_folder = os.path.join(self.tmp_dir, file_format)
+            train_df, eval_df = create_train_eval_datasets(input_file, max_points_per_class, chosen_classes=[0, 1, 5], train_split=0.7,
+                                                           output_dataset_folder=output_folder, file_format=file_format, chunk_size=4000)
+
+            # each chosen class is capped, and smaller classes are kept whole
+            counts = pd.concat((train_df, eval_df))['label'].value_counts()
+            self.assertEqual(sorted(counts.index), [0, 1, 5])
+            self.assertEqual(counts[0], max_points_per_class)
+            self.assertEqual(counts[1], max_points_per_class)
+            self.assertEqual(counts[5], np.sum(self.df['label'] == 5))
+            self.assertAlmostEqual(len(train_df) / (len(train_df) + len(eval_df)), 0.7, delta=0.02)
+
+            # splits are disjoint, match the input rows and the written files
+            self.assertEqual(len(np.intersect1d(train_df.index, eval_df.index)), 0)
+            for split_df, split in ((train_df, 'train'), (eval_df, 'eval')):
+                pd.testing.assert_frame_equal(split_df, self.df.loc[split_df.index], check_dtype=False)
+                written = read_table(os.path.join(output_folder, f'{split}_dataset.{file_format}'))
+                np.testing.assert_allclose(written.values, split_df.values, rtol=1e-12)
+
+        # same seed, same split
+        train_again, _ = create_train_eval_datasets(input_file, max_points_per_class, chosen_classes=[0, 1, 5], train_split=0.7,
+                                                    output_dataset_folder=output_folder, file_format=file_format, chunk_size=9000)
+        np.testing.assert_array_equal(np.sort(train_again.index.values), np.sort(train_df.index.values))
+
+    def test_no_data(self):
+        input_file = os.path.join(self.tmp_dir, 'data.csv')
+        write_table(self.df, input_file)
+        with self.assertRaises(ValueError):
+            create_train_eval_datasets(input_file, 100, chosen_classes=[9], output_dataset_folder=os.path.join(self.tmp_dir, 'out'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,11 @@
 import unittest
 from unittest import mock
 from torch.utils.data import DataLoader
-from utils.point_cloud_data_utils import read_file_to_numpy, remap_labels, clean_nan_values, compute_point_cloud_bounds
+from utils.point_cloud_data_utils import read_file_to_numpy, remap_labels, clean_nan_values, compute_point_cloud_bounds, compute_morton_codes, apply_precision_policy
 from models.mcnn import MultiScaleCNN
 from scipy.spatial import cKDTree
-from utils.train_data_utils import PointCloudDataset, prepare_dataloader, save_model, load_model, load_parameters, save_used_parameters
+from utils.train_data_utils import PointCloudDataset, DataSource, MortonBlockSampler, prepare_dataloader, create_dataloader, create_point_cloud_dataset, save_model, load_model, load_parameters, save_used_parameters
+from scripts.point_cloud_to_image import gather_grids_from_neighbor_indices, create_multiscale_grid_coords, build_raster_pyramid, compute_neighbor_index_grids_from_rasters, build_feature_matrix
 import torch
 import numpy as np
 from tqdm import tqdm
@@ -12,6 +13,10 @@ import os
 import shutil
 import pandas as pd
 import time
+import tempfile
+import multiprocessing
+from torch.utils.data import Subset
+import utils.train_data_utils as train_data_utils
 
 '''
 class TestSaveLoadModel(unittest.TestCase):
@@ -520,6 +525,320 @@ class TestPrepareDataloader(unittest.TestCase):
         
         
 
+class TestBatchedGridGeneration(unittest.TestCase):
+
+    def setUp(self):
+        # synthetic point cloud: x, y, z, 4 features and a label
+        rng = np.random.default_rng(42)
+        num_points = 5000
+        coords = np.column_stack((rng.uniform(0, 50, num_points), rng.uniform(0, 50, num_points), rng.uniform(0, 5, num_points)))
+        features = rng.uniform(0, 255, (num_points, 4))
+        labels = rng.integers(0, 3, num_points)
+        self.full_data_array = np.column_stack((coords, features, labels)).astype(np.float64)
+        self.known_features = ['x', 'y', 'z', 'intensity', 'red', 'green', 'blue', 'label']
+        self.features_to_use = ['intensity', 'red', 'green', 'blue']
+        self.window_sizes = [('small', 2.5), ('medium', 5.0), ('large', 10.0)]
+        self.grid_resolution = 128
+        self.batch_size = 8
+
+        self.dataset = PointCloudDataset(
+            full_data_array=self.full_data_array,
+            window_sizes=self.window_sizes,
+            grid_resolution=self.grid_resolution,
+            features_to_use=self.features_to_use,
+            known_features=self.known_features,
+            subset_file=None
+        )
+
+    def test_batch_matches_single_points(self):
+        indices = list(range(self.batch_size))
+        small_grids, medium_grids, large_grids, labels, original_indices = self.dataset[indices]
+
+        self.assertEqual(small_grids.shape, (self.batch_size, len(self.features_to_use), self.grid_resolution, self.grid_resolution))
+        self.assertEqual(small_grids.dtype, torch.float32)
+
+        for i, idx in enumerate(indices):
+            small_grid, medium_grid, large_grid, label, original_idx = self.dataset[idx]
+            torch.testing.assert_close(small_grids[i], small_grid)
+            torch.testing.assert_close(medium_grids[i], medium_grid)
+            torch.testing.assert_close(large_grids[i], large_grid)
+            self.assertEqual(labels[i].item(), label.item())
+            self.assertEqual(original_indices[i].item(), original_idx)
+
+    def test_batched_dataloader(self):
+        loader = create_dataloader(self.dataset, batch_size=self.batch_size, shuffle=True, num_workers=0, batched_grids=True)
+        self.assertEqual(len(loader), int(np.ceil(len(self.dataset) / self.batch_size)))
+
+        small_grids, medium_grids, large_grids, labels, indices = next(iter(loader))
+        self.assertEqual(small_grids.shape, (self.batch_size, len(self.features_to_use), self.grid_resolution, self.grid_resolution))
+        self.assertEqual(large_grids.shape, medium_grids.shape)
+        self.assertEqual(len(labels), self.batch_size)
+        self.assertEqual(len(indices), self.batch_size)
+
+    def test_feature_matrix_gather(self):
+        self.assertTrue(self.dataset.feature_matrix.flags['C_CONTIGUOUS'])
+        self.assertEqual(self.dataset.feature_matrix.shape, (len(self.full_data_array), len(self.features_to_use)))
+
+        index_grids = self.dataset.get_neighbor_index_batch(np.arange(self.batch_size))
+        out = np.empty(index_grids.shape + (len(self.features_to_use),), dtype=np.float32)
+        grids = gather_grids_from_neighbor_indices(index_grids, self.dataset.feature_matrix, out=out)
+        self.assertTrue(np.shares_memory(grids, out))
+
+        # same values as gathering full rows and then selecting the channels
+        expected = self.full_data_array[index_grids.ravel(), :][:, self.dataset.feature_indices]
+        expected = np.transpose(expected.reshape(out.shape), (0, 1, 4, 2, 3)).astype(np.float32)
+        np.testing.assert_array_equal(grids, expected)
+
+    def test_approximate_grids(self):
+        grid_resolution = 32
+        raster_pyramid = build_raster_pyramid(self.full_data_array, self.window_sizes, grid_resolution)
+        center_points = self.full_data_array[:self.batch_size, :3]
+        index_grids = compute_neighbor_index_grids_from_rasters(center_points, raster_pyramid, grid_resolution)
+        self.assertEqual(index_grids.shape, (self.batch_size, len(self.window_sizes), grid_resolution, grid_resolution))
+
+        # each cell holds the nearest point of a location at most half a cell away (along x and y) from the exact cell center,
+        # so, by the triangle inequality, it is at most twice that offset farther than the exact nearest point
+        grid_coords = create_multiscale_grid_coords(center_points, self.window_sizes, grid_resolution)[..., :2]
+        exact_distances, _ = cKDTree(self.full_data_array[:, :2]).query(grid_coords.reshape(-1, 2))
+        assigned_points = self.full_data_array[index_grids.ravel(), :2]
+        approx_distances = np.linalg.norm(assigned_points - grid_coords.reshape(-1, 2), axis=1)
+        max_errors = np.repeat(raster_pyramid['cell_sizes'], grid_resolution**2)[None, :].repeat(self.batch_size, axis=0).ravel() * np.sqrt(2) / 2
+        self.assertTrue(np.all(approx_distances <= exact_distances + 2 * max_errors + 1e-9))
+
+        # the approximate dataset serves batches of the same shape
+        approx_dataset = PointCloudDataset(full_data_array=self.full_data_array, window_sizes=self.window_sizes, grid_resolution=grid_resolution,
+                                           features_to_use=self.features_to_use, known_features=self.known_features, approximate_grids=True)
+        small_grids, _, large_grids, _, _ = approx_dataset[list(range(self.batch_size))]
+        self.assertEqual(large_grids.shape, (self.batch_size, len(self.features_to_use), grid_resolution, grid_resolution))
+
+    def test_neighbor_index_cache(self):
+        cached_dataset = PointCloudDataset(
+            full_data_array=self.full_data_array,
+            window_sizes=self.window_sizes,
+            grid_resolution=self.grid_resolution,
+            features_to_use=self.features_to_use,
+            known_features=self.known_features,
+            subset_file=None,
+            index_cache_bytes=4 * len(self.window_sizes) * self.grid_resolution**2 * 12    # room for 12 points
+        )
+        indices = list(range(self.batch_size))
+        first_pass = cached_dataset[indices]
+        second_pass = cached_dataset[indices]
+        self.assertEqual(cached_dataset.index_cache.misses, self.batch_size)
+        self.assertEqual(cached_dataset.index_cache.hits, self.batch_size)
+
+        # points beyond the budget are still served correctly
+        more_indices = list(range(4, 4 + self.batch_size * 2))
+        beyond_budget = cached_dataset[more_indices]
+        self.assertEqual(cached_dataset.index_cache.size, 12)
+
+        for cached, generated in zip(first_pass[:3], self.dataset[indices][:3]):
+            torch.testing.assert_close(cached, generated)
+        for cached, generated in zip(second_pass[:3], self.dataset[indices][:3]):
+            torch.testing.assert_close(cached, generated)
+        for cached, generated in zip(beyond_budget[:3], self.dataset[more_indices][:3]):
+            torch.testing.assert_close(cached, generated)
+
+
+    def test_neighbor_index_cache_with_workers(self):
+        # workers persist across epochs, so that their caches are hit at the second epoch
+        cached_dataset = PointCloudDataset(full_data_array=self.full_data_array, window_sizes=self.window_sizes, grid_resolution=self.grid_resolution,
+                                           features_to_use=self.features_to_use, known_features=self.known_features,
+                                           index_cache_bytes=4 * len(self.window_sizes) * self.grid_resolution**2 * len(self.full_data_array))
+        subset = Subset(cached_dataset, list(range(8 * self.batch_size)))
+        loader = create_dataloader(subset, batch_size=self.batch_size, shuffle=False, num_workers=2)
+        self.assertTrue(loader.persistent_workers)
+        self.assertFalse(create_dataloader(self.dataset, batch_size=self.batch_size, num_workers=2).persistent_workers)
+
+        num_computed = multiprocessing.Value('i', 0)     # points whose index grids are computed, counted across worker processes
+        compute_neighbor_index_grids = train_data_utils.compute_neighbor_index_grids
+        def counting_compute(center_points, **kwargs):
+            with num_computed.get_lock():
+                num_computed.value += len(center_points)
+            return compute_neighbor_index_grids(center_points, **kwargs)
+
+        with mock.patch('utils.train_data_utils.compute_neighbor_index_grids', side_effect=counting_compute):
+            first_epoch = [batch[0] for batch in loader]
+            self.assertEqual(num_computed.value, len(subset))
+            second_epoch = [batch[0] for batch in loader]
+            self.assertEqual(num_computed.value, len(subset))   # every point of the second epoch is a cache hit
+        for first, second in zip(first_epoch, second_epoch):
+            torch.testing.assert_close(first, second)
+
+class TestPrecisionPolicy(unittest.TestCase):
+
+    def setUp(self):
+        # synthetic point cloud with UTM-like absolute coordinates
+        rng = np.random.default_rng(7)
+        num_points = 5000
+        self.origin = np.array([686123.457, 4929876.543, 48.25])
+        coords = self.origin + np.column_stack((rng.uniform(0, 50, num_points), rng.uniform(0, 50, num_points), rng.uniform(0, 5, num_points)))
+        features = rng.uniform(0, 255, (num_points, 4))
+        labels = rng.integers(0, 3, num_points)
+        self.full_data_array = np.column_stack((coords, features, labels))
+        self.known_features = ['x', 'y', 'z', 'intensity', 'red', 'green', 'blue', 'label']
+        self.features_to_use = ['intensity', 'red', 'green', 'blue']
+        self.window_sizes = [('small', 2.5), ('medium', 5.0), ('large', 10.0)]
+        self.grid_resolution = 64
+        self.indices = list(range(0, 3000, 100))
+
+    def create_dataset(self, precision, subset_file=None):
+        return PointCloudDataset(full_data_array=self.full_data_array, window_sizes=self.window_sizes, grid_resolution=self.grid_resolution,
+                                 features_to_use=self.features_to_use, known_features=self.known_features, subset_file=subset_file, precision=precision)
+
+    def test_offset_coordinates(self):
+        data_array, coordinate_origin = apply_precision_policy(self.full_data_array, precision='float32')
+        self.assertEqual(data_array.dtype, np.float32)
+        np.testing.assert_array_equal(coordinate_origin, np.floor(self.full_data_array[:, :3].min(axis=0)))
+
+        # shifted float32 coordinates keep a sub-millimeter resolution, absolute float32 coordinates do not
+        shifted_error = np.abs(data_array[:, :3] + coordinate_origin - self.full_data_array[:, :3]).max()
+        absolute_error = np.abs(self.full_data_array[:, :3].astype(np.float32) - self.full_data_array[:, :3]).max()
+        self.assertLess(shifted_error, 1e-4)
+        self.assertGreater(absolute_error, 1e-2)
+        np.testing.assert_array_equal(data_array[:, -1], self.full_data_array[:, -1])
+
+        with self.assertRaises(ValueError):
+            apply_precision_policy(self.full_data_array, precision='int8')
+
+    def test_float16_range(self):
+        # LAS intensities are uint16: values above 65504 do not fit in float16 and are refused instead of becoming inf
+        intensity = np.array([[0], [65504], [65535]], dtype=np.uint16)
+        with self.assertRaises(ValueError):
+            build_feature_matrix(intensity, [0], dtype=np.float16)
+        np.testing.assert_array_equal(build_feature_matrix(intensity[:2], [0], dtype=np.float16), [[0], [65504]])
+        np.testing.assert_array_equal(build_feature_matrix(intensity, [0], dtype=np.float32), [[0], [65504], [65535]])
+
+        data_array, _ = apply_precision_policy(np.column_stack((self.full_data_array[:3, :3], intensity)), precision='float16')
+        with self.assertRaises(ValueError):
+            build_feature_matrix(data_array, [3], dtype=np.float16)
+
+        self.full_data_array[0, 3] = 65535
+        with self.assertRaises(ValueError):
+            self.create_dataset('float16')
+        self.assertEqual(self.create_dataset('float32').feature_matrix[0, 0], 65535)
+
+    def test_grids_match_within_tolerance(self):
+        reference = self.create_dataset('float64')[self.indices]
+        float32_dataset = self.create_dataset('float32')
+        float16_dataset = self.create_dataset('float16')
+        self.assertEqual(float32_dataset.full_data_array.dtype, np.float32)
+        self.assertEqual(float16_dataset.feature_matrix.dtype, np.float16)
+
+        float32_grids = float32_dataset[self.indices]
+        float16_grids = float16_dataset[self.indices]
+        for reference_grids, grids32, grids16 in zip(reference[:3], float32_grids[:3], float16_grids[:3]):
+            self.assertEqual(grids32.dtype, torch.float32)
+            self.assertEqual(grids16.dtype, torch.float16)
+            # shifted coordinates only change the nearest point of cells sitting on a (sub-millimeter) tie
+            mismatching_cells = (grids32 != reference_grids).any(dim=1).float().mean().item()
+            self.assertLess(mismatching_cells, 1e-3)
+            # float16 features are within half a float16 step of the float32 ones (at most 0.0625 for values up to 255)
+            torch.testing.assert_close(grids16.float(), grids32, rtol=1e-3, atol=0.0625)
+
+        torch.testing.assert_close(float32_grids[3], reference[3])
+        torch.testing.assert_close(float32_grids[4], reference[4])
+
+        # single point generation follows the same policy
+        small_grid = float16_dataset[self.indices[1]][0]
+        self.assertEqual(small_grid.dtype, torch.float16)
+        torch.testing.assert_close(small_grid, float16_grids[0][1])
+
+    def test_subset_matching_with_shifted_coordinates(self):
+        subset_dir = tempfile.mkdtemp()
+        try:
+            subset_file = os.path.join(subset_dir, 'subset.csv')
+            pd.DataFrame(self.full_data_array[::7, :3], columns=['x', 'y', 'z']).to_csv(subset_file, index=False, float_format='%.17g')
+            reference = self.create_dataset('float64', subset_file=subset_file)
+            shifted = self.create_dataset('float32', subset_file=subset_file)
+            self.assertGreater(len(reference), 0)
+            np.testing.assert_array_equal(shifted.original_indices, reference.original_indices)
+        finally:
+            shutil.rmtree(subset_dir)
+
+
+class TestDataSource(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_filepath = os.path.join(self.tmp_dir, 'data.csv')
+        rng = np.random.default_rng(3)
+        num_points = 4000
+        self.df = pd.DataFrame({'x': rng.uniform(0, 40, num_points), 'y': rng.uniform(0, 40, num_points), 'z': rng.uniform(0, 5, num_points),
+                                'intensity': rng.uniform(0, 255, num_points), 'red': rng.uniform(0, 255, num_points),
+                                'label': rng.choice([2, 5, 9], num_points)})
+        self.df.to_csv(self.data_filepath, index=False)
+        self.window_sizes = [('small', 2.5), ('medium', 5.0), ('large', 10.0)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_derived_facts(self):
+        data_source = DataSource(self.data_filepath)
+        self.assertEqual(data_source.known_features, ['x', 'y', 'z', 'intensity', 'red', 'label'])
+        self.assertEqual(data_source.num_points, len(self.df))
+        self.assertEqual(data_source.num_classes, 3)
+        self.assertEqual(data_source.label_mapping, {2: 0, 5: 1, 9: 2})
+        np.testing.assert_array_equal(data_source.data_array[:, -1], self.df['label'].map({2: 0, 5: 1, 9: 2}).values)
+        self.assertEqual(data_source.bounds['x_max'], data_source.data_array[:, 0].max())
+
+        with self.assertRaises(ValueError):
+            DataSource(None)
+
+    def test_single_load(self):
+        data_source = DataSource(self.data_filepath)
+        with mock.patch('utils.train_data_utils.read_file_to_numpy') as mock_read:
+            train_loader, eval_loader = prepare_dataloader(batch_size=16, window_sizes=self.window_sizes, grid_resolution=16,
+                                                           features_to_use=['intensity', 'red'], train_split=0.8, num_workers=0,
+                                                           data_source=data_source)
+            small_grids, _, _, labels, _ = next(iter(train_loader))
+            mock_read.assert_not_called()
+        self.assertEqual(small_grids.shape, (16, 2, 16, 16))
+        self.assertTrue(torch.all(labels < data_source.num_classes))
+
+
+    def test_shared_precision_array(self):
+        # the data source keeps only the array in the precision policy, and datasets use it without a copy
+        data_source = DataSource(self.data_filepath, precision='float32')
+        self.assertEqual(data_source.data_array.dtype, np.float32)
+        np.testing.assert_array_equal(data_source.coordinate_origin, np.floor(self.df[['x', 'y', 'z']].min().values))
+
+        dataset = create_point_cloud_dataset(self.data_filepath, self.window_sizes, 16, ['intensity', 'red'], precision='float32', data_source=data_source)
+        self.assertIs(dataset.full_data_array, data_source.data_array)
+        reference = create_point_cloud_dataset(self.data_filepath, self.window_sizes, 16, ['intensity', 'red'], precision='float32')
+        np.testing.assert_array_equal(dataset.original_indices, reference.original_indices)
+        torch.testing.assert_close(dataset[list(range(10))][0], reference[list(range(10))][0])
+
+        with self.assertRaises(ValueError):
+            create_point_cloud_dataset(self.data_filepath, self.window_sizes, 16, ['intensity', 'red'], precision='float64', data_source=data_source)
+
+class TestMortonBlockSampler(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.coordinates = np.column_stack((rng.uniform(0, 100, 10000), rng.uniform(0, 100, 10000), rng.uniform(0, 10, 10000)))
+
+    def test_strict_z_order(self):
+        order = list(MortonBlockSampler(self.coordinates, shuffle=False))
+        self.assertEqual(sorted(order), list(range(len(self.coordinates))))
+
+        codes = compute_morton_codes(self.coordinates)[order]
+        self.assertTrue(np.all(np.diff(codes.astype(np.float64)) >= 0))
+
+    def test_block_shuffle(self):
+        block_size = 256
+        z_order = np.array(list(MortonBlockSampler(self.coordinates, shuffle=False)))
+        first_epoch = np.array(list(MortonBlockSampler(self.coordinates, block_size=block_size, shuffle=True, seed=1)))
+        self.assertEqual(sorted(first_epoch.tolist()), list(range(len(self.coordinates))))
+        self.assertFalse(np.array_equal(first_epoch, z_order))
+
+        # the shuffled order is made of contiguous runs of the Z-order, one per block
+        positions = np.empty(len(z_order), dtype=np.int64)
+        positions[z_order] = np.arange(len(z_order))
+        num_breaks = np.count_nonzero(np.diff(positions[first_epoch]) != 1)
+        self.assertLess(num_breaks, int(np.ceil(len(z_order) / block_size)))
+
+
 '''class TestCustomCollateFn(unittest.TestCase):
     def setUp(self):
         # Mock dataset entries
@@ -109,6 +109,51 @@ def parse_arguments():
                         default=config.get('file_to_predict', 'data/chosen_tiles/'),
                         help='File path to the file we need to run predictions on.')
     
+    parser.add_argument('--approximate_grids', action='store_true', default=config.get('approximate_grids', False),
+                        help='If set, feature images for predictions are sliced from rasters of the point cloud built once per scale (faster, with a positional error of at most half a cell).')
+    
+    parser.add_argument('--materialize_grids', action='store_true', default=config.get('materialize_grids', False),
+                        help='If set, pre-computes the feature images of the training and evaluation files and saves them in grid_store_dir.')
+    
+    parser.add_argument('--grid_store_dir', type=str, default=config.get('grid_store_dir', None),
+                        help='Directory of the pre-computed feature images. If a matching store exists, feature images are read from it instead of being generated.')
+    
+    parser.add_argument('--grid_store_dtype', type=str, choices=['float32', 'float16'], default=config.get('grid_store_dtype', 'float32'),
+                        help="Data type used to save the pre-computed feature images. A 'float16' store is only used with precision 'float16', a 'float32' store otherwise.")
+    
+    parser.add_argument('--grid_store_mode', type=str, choices=['features', 'indices'], default=config.get('grid_store_mode', 'features'),
+                        help="What to pre-compute: the feature images ('features') or the nearest-neighbor indices of their cells ('indices'), which are valid for any selection of features.")
+    
+    parser.add_argument('--neighbor_index_backend', type=str, choices=['kdtree', 'voxel_hash'], default=config.get('neighbor_index_backend', 'kdtree'),
+                        help="Nearest-neighbor index used to fill the feature images: scipy's KDTree ('kdtree') or a uniform voxel grid ('voxel_hash').")
+    
+    parser.add_argument('--tree_cache_dir', type=str, default=config.get('tree_cache_dir', None),
+                        help='Directory where the nearest-neighbor indices (KDTrees) are saved and reused across runs. If not set, they are rebuilt at every run.')
+    
+    parser.add_argument('--precision', type=str, choices=['float64', 'float32', 'float16'], default=config.get('precision', 'float64'),
+                        help="Precision of the data path: 'float64' keeps the point cloud in float64, 'float32' stores it in float32 with coordinates shifted to the tile origin, 'float16' also stores the feature images in float16.")
+    
+    parser.add_argument('--ingest_cache_dir', type=str, default=config.get('ingest_cache_dir', None),
+                        help='Directory where .las and .csv input files are converted, on first use, to memory-mapped column-major .npy files reused across runs. If not set, input files are parsed at every load.')
+    
+    parser.add_argument('--laz_threads', type=int, default=config.get('laz_threads', None),
+                        help='Number of threads used to decompress and compress .laz files. If not set, all available cores are used.')
+    
+    parser.add_argument('--compress_las', action=argparse.BooleanOptionalAction, default=config.get('compress_las', True),
+                        help='Whether predicted files are saved as compressed .laz files (--compress_las) or as .las files (--no-compress_las).')
+    
+    parser.add_argument('--inference_mode', type=str, choices=['streaming', 'subtiles', 'parallel_subtiles'], default=config.get('inference_mode', 'streaming'),
+                        help="How files are predicted: 'streaming' builds one neighbor index over the whole file and predicts its points in spatially ordered batches, 'subtiles' splits large files into subtiles predicted one by one, 'parallel_subtiles' predicts the subtiles with a pool of processes (CPU only).")
+    
+    parser.add_argument('--inference_processes', type=int, default=config.get('inference_processes', None),
+                        help="Number of worker processes predicting subtiles with --inference_mode parallel_subtiles. If not set, one per available core.")
+    
+    parser.add_argument('--spatial_block_size', type=int, default=config.get('spatial_block_size', None),
+                        help='If set, training points are sampled in Z-order (Morton order), shuffled in blocks of this many points, for cache-friendly neighbor queries.')
+    
+    parser.add_argument('--index_cache_mb', type=int, default=config.get('index_cache_mb', None),
+                        help='Memory budget (in MB) to cache the nearest-neighbor indices of the feature images across training epochs. If not set, no cache is used.')
+    
     # Parsing arguments
     args = parser.parse_args()
     
@@ -9,33 +9,45 @@
 
 
 import os
-import laspy
+import time
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
-from utils.point_cloud_data_utils import las_to_csv, clean_and_combine_csv_files
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from utils.point_cloud_data_utils import las_to_csv, clean_and_combine_csv_files, save_subset_indices
+from utils.table_io import iter_table_chunks, TableWriter
+from utils.sampling import RandomKeyReservoir, hash_to_unit_interval
+from utils.las_io import las_extension, open_las, concatenate_las, set_laz_threads
 
 
-def create_dataset(input_folders, fused_las_folder, max_points_per_class, output_dataset_folder=None, chosen_classes=[3,5,6,10,11,64], train_split=0.8):
+def create_dataset(input_folders, fused_las_folder, max_points_per_class, output_dataset_folder=None, chosen_classes=[3,5,6,10,11,64], train_split=0.8, file_format='csv', compress_las=False, laz_threads=None, num_workers=1, max_memory_mb=None):
     """
     Creates a dataset for training and evaluation from LAS files by processing ground and off-ground data.
 
     This function:
     - Finds and pairs ground and off-ground LAS files.
     - Stitches them into fused LAS files.
-    - Converts the fused LAS files into CSVs.
+    - Converts the fused LAS files into CSVs (or Parquet files).
     - Combines the CSV files into a single dataset.
     - Rebalances the dataset by downsampling overrepresented classes.
     - Splits the dataset into training and evaluation sets.
 
+    With num_workers > 1, file pairs are processed end-to-end (stitching, filtering and conversion) in parallel by a pool of 
+    processes, and the converted files are combined once all pairs are done (see process_file_pairs).
+
     Args:
-    - input_folders (List): List of paths to the folders containing the input LAS files.
+    - input_folders (List): List of paths to the folders containing the input LAS (or LAZ) files.
     - fused_las_folder (str): Folder to save fused LAS and intermediate CSV files.
     - max_points_per_class (int): Maximum number of points per class for rebalancing.
     - output_dataset_folder (str): Folder to save the final dataset.
     - chosen_classes (list, optional): List of class labels to include in the dataset.
     - train_split (float): Proportion of data allocated to training (default: 0.8).
-    
+    - file_format (str): Format of the intermediate and final files, 'csv' or 'parquet' (needs the optional pyarrow package). Default is 'csv'.
+    - compress_las (bool): If True, the fused files are saved as compressed .laz files. Default is False.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression. If None, all cores are used 
+                                   (one thread per worker when num_workers > 1). Default is None.
+    - num_workers (int): Number of file pairs processed in parallel. Default is 1 (sequential).
+    - max_memory_mb (int, optional): Memory budget (MB) of the pairs processed at the same time, estimated from their number of points. 
+                                     If None, the number of concurrent pairs is only limited by num_workers. Default is None.
 
     Returns:
     - None
@@ -43,26 +55,21 @@ def create_dataset(input_folders, fused_las_folder, max_points_per_class, output
     # get ground + off ground las file pairs
     file_pairs = pair_ground_and_offgrounds(input_folders=input_folders)
 
-    # stitch the pairs together and save them inside fused_las_folder
-    fused_files = stitch_pairs(file_pairs=file_pairs, output_folder=fused_las_folder)
+    # stitch each pair, then convert the fused las into a csv (or parquet) file saved in a fused_las_folder/<file_format>/ subdirectory
+    csv_filepaths = process_file_pairs(file_pairs=file_pairs, fused_las_folder=fused_las_folder, chosen_classes=chosen_classes, 
+                                       file_format=file_format, compress_las=compress_las, laz_threads=laz_threads, 
+                                       num_workers=num_workers, max_memory_mb=max_memory_mb)
 
-    # convert the las into csv files and save them in a fused_las_folder/csv/ subdirectory
-    csv_subdir = f"{fused_las_folder}/csv" 
-    os.makedirs(csv_subdir, exist_ok=True)
-    csv_filepaths = []
-    for las_filepath in fused_files:
-        csv_path = las_to_csv(las_file=las_filepath, output_folder=csv_subdir, selected_classes=chosen_classes)
-        csv_filepaths.append(csv_path)
+    # combine the files together to get one big file, and save it. Also cleans nan/inf values of combined file internally
+    combined_csv = clean_and_combine_csv_files(csv_filepaths, output_csv=f"{output_dataset_folder}/full_dataset.{file_format}")
 
-    # combine the csvs together to get one big file, and save it. Also cleans nan/inf values of combined file internally
-    combined_csv = clean_and_combine_csv_files(csv_filepaths, output_csv=f"{output_dataset_folder}/full_dataset.csv")
-
-    # finally rebalance the combined csv and create train/test datasets, saving them as csv inside output_dataset_folder
+    # finally rebalance the combined file and create train/test datasets, saving them inside output_dataset_folder
     train_df, eval_df = create_train_eval_datasets(csv_file=combined_csv,
                                max_points_per_class=max_points_per_class,
                                chosen_classes=chosen_classes,
                                train_split=train_split,
-                               output_dataset_folder=output_dataset_folder)
+                               output_dataset_folder=output_dataset_folder,
+                               file_format=file_format)
     '''need to add filtering of dfs because they may contain too many feats and _b,_a suffyxes'''
     
     # Inspection: Print dataset summary
@@ -100,8 +107,8 @@ def pair_ground_and_offgrounds(input_folders):
     # Process each directory separately
     for input_folder in input_folders:
         # Find all ground and off-ground files based on suffix
-        ground_files = [os.path.join(input_folder, file) for file in os.listdir(input_folder) if file.endswith("FGLn.las")]
-        off_ground_files = [os.path.join(input_folder, file) for file in os.listdir(input_folder) if file.endswith("FSLn.las")]
+        ground_files = [os.path.join(input_folder, file) for file in os.listdir(input_folder) if file.endswith(("FGLn.las", "FGLn.laz"))]
+        off_ground_files = [os.path.join(input_folder, file) for file in os.listdir(input_folder) if file.endswith(("FSLn.las", "FSLn.laz"))]
 
         # Pair each ground file with all off-ground files in the same directory
         for ground_file in ground_files:
@@ -114,7 +121,7 @@ def pair_ground_and_offgrounds(input_folders):
 
 
 
-def stitch_pairs(file_pairs, output_folder):
+def stitch_pairs(file_pairs, output_folder, compress=False, laz_threads=None):
     """
     Stitches and fuses multiple pairs of ground and off-ground LAS files.
 
@@ -123,223 +130,267 @@ def stitch_pairs(file_pairs, output_folder):
         - ground_file (str): Path to the ground LAS file.
         - off_ground_files (list): List of paths to the off-ground LAS files.
     - output_folder (str): Folder to save the fused LAS files.
+    - compress (bool): If True, the fused files are saved as compressed .laz files instead of .las files. Default is False.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression. If None, all cores are used. Default is None.
 
     Returns:
     - fused_files (list): List of file paths to the fused LAS files.
     """
-    fused_files = []
-
     print(f"Processing {len(file_pairs)} file pairs (ground + off grounds)")
 
+    fused_files = []
     for ground_file, off_ground_files in file_pairs:
-        # Load the ground LAS file
-        if not ground_file:
-            raise ValueError(f"Error: No ground file found.")
-        ground_las = laspy.read(ground_file)
-
-        # Check that at least one off-ground file exists
-        if not off_ground_files:
-            raise ValueError(f"Error: No off-ground files found for ground file {ground_file}")
-
-        # Get the dimensions in the ground file
-        ground_dimensions = set(ground_las.point_format.dimension_names)
-
-        # Prepare lists to collect all points and attributes
-        all_points = [np.vstack((ground_las.x, ground_las.y, ground_las.z)).T]
-        all_labels = [ground_las.label]
-
-        # Collect other attributes if they exist
-        all_intensities = [ground_las.intensity] 
-        all_red = [ground_las.red]
-        all_green = [ground_las.green] 
-        all_blue = [ground_las.blue] 
-        all_nir = [ground_las.nir] 
-        all_return_number = [ground_las.return_number] 
-        all_number_of_returns = [ground_las.number_of_returns] 
-        all_classification = [ground_las.classification] 
-
-        # Loop through off-ground files and collect their data
-        for file in off_ground_files:
-            off_ground_las = laspy.read(file)
-
-            # check that dimensions match between ground and off ground 
-            off_ground_dimensions = set(off_ground_las.point_format.dimension_names)
-
-            if ground_dimensions != off_ground_dimensions:
-                raise ValueError(
-                    f"Dimension mismatch between ground file and off-ground file:\n"
-                    f"Ground dimensions: {ground_dimensions}\n"
-                    f"Off-ground dimensions: {off_ground_dimensions}"
-                )
-
-            all_points.append(np.vstack((off_ground_las.x, off_ground_las.y, off_ground_las.z)).T)
-            all_labels.append(off_ground_las.label)
-
-
-            all_intensities.append(off_ground_las.intensity)
-
-            all_red.append(off_ground_las.red)
-
-            all_green.append(off_ground_las.green)
-
-            all_blue.append(off_ground_las.blue)
-
-            all_nir.append(off_ground_las.nir)
-
-            all_return_number.append(off_ground_las.return_number)
-
-            all_number_of_returns.append(off_ground_las.number_of_returns)
-
-            all_classification.append(off_ground_las.classification)
-
-        # Concatenate all points and attributes
-        all_points = np.concatenate(all_points)
-        all_labels = np.concatenate(all_labels)
-
-        all_intensities = np.concatenate(all_intensities)
-
-        all_red = np.concatenate(all_red)
-
-        all_green = np.concatenate(all_green)
-
-        all_blue = np.concatenate(all_blue)
-
-        all_nir = np.concatenate(all_nir)
+        fused_files.append(stitch_pair(ground_file, off_ground_files, output_folder, compress=compress, laz_threads=laz_threads))
 
-        all_return_number = np.concatenate(all_return_number)
-
-        all_number_of_returns = np.concatenate(all_number_of_returns)
-
-        all_classification = np.concatenate(all_classification)
-
-        # Create a new LAS file for the fused data
-        # Create a new header with the correct point format, scales, and offsets 
-        fused_header = laspy.LasHeader(point_format=ground_las.header.point_format, version=ground_las.header.version)
-        fused_header.offsets = ground_las.header.offsets
-        fused_header.scales = ground_las.header.scales
-        fused_las = laspy.LasData(fused_header)
-
-        fused_las.x = all_points[:, 0]
-        fused_las.y = all_points[:, 1]
-        fused_las.z = all_points[:, 2]
-        fused_las.label = all_labels
+    return fused_files
 
-        fused_las.intensity = all_intensities
 
-        fused_las.red = all_red
+def stitch_pair(ground_file, off_ground_files, output_folder, compress=False, laz_threads=None):
+    """
+    Stitches a ground LAS file and its off-ground LAS files into a single fused LAS file.
+    Points are streamed chunk by chunk into the fused file with all their dimensions (see concatenate_las), 
+    so that files are never fully loaded.
 
-        fused_las.green = all_green
+    Args:
+    - ground_file (str): Path to the ground LAS file.
+    - off_ground_files (list): List of paths to the off-ground LAS files.
+    - output_folder (str): Folder to save the fused LAS file.
+    - compress (bool): If True, the fused file is saved as a compressed .laz file instead of a .las file. Default is False.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression. If None, all cores are used. Default is None.
 
-        fused_las.blue = all_blue
+    Returns:
+    - fused_filepath (str): Path to the fused LAS file.
+    """
+    # Check the ground file
+    if not ground_file:
+        raise ValueError(f"Error: No ground file found.")
+    with open_las(ground_file, laz_threads=laz_threads) as las_reader:
+        ground_header = las_reader.header
+
+    # Check that at least one off-ground file exists
+    if not off_ground_files:
+        raise ValueError(f"Error: No off-ground files found for ground file {ground_file}")
+
+    # check that dimensions match between ground and off grounds (only the headers are read)
+    ground_dimensions = set(ground_header.point_format.dimension_names)
+    for file in off_ground_files:
+        with open_las(file, laz_threads=laz_threads) as las_reader:
+            off_ground_dimensions = set(las_reader.header.point_format.dimension_names)
+        if ground_dimensions != off_ground_dimensions:
+            raise ValueError(
+                f"Dimension mismatch between ground file and off-ground file:\n"
+                f"Ground dimensions: {ground_dimensions}\n"
+                f"Off-ground dimensions: {off_ground_dimensions}"
+            )
+
+    # Stream the points of all files into the fused file, with the point format, scales, and offsets of the ground file
+    os.makedirs(output_folder, exist_ok=True)
+    fused_filepath = os.path.join(output_folder, f"fused_{os.path.splitext(os.path.basename(ground_file))[0]}{las_extension(compress)}")
+    concatenate_las([ground_file] + list(off_ground_files), fused_filepath, header=ground_header, laz_threads=laz_threads)
+
+    print(f"Fused LAS file saved at: {fused_filepath}")
+    return fused_filepath
+
+
+def process_file_pair(file_pair, fused_las_folder, chosen_classes=None, file_format='csv', compress_las=False, laz_threads=None):
+    """
+    Processes a pair of ground and off-ground LAS files end-to-end: stitches them into a fused LAS file (saved in fused_las_folder), 
+    then filters the chosen classes and converts the fused file into a CSV (or Parquet) file (saved in fused_las_folder/<file_format>/).
 
-        fused_las.nir = all_nir
+    Args:
+    - file_pair (tuple): Tuple (ground_file, off_ground_files), as returned by pair_ground_and_offgrounds.
+    - fused_las_folder (str): Folder to save the fused LAS file.
+    - chosen_classes (list, optional): List of class labels to keep. If None, all classes are kept. Default is None.
+    - file_format (str): Format of the converted file, 'csv' or 'parquet'. Default is 'csv'.
+    - compress_las (bool): If True, the fused file is saved as a compressed .laz file. Default is False.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression. If None, all cores are used. Default is None.
 
-        fused_las.return_number = all_return_number
+    Returns:
+    - csv_filepath (str): Path to the converted file.
+    """
+    ground_file, off_ground_files = file_pair
+    fused_filepath = stitch_pair(ground_file, off_ground_files, fused_las_folder, compress=compress_las, laz_threads=laz_threads)
+    return las_to_csv(las_file=fused_filepath, output_folder=f"{fused_las_folder}/{file_format}", selected_classes=chosen_classes, file_format=file_format)
 
-        fused_las.number_of_returns = all_number_of_returns
 
-        fused_las.classification = all_classification
+def estimate_pair_memory(file_pair):
+    """
+    Estimates the peak memory (in bytes) used to process a pair of ground and off-ground LAS files (see process_file_pair), 
+    from the number of points and the point format in the headers of the files (nothing else is read).
+    Stitching streams the points, so the peak is reached by the conversion of the fused file, which holds its points 
+    (twice, while removing out of bounds points) and then a float64 array and a DataFrame with one column per dimension.
 
-        # Update header
-        fused_las.update_header()
+    Args:
+    - file_pair (tuple): Tuple (ground_file, off_ground_files), as returned by pair_ground_and_offgrounds.
 
-        # Save the fused LAS file
-        os.makedirs(output_folder, exist_ok=True)
-        fused_filepath = os.path.join(output_folder, f"fused_{os.path.basename(ground_file)}")
-        fused_las.write(fused_filepath)
+    Returns:
+    - memory (int): Estimated peak memory in bytes.
+    """
+    ground_file, off_ground_files = file_pair
+    num_points, bytes_per_point = 0, 0
+    for file_path in [ground_file] + list(off_ground_files):
+        with open_las(file_path) as las_reader:
+            num_points += las_reader.header.point_count
+            point_format = las_reader.header.point_format
+            bytes_per_point = max(bytes_per_point, max(2 * point_format.size, 2 * 8 * len(list(point_format.dimension_names))))
+    return num_points * bytes_per_point
 
-        print(f"Fused LAS file saved at: {fused_filepath}")
-        fused_files.append(fused_filepath)
 
-    return fused_files
+def process_file_pairs(file_pairs, fused_las_folder, chosen_classes=None, file_format='csv', compress_las=False, laz_threads=None, num_workers=1, max_memory_mb=None):
+    """
+    Processes pairs of ground and off-ground LAS files end-to-end (see process_file_pair), sequentially or in parallel 
+    with a pool of num_workers processes. 
+    The number of pairs processed at the same time is also bounded by a memory budget: a pair is only started once the estimated 
+    memory of the pairs in progress (see estimate_pair_memory) plus its own fits in max_memory_mb (a pair is always started 
+    if no other pair is in progress). Pairs are started from the largest, so that the longest ones do not run last and alone.
+    A progress line is printed when each pair is done.
 
+    Args:
+    - file_pairs (list): List of tuples (ground_file, off_ground_files), as returned by pair_ground_and_offgrounds.
+    - fused_las_folder (str): Folder to save the fused LAS files (and the converted files, in a <file_format>/ subdirectory).
+    - chosen_classes (list, optional): List of class labels to keep. If None, all classes are kept. Default is None.
+    - file_format (str): Format of the converted files, 'csv' or 'parquet'. Default is 'csv'.
+    - compress_las (bool): If True, the fused files are saved as compressed .laz files. Default is False.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression by each worker. If None, 
+                                   all cores are used when processing sequentially, and one thread per worker otherwise. Default is None.
+    - num_workers (int): Number of worker processes. If 1, pairs are processed sequentially in the current process. Default is 1.
+    - max_memory_mb (int, optional): Memory budget (MB) of the pairs processed at the same time. If None, only num_workers 
+                                     limits the concurrency. Default is None.
 
-def create_train_eval_datasets(csv_file, max_points_per_class, chosen_classes=None, train_split=0.8, output_dataset_folder=None):
+    Returns:
+    - csv_filepaths (list): Paths to the converted files, in the order of file_pairs.
     """
-    Analyzes the class distribution in a CSV file, filters chosen classes, rebalances by downsampling 
+    if num_workers < 1:
+        raise ValueError(f"num_workers must be a positive integer, got {num_workers}.")
+    os.makedirs(f"{fused_las_folder}/{file_format}", exist_ok=True)
+    print(f"Processing {len(file_pairs)} file pairs (ground + off grounds) with {num_workers} worker(s)")
+
+    csv_filepaths = [None] * len(file_pairs)
+    start_time = time.time()
+
+    def report(pair_idx, num_done):
+        ground_name = os.path.basename(file_pairs[pair_idx][0])
+        print(f"[{num_done}/{len(file_pairs)}] {ground_name} -> {csv_filepaths[pair_idx]} ({time.time() - start_time:.1f}s)")
+
+    if num_workers == 1:
+        for pair_idx, file_pair in enumerate(file_pairs):
+            csv_filepaths[pair_idx] = process_file_pair(file_pair, fused_las_folder, chosen_classes=chosen_classes, file_format=file_format, 
+                                                        compress_las=compress_las, laz_threads=laz_threads)
+            report(pair_idx, pair_idx + 1)
+        return csv_filepaths
+
+    # workers share the cores: unless specified otherwise, each one (de)compresses LAZ files with a single thread
+    worker_laz_threads = laz_threads if laz_threads is not None else 1
+    memory_budget = max_memory_mb * 2**20 if max_memory_mb is not None else None
+    pair_memory = [estimate_pair_memory(file_pair) for file_pair in file_pairs]
+    pending = sorted(range(len(file_pairs)), key=lambda pair_idx: pair_memory[pair_idx], reverse=True)
+
+    running = {}    # future -> index of its pair
+    running_memory, num_done = 0, 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=set_laz_threads, initargs=(worker_laz_threads,)) as executor:
+        while pending or running:
+            # start pairs while there are free workers and the next pair fits in the memory budget
+            while pending and len(running) < num_workers and (not running or memory_budget is None or running_memory + pair_memory[pending[0]] <= memory_budget):
+                pair_idx = pending.pop(0)
+                future = executor.submit(process_file_pair, file_pairs[pair_idx], fused_las_folder, chosen_classes=chosen_classes, 
+                                         file_format=file_format, compress_las=compress_las, laz_threads=worker_laz_threads)
+                running[future] = pair_idx
+                running_memory += pair_memory[pair_idx]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                pair_idx = running.pop(future)
+                running_memory -= pair_memory[pair_idx]
+                csv_filepaths[pair_idx] = future.result()
+                num_done += 1
+                report(pair_idx, num_done)
+
+    return csv_filepaths
+
+
+def create_train_eval_datasets(csv_file, max_points_per_class, chosen_classes=None, train_split=0.8, output_dataset_folder=None, file_format='csv', chunk_size=100000, seed=42):
+    """
+    Analyzes the class distribution in a CSV (or Parquet) file, filters chosen classes, rebalances by downsampling 
     overrepresented classes, splits the dataset into training and evaluation sets, and saves
-    the splits to new CSV files inside the specified folder.
+    the splits to new CSV (or Parquet) files inside the specified folder.
+    The file is streamed in a single pass: each class keeps a bounded reservoir of at most max_points_per_class points 
+    (see RandomKeyReservoir), so that memory is bounded by max_points_per_class x number of classes rather than by the file size.
+    Each point is assigned to the training or evaluation set by a seeded hash of its row (see hash_to_unit_interval), 
+    and the splits are written class by class.
+    Chosen classes are filtered while reading: for Parquet inputs, row groups without any chosen class are skipped.
+    The rows of each split in the input file are also saved as int64 row-index files (train_indices.npy and eval_indices.npy), 
+    which can be used as subset files of the input file instead of the train and eval files (see save_subset_indices).
 
     Args:
-    - csv_file (str): Path to the input CSV file.
+    - csv_file (str): Path to the input CSV or Parquet file.
     - max_points_per_class (int): Maximum number of points allowed per class.
     - chosen_classes (list, optional): List of class labels to extract and rebalance. If None, use all classes.
     - train_split (float): Proportion of data to allocate to the training set (default: 0.8).
     - output_dataset_folder (str): Folder where the train and eval csv will be saved.
+    - file_format (str): Format of the train and eval files, 'csv' or 'parquet'. Default is 'csv'.
+    - chunk_size (int): Number of rows read at a time. Default is 100000.
+    - seed (int): Seed of the downsampling and of the train/eval split. Default is 42.
 
     Returns:
-    - train_df (pd.DataFrame): A Pandas DataFrame containing the training set.
-    - eval_df (pd.DataFrame): A Pandas DataFrame containing the evaluation set.
+    - train_df (pd.DataFrame): A Pandas DataFrame containing the training set, indexed by row of the input file.
+    - eval_df (pd.DataFrame): A Pandas DataFrame containing the evaluation set, indexed by row of the input file.
     """
     # Check directory to save the datasets
     if output_dataset_folder is None:
         raise ValueError("Output dataset folder not specified.")
     os.makedirs(output_dataset_folder, exist_ok=True)
     
-    # Initialize variables for processing the dataset in chunks
-    chunksize = 10_000
-    filtered_dfs = []  # For storing filtered chunks
-    
-    # Read and process the CSV in chunks
+    # Stream the file once, keeping only the chosen classes, and offer the points of each class to its reservoir
     print(f"Reading and processing the dataset in chunks for train/eval split...")
-    for chunk in pd.read_csv(csv_file, chunksize=chunksize):
-        # Filter chosen classes
-        if chosen_classes is not None:
-            chunk = chunk[chunk['label'].isin(chosen_classes)]
-
-        # Append filtered chunk to list
-        filtered_dfs.append(chunk)
-
-    # Combine all filtered chunks into a single DataFrame
-    if filtered_dfs:
-        df = pd.concat(filtered_dfs, ignore_index=True)
-    else:
+    seed_sequence = np.random.SeedSequence(seed)
+    reservoirs = {}     # class label -> reservoir of the points of the class
+    for chunk, row_indices in iter_table_chunks(csv_file, chunk_size=chunk_size, label_filter=chosen_classes, with_row_indices=True):
+        labels = chunk['label'].values
+        for class_label in np.unique(labels):
+            in_class = labels == class_label
+            if class_label not in reservoirs:
+                # one generator per class (in order of first appearance), so that the sample does not depend on the chunk size
+                reservoirs[class_label] = RandomKeyReservoir(max_points_per_class, rng=np.random.default_rng(seed_sequence.spawn(1)[0]))
+            reservoirs[class_label].add(chunk[in_class], row_indices[in_class])
+
+    if not reservoirs:
         raise ValueError("No data found after filtering for chosen classes.")
 
     # Print class distribution before rebalancing
     print("\nOriginal class distribution:")
-    class_counts = df['label'].value_counts().sort_index()
-    for class_label, count in class_counts.items():
-        print(f"Class {class_label}: {count} points")
-
-    # Rebalance the dataset by downsampling overrepresented classes
-    rebalanced_dfs = []
-    for class_label, count in class_counts.items():
-        class_subset = df[df['label'] == class_label]
-        if count > max_points_per_class:
-            # Downsample to the specified max_points_per_class
-            class_subset = class_subset.sample(max_points_per_class, random_state=42)
-        rebalanced_dfs.append(class_subset)
-
-    # Combine the rebalanced subsets
-    rebalanced_df = pd.concat(rebalanced_dfs, ignore_index=True)
-
-    # Print class distribution after rebalancing
+    for class_label in sorted(reservoirs):
+        print(f"Class {class_label}: {reservoirs[class_label].num_seen} points")
+
+    # Split the (rebalanced) points of each class and write them class by class
+    train_csv = f"{output_dataset_folder}/train_dataset.{file_format}"
+    eval_csv = f"{output_dataset_folder}/eval_dataset.{file_format}"
+    train_dfs, eval_dfs = [], []
     print("\nRebalanced class distribution:")
-    rebalanced_class_counts = rebalanced_df['label'].value_counts().sort_index()
-    for class_label, count in rebalanced_class_counts.items():
-        print(f"Class {class_label}: {count} points")
-
-    # Split the rebalanced dataset into training and evaluation sets
-    train_df, eval_df = train_test_split(
-        rebalanced_df, 
-        test_size=(1 - train_split), 
-        random_state=42, 
-        stratify=rebalanced_df['label']
-    )
+    with TableWriter(train_csv) as train_writer, TableWriter(eval_csv) as eval_writer:
+        for class_label in sorted(reservoirs):
+            class_subset, class_rows = reservoirs.pop(class_label).sample()
+            class_subset.index = class_rows
+            print(f"Class {class_label}: {len(class_subset)} points")
+
+            in_train = hash_to_unit_interval(class_rows, seed=seed) < train_split
+            for split_df, writer, split_dfs in ((class_subset[in_train], train_writer, train_dfs), (class_subset[~in_train], eval_writer, eval_dfs)):
+                if len(split_df) > 0 or writer.num_rows == 0:    # an empty split still gets a header
+                    writer.write(split_df)
+                split_dfs.append(split_df)
+
+    train_df = pd.concat(train_dfs)
+    eval_df = pd.concat(eval_dfs)
 
     # Print dataset split summary
     print(f"\nDataset split into:")
-    print(f"- Training set: {len(train_df)} points ({train_split * 100:.0f}%)")
-    print(f"- Evaluation set: {len(eval_df)} points ({(1 - train_split) * 100:.0f}%)")
-  
-    train_csv = f"{output_dataset_folder}/train_dataset.csv"
-    eval_csv = f"{output_dataset_folder}/eval_dataset.csv"
-    train_df.to_csv(train_csv, index=False)
-    eval_df.to_csv(eval_csv, index=False)
-
-    print(f"\nTraining dataset saved to: {train_csv}")
-    print(f"Evaluation dataset saved to: {eval_csv}")
+    print(f"- Training set: {len(train_df)} points ({len(train_df) / (len(train_df) + len(eval_df)) * 100:.0f}%)")
+    print(f"- Evaluation set: {len(eval_df)} points ({len(eval_df) / (len(train_df) + len(eval_df)) * 100:.0f}%)")
+
+    train_indices = save_subset_indices(train_df.index.values, f"{output_dataset_folder}/train_indices.npy")
+    eval_indices = save_subset_indices(eval_df.index.values, f"{output_dataset_folder}/eval_indices.npy")
+
+    print(f"\nTraining dataset saved to: {train_csv} (row indices: {train_indices})")
+    print(f"Evaluation dataset saved to: {eval_csv} (row indices: {eval_indices})")
 
     return train_df, eval_df
 
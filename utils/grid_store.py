@@ -0,0 +1,376 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SequentialSampler
+from tqdm import tqdm
+from scripts.point_cloud_to_image import gather_grids_from_neighbor_indices
+
+
+MANIFEST_FILENAME = 'manifest.json'
+GRID_STORE_MODES = ('features', 'indices')
+GRID_STORE_DTYPES = ('float32', 'float16')
+
+
+def compute_file_hash(file_path, block_size=2**20):
+    """
+    Computes the SHA-256 hash of a file's content, reading it in blocks.
+
+    Args:
+    - file_path (str): Path to the file.
+    - block_size (int): Number of bytes read at a time. Default is 1 MiB.
+
+    Returns:
+    - str: Hexadecimal digest of the file content.
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_fingerprint(file_path):
+    """
+    Identifies a file by its absolute path, modification time and size (as ingest_cache_key does), without reading its content.
+
+    Args:
+    - file_path (str): Path to the file.
+
+    Returns:
+    - fingerprint (dict): Dictionary with the 'path', 'mtime_ns' and 'size' of the file.
+    """
+    file_stat = os.stat(file_path)
+    return {'path': os.path.abspath(file_path), 'mtime_ns': file_stat.st_mtime_ns, 'size': file_stat.st_size}
+
+
+def grid_store_params(data_filepath, window_sizes, grid_resolution, features_to_use, subset_file=None, mode='features', dtype='float32'):
+    """
+    Collects the parameters that fully determine the grids of a dataset, together with the key identifying them.
+    Grids are deterministic given the source data, the selected points, the features, the window sizes and the resolution.
+    Index grids (mode='indices') do not depend on the features, so features are not part of their key, and are always stored as int32.
+    Source files are identified by path, modification time and size (see file_fingerprint), so that looking up a store 
+    never reads them: a modified or replaced file changes the key. Their content hashes are only computed when the store is written.
+
+    Args:
+    - data_filepath (str): Path to the full data file.
+    - window_sizes (list): List of tuples for grid window sizes (e.g., [('small', 2.5), ('medium', 5.0), ('large', 10.0)]).
+    - grid_resolution (int): Grid resolution (e.g., 128x128).
+    - features_to_use (list): List of feature names used for generating grids.
+    - subset_file (str, optional): Path to the subset file selecting the points. If None, all points are selected.
+    - mode (str): 'features' to store feature grids, 'indices' to store nearest-neighbor index grids. Default is 'features'.
+    - dtype (str): Data type of the stored feature grids, 'float32' or 'float16' (ignored in 'indices' mode). Default is 'float32'.
+
+    Returns:
+    - params (dict): Dictionary with the grid parameters and the fingerprints of the source files, including a 'key' entry.
+    """
+    if mode not in GRID_STORE_MODES:
+        raise ValueError(f"Unsupported grid store mode '{mode}'. Choose among {GRID_STORE_MODES}.")
+    if mode == 'features' and dtype not in GRID_STORE_DTYPES:
+        raise ValueError(f"Unsupported grid store dtype '{dtype}'. Choose among {GRID_STORE_DTYPES}.")
+
+    params = {
+        'mode': mode,
+        'dtype': dtype if mode == 'features' else 'int32',
+        'source': file_fingerprint(data_filepath),
+        'subset': file_fingerprint(subset_file) if subset_file is not None else None,
+        'features_to_use': list(features_to_use) if mode == 'features' else None,
+        'window_sizes': [[label, float(size)] for label, size in window_sizes],
+        'grid_resolution': int(grid_resolution),
+    }
+    params['key'] = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+    return params
+
+
+def find_grid_store(grid_store_dir, params):
+    """
+    Looks for a materialized grid store matching the given parameters.
+
+    Args:
+    - grid_store_dir (str): Root directory containing the grid stores.
+    - params (dict): Grid parameters, as returned by grid_store_params.
+
+    Returns:
+    - store_dir (str or None): Path to the matching store, or None if no complete store exists.
+    """
+    store_dir = os.path.join(grid_store_dir, params['key'])
+    manifest_path = os.path.join(store_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('key') != params['key'] or not manifest.get('complete', False):
+        return None
+
+    return store_dir
+
+
+def write_grid_store(dataset, grid_store_dir, params, shard_size=1024, batch_size=64, num_workers=0):
+    """
+    Materializes the multiscale grids of every point of a dataset into sharded .npy files, which can later be memory-mapped.
+    The grids are stored with the data type of the parameters: in 'indices' mode (see grid_store_params) only the int32 nearest-neighbor index grids are stored.
+    The manifest is written last, so that an interrupted materialization is never mistaken for a complete store.
+    It records the content hashes of the source files, which are checked to be unchanged since the parameters were collected.
+
+    Args:
+    - dataset (PointCloudDataset): Dataset whose grids are to be materialized.
+    - grid_store_dir (str): Root directory of the grid stores. The store is saved in a subdirectory named after the parameters' key.
+    - params (dict): Grid parameters, as returned by grid_store_params.
+    - shard_size (int): Number of points per shard file. Default is 1024.
+    - batch_size (int): Number of points generated at a time. Default is 64.
+    - num_workers (int): Number of workers used to generate the grids. Default is 0.
+
+    Returns:
+    - store_dir (str): Path to the directory where the store was saved.
+    """
+    dtype = params['dtype']
+    if params['mode'] == 'indices':
+        dataset = NeighborIndexDataset(dataset)
+
+    store_dir = os.path.join(grid_store_dir, params['key'])
+    os.makedirs(store_dir, exist_ok=True)
+
+    num_points = len(dataset)
+    num_scales = len(params['window_sizes'])
+    resolution = params['grid_resolution']
+    if params['mode'] == 'indices':
+        point_shape = (num_scales, resolution, resolution)
+    else:
+        point_shape = (num_scales, len(params['features_to_use']), resolution, resolution)
+
+    # Allocate the shards on disk
+    shards = []
+    for shard_idx, start in enumerate(range(0, num_points, shard_size)):
+        count = min(shard_size, num_points - start)
+        filename = f"{params['mode']}_{shard_idx:05d}.npy"
+        shards.append({'file': filename, 'start': start, 'count': count})
+    shard_arrays = [np.lib.format.open_memmap(os.path.join(store_dir, shard['file']), mode='w+', dtype=dtype,
+                                              shape=(shard['count'],) + point_shape)
+                    for shard in shards]
+
+    labels = np.empty(num_points, dtype=np.int64)
+    original_indices = np.empty(num_points, dtype=np.int64)
+
+    # Generate grids batch-wise (in order) and write them to the shards
+    batch_sampler = BatchSampler(SequentialSampler(range(num_points)), batch_size=batch_size, drop_last=False)
+    loader = DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=num_workers)
+
+    position = 0
+    for batch in tqdm(loader, desc="Materializing grids", unit="batch"):
+        if params['mode'] == 'indices':
+            grids, batch_labels, batch_indices = batch
+            grids = grids.numpy()
+        else:
+            small_grids, medium_grids, large_grids, batch_labels, batch_indices = batch
+            grids = torch.stack((small_grids, medium_grids, large_grids), dim=1).numpy()
+        batch_len = grids.shape[0]
+
+        labels[position:position + batch_len] = batch_labels.numpy()
+        original_indices[position:position + batch_len] = np.asarray(batch_indices)
+
+        # a batch can span two shards
+        written = 0
+        while written < batch_len:
+            shard_idx = (position + written) // shard_size
+            offset = (position + written) % shard_size
+            n = min(batch_len - written, shard_size - offset)
+            shard_arrays[shard_idx][offset:offset + n] = grids[written:written + n]
+            written += n
+        position += batch_len
+
+    for shard_array in shard_arrays:
+        shard_array.flush()
+    del shard_arrays
+
+    np.save(os.path.join(store_dir, 'labels.npy'), labels)
+    np.save(os.path.join(store_dir, 'original_indices.npy'), original_indices)
+
+    # the source files must not have changed while the grids were generated
+    manifest = dict(params)
+    for name in ('source', 'subset'):
+        fingerprint = params[name]
+        if fingerprint is not None and file_fingerprint(fingerprint['path']) != fingerprint:
+            raise ValueError(f"File {fingerprint['path']} was modified while the grid store was written: the grids may not match its content.")
+        manifest[f'{name}_hash'] = compute_file_hash(fingerprint['path']) if fingerprint is not None else None
+    manifest.update({'num_points': num_points, 'shard_size': shard_size, 'shards': shards, 'complete': True})
+    with open(os.path.join(store_dir, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Grid store with {num_points} points saved to {store_dir}")
+
+    return store_dir
+
+
+class NeighborIndexDataset(Dataset):
+    def __init__(self, dataset):
+        """
+        Wraps a PointCloudDataset so that it returns the nearest-neighbor index grids of its points instead of the feature grids.
+
+        Args:
+        - dataset (PointCloudDataset): The wrapped dataset.
+        """
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        """
+        Returns the index grids (batch_size, scales, H, W), the labels and the original indices of a batch of points.
+        """
+        indices = np.atleast_1d(np.asarray(indices, dtype=np.int64))
+        index_grids = self.dataset.get_neighbor_index_batch(indices)
+        labels = self.dataset.selected_array[indices, -1].astype(np.int64)
+        original_indices = self.dataset.original_indices[indices]
+
+        return torch.from_numpy(index_grids), torch.from_numpy(labels), torch.from_numpy(original_indices)
+
+
+class NeighborIndexCache:
+    def __init__(self, num_points, index_grid_shape, max_bytes):
+        """
+        In-memory cache of nearest-neighbor index grids, bounded by a byte budget.
+        Points are cached on first access until the budget is exhausted; points that do not fit are recomputed every time.
+        Notice that every DataLoader worker holds its own copy of the cache, filled with the points of the batches it loads: 
+        workers must persist across epochs for their caches to be reused (see create_dataloader), and hits are only guaranteed 
+        when each worker gets the same batches at every epoch (e.g., without shuffling).
+
+        Args:
+        - num_points (int): Number of points of the dataset.
+        - index_grid_shape (tuple): Shape of the index grids of a single point, i.e. (scales, H, W).
+        - max_bytes (int): Maximum number of bytes used to store the index grids.
+        """
+        point_bytes = int(np.prod(index_grid_shape)) * np.dtype(np.int32).itemsize
+        self.capacity = int(min(num_points, max_bytes // point_bytes))
+        self.index_grid_shape = tuple(index_grid_shape)
+
+        self.slots = np.full(num_points, -1, dtype=np.int64)    # slot of each point inside the cache (-1 = not cached)
+        self.index_grids = np.empty((self.capacity,) + self.index_grid_shape, dtype=np.int32)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, indices, compute_fn):
+        """
+        Returns the index grids of the given points, computing (and caching, if there is room) the missing ones.
+
+        Args:
+        - indices (numpy.ndarray): Indices of the points.
+        - compute_fn (callable): Function computing the index grids of an array of point indices.
+
+        Returns:
+        - index_grids (numpy.ndarray): Index grids of shape (len(indices), scales, H, W).
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        slots = self.slots[indices]
+        cached = slots >= 0
+
+        index_grids = np.empty((len(indices),) + self.index_grid_shape, dtype=np.int32)
+        index_grids[cached] = self.index_grids[slots[cached]]
+
+        missing = np.flatnonzero(~cached)
+        self.hits += len(indices) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            index_grids[missing] = compute_fn(indices[missing])
+
+            # store as many of the new index grids as the budget allows
+            missing_points, first_occurrence = np.unique(indices[missing], return_index=True)
+            num_to_store = min(len(missing_points), self.capacity - self.size)
+            if num_to_store > 0:
+                new_slots = np.arange(self.size, self.size + num_to_store)
+                self.index_grids[new_slots] = index_grids[missing[first_occurrence[:num_to_store]]]
+                self.slots[missing_points[:num_to_store]] = new_slots
+                self.size += num_to_store
+
+        return index_grids
+
+
+class GridStoreDataset(Dataset):
+    def __init__(self, store_dir, feature_matrix=None):
+        """
+        Dataset class serving pre-computed multiscale grids from a grid store (see write_grid_store).
+        Shards are memory-mapped, so repeated epochs only cost disk (or page cache) reads.
+        For stores of index grids, features are gathered from the feature matrix at load time, so that the same store can 
+        be used with any feature selection.
+
+        Args:
+        - store_dir (str): Path to the grid store directory (containing manifest.json).
+        - feature_matrix (numpy.ndarray, optional): Selected features of the full point cloud (see build_feature_matrix), needed only for stores of index grids.
+        """
+        manifest_path = os.path.join(store_dir, MANIFEST_FILENAME)
+        if not os.path.exists(manifest_path):
+            raise FileNotFoundError(f"Grid store manifest not found at {manifest_path}")
+
+        with open(manifest_path, 'r') as f:
+            self.manifest = json.load(f)
+
+        self.store_dir = store_dir
+        self.mode = self.manifest.get('mode', 'features')
+        if self.mode == 'indices' and feature_matrix is None:
+            raise ValueError("A feature matrix is needed to read features from a store of index grids.")
+        self.feature_matrix = feature_matrix
+
+        self.shard_size = self.manifest['shard_size']
+        self.window_sizes = [tuple(ws) for ws in self.manifest['window_sizes']]
+        self.features_to_use = self.manifest['features_to_use']
+        self.grid_resolution = self.manifest['grid_resolution']
+
+        # copy-on-write memory maps: nothing is read until accessed, and tensors can be built without copies
+        self.shards = [np.load(os.path.join(store_dir, shard['file']), mmap_mode='c') for shard in self.manifest['shards']]
+        self.labels = np.load(os.path.join(store_dir, 'labels.npy'))
+        self.original_indices = np.load(os.path.join(store_dir, 'original_indices.npy'))
+
+    def __len__(self):
+        return self.manifest['num_points']
+
+    def __getitem__(self, idx):
+        """
+        Returns the stored grids for the point at index `idx` (or for a whole batch, if `idx` is a list of indices),
+        together with the label and the original index, in the same format as PointCloudDataset.
+        """
+        if isinstance(idx, (list, tuple, np.ndarray, torch.Tensor)):
+            return self.get_batch(idx)
+
+        grids = self.shards[idx // self.shard_size][idx % self.shard_size]
+        if self.mode == 'indices':
+            grids = gather_grids_from_neighbor_indices(grids[None], self.feature_matrix)[0]
+        grids = torch.from_numpy(grids).float()     # no copy for float32 stores
+
+        label = torch.tensor(self.labels[idx], dtype=torch.long)
+
+        return grids[0], grids[1], grids[2], label, self.original_indices[idx]
+
+    def get_batch(self, indices):
+        """
+        Reads the stored grids of a batch of points into a single (batch_size, scales, channels, H, W) tensor.
+
+        Args:
+        - indices (list): Indices of the points to be included in the batch.
+
+        Returns:
+        - small_grids, medium_grids, large_grids (torch.Tensor): Views on the batched grids tensor.
+        - labels (torch.Tensor): Labels of the points in the batch.
+        - original_indices (torch.Tensor): Indices of the points in the original data array.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = indices // self.shard_size
+        offsets = indices % self.shard_size
+
+        first_shard = self.shards[0]
+        grids = np.empty((len(indices),) + first_shard.shape[1:], dtype=first_shard.dtype)
+        for shard_id in np.unique(shard_ids):
+            in_shard = shard_ids == shard_id
+            grids[in_shard] = self.shards[shard_id][offsets[in_shard]]
+
+        if self.mode == 'indices':
+            grids = gather_grids_from_neighbor_indices(grids, self.feature_matrix)
+        grids = torch.from_numpy(grids).float()
+        labels = torch.from_numpy(self.labels[indices])
+        original_indices = torch.from_numpy(self.original_indices[indices])
+
+        return grids[:, 0], grids[:, 1], grids[:, 2], labels, original_indices
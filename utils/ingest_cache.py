@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+
+INGEST_SCHEMA_FILENAME = 'schema.json'
+INGEST_DATA_FILENAME = 'data.npy'
+INGEST_LAYOUT = 'column_major'      # part of the key: copies saved with another layout are ingested again
+
+# Hits, misses and times of the ingest cache, collected over the whole run (see load_or_ingest_columns)
+INGEST_CACHE_STATS = {'hits': 0, 'misses': 0, 'load_time': 0.0, 'ingest_time': 0.0}
+
+
+def ingest_cache_key(file_path, features_to_use=None):
+    """
+    Computes the key of the ingested copy of a source file from its absolute path, modification time and size,
+    so that a modified (or replaced) source file is ingested again.
+
+    Args:
+    - file_path (str): Path to the source file (e.g., .las or .csv file).
+    - features_to_use (list, optional): Features extracted from the file (None for all of them). Default is None.
+
+    Returns:
+    - key (str): Hexadecimal key identifying the ingested copy.
+    """
+    file_stat = os.stat(file_path)
+    params = {
+        'path': os.path.abspath(file_path),
+        'mtime_ns': file_stat.st_mtime_ns,
+        'size': file_stat.st_size,
+        'features_to_use': list(features_to_use) if features_to_use is not None else None,
+        'layout': INGEST_LAYOUT,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def write_ingested_columns(data_array, feature_names, ingest_dir, schema):
+    """
+    Saves the data array in a column-major (Fortran-ordered) .npy file, so that each column is contiguous on disk, 
+    together with a schema sidecar listing the columns.
+    Files are written into a temporary directory first, so that concurrent or interrupted runs never leave a partial copy.
+
+    Args:
+    - data_array (numpy.ndarray): The data array read from the source file.
+    - feature_names (list): Names of the columns of the data array.
+    - ingest_dir (str): Directory of the ingested copy.
+    - schema (dict): Description of the source file, saved in the schema sidecar.
+    """
+    tmp_dir = f"{ingest_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    ingested_array = np.lib.format.open_memmap(os.path.join(tmp_dir, INGEST_DATA_FILENAME), mode='w+', dtype=data_array.dtype, 
+                                               shape=data_array.shape, fortran_order=True)
+    for column_index in range(len(feature_names)):
+        ingested_array[:, column_index] = data_array[:, column_index]
+    ingested_array.flush()
+    del ingested_array
+
+    columns = [{'name': feature, 'dtype': str(data_array.dtype)} for feature in feature_names]
+    schema = dict(schema, num_points=int(data_array.shape[0]), file=INGEST_DATA_FILENAME, columns=columns)
+    with open(os.path.join(tmp_dir, INGEST_SCHEMA_FILENAME), 'w') as f:
+        json.dump(schema, f, indent=4)
+
+    try:
+        os.rename(tmp_dir, ingest_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)  # another run ingested the same file in the meantime
+
+
+def open_ingested_copy(file_path, cache_dir, reader, features_to_use=None, mmap_mode='r'):
+    """
+    Memory-maps the ingested copy of a source file, ingesting the file first if needed (i.e., reading it once with 
+    the given reader and saving it with write_ingested_columns).
+    Memory-mapped copies are backed by the page cache, so processes opening the same copy share its memory.
+
+    Args:
+    - file_path (str): Path to the source file (e.g., .las or .csv file).
+    - cache_dir (str): Root directory of the ingested copies.
+    - reader (callable): Function reading the source file, called as reader(file_path, features_to_use) and returning (data_array, feature_names).
+    - features_to_use (list, optional): Features extracted from the file (None for all of them). Default is None.
+    - mmap_mode (str): Mode of the memory map (see numpy.load): 'r' for a read-only copy, 'c' for a copy-on-write one. Default is 'r'.
+
+    Returns:
+    - data_array (numpy.memmap): The memory-mapped (num_points, num_features) array (None if the file could not be read).
+    - feature_names (list): Names of the columns of the data array.
+    """
+    key = ingest_cache_key(file_path, features_to_use=features_to_use)
+    ingest_dir = os.path.join(cache_dir, key)
+    schema_path = os.path.join(ingest_dir, INGEST_SCHEMA_FILENAME)
+
+    if not os.path.exists(schema_path):
+        start_time = time.time()
+        result = reader(file_path, features_to_use)
+        if result is None:
+            return None, None
+        data_array, feature_names = result
+        os.makedirs(cache_dir, exist_ok=True)
+        write_ingested_columns(data_array, feature_names, ingest_dir, schema={'source': os.path.abspath(file_path),
+                                                                              'features_to_use': features_to_use})
+        ingest_time = time.time() - start_time
+
+        INGEST_CACHE_STATS['misses'] += 1
+        INGEST_CACHE_STATS['ingest_time'] += ingest_time
+        print(f"Ingested {file_path} into {ingest_dir} in {ingest_time:.2f} s")
+    else:
+        INGEST_CACHE_STATS['hits'] += 1
+
+    start_time = time.time()
+    with open(schema_path, 'r') as f:
+        schema = json.load(f)
+    feature_names = [column['name'] for column in schema['columns']]
+    data_array = np.load(os.path.join(ingest_dir, schema['file']), mmap_mode=mmap_mode)
+    INGEST_CACHE_STATS['load_time'] += time.time() - start_time
+
+    return data_array, feature_names
+
+
+def load_or_ingest_columns(file_path, cache_dir, reader, features_to_use=None, columns=None):
+    """
+    Opens the columns of the ingested copy of a source file as read-only memory maps, ingesting the file first if needed (see open_ingested_copy).
+
+    Args:
+    - file_path (str): Path to the source file (e.g., .las or .csv file).
+    - cache_dir (str): Root directory of the ingested copies.
+    - reader (callable): Function reading the source file, called as reader(file_path, features_to_use) and returning (data_array, feature_names).
+    - features_to_use (list, optional): Features extracted from the file (None for all of them). Default is None.
+    - columns (list, optional): Names of the columns to open. If None, all columns are opened. Default is None.
+
+    Returns:
+    - columns (dict): Dictionary of {column name: memory-mapped column}, in the order of the source file (None if the file could not be read).
+    - feature_names (list): Names of all the columns of the ingested copy.
+    """
+    data_array, feature_names = open_ingested_copy(file_path, cache_dir, reader, features_to_use=features_to_use)
+    if data_array is None:
+        return None, None
+
+    if columns is not None:
+        missing_columns = [column for column in columns if column not in feature_names]
+        if missing_columns:
+            raise ValueError(f"Columns {missing_columns} are not available in the ingested copy of {file_path}. Available columns: {feature_names}")
+
+    # columns of the column-major copy are contiguous views on its memory map
+    loaded_columns = {feature: data_array[:, column_index] for column_index, feature in enumerate(feature_names)
+                      if columns is None or feature in columns}
+
+    return loaded_columns, feature_names
+
+
+def load_or_ingest_file(file_path, cache_dir, reader, features_to_use=None):
+    """
+    Loads the data array of a source file from its ingested copy (see open_ingested_copy), without parsing the source file again.
+    The array is a copy-on-write memory map of the ingested copy: it is not copied into memory, and pages are only made private 
+    to the process when they are modified (e.g., when labels are remapped).
+
+    Args:
+    - file_path (str): Path to the source file (e.g., .las or .csv file).
+    - cache_dir (str): Root directory of the ingested copies.
+    - reader (callable): Function reading the source file, called as reader(file_path, features_to_use) and returning (data_array, feature_names).
+    - features_to_use (list, optional): Features extracted from the file (None for all of them). Default is None.
+
+    Returns:
+    - data_array (numpy.memmap): The data array (None if the file could not be read).
+    - feature_names (list): Names of the columns of the data array.
+    """
+    start_time = time.time()
+    data_array, feature_names = open_ingested_copy(file_path, cache_dir, reader=reader, features_to_use=features_to_use, mmap_mode='c')
+    if data_array is None:
+        return None
+
+    print(f"Loaded {file_path} from its ingested copy in {time.time() - start_time:.2f} s "
+          f"[hits: {INGEST_CACHE_STATS['hits']}, misses: {INGEST_CACHE_STATS['misses']}]")
+
+    return data_array, feature_names
@@ -0,0 +1,166 @@
+import os
+import laspy
+
+
+LAS_EXTENSIONS = ('.las', '.laz')
+
+
+def is_las_file(file_path):
+    """
+    Checks whether a file is a point cloud in LAS format, either uncompressed (.las) or compressed (.laz).
+
+    Args:
+    - file_path (str): Path to the file.
+
+    Returns:
+    - is_las (bool): True if the file has a .las or .laz extension.
+    """
+    return file_path.lower().endswith(LAS_EXTENSIONS)
+
+
+def las_extension(compress=False):
+    """
+    Returns the extension of the LAS files written by the pipeline (e.g., subtiles and predictions).
+
+    Args:
+    - compress (bool): Whether the files are compressed (LAZ). Default is False.
+
+    Returns:
+    - extension (str): '.laz' if compress is True, '.las' otherwise.
+    """
+    return '.laz' if compress else '.las'
+
+
+def set_laz_threads(laz_threads):
+    """
+    Sets the number of threads of the pool (shared by the whole process) that decompresses and compresses the chunks of LAZ files.
+    The pool is created on the first LAZ read or write of the process, so this must be called once, at startup (e.g., in main.py), 
+    to have an effect. Child processes inherit the setting.
+
+    Args:
+    - laz_threads (int, optional): Number of threads. If None, the pool uses all available cores.
+    """
+    if laz_threads is None:
+        return
+    if laz_threads < 1:
+        raise ValueError(f"laz_threads must be a positive integer, got {laz_threads}.")
+    os.environ['RAYON_NUM_THREADS'] = str(laz_threads)   # size of the lazrs (rayon) thread pool
+
+
+def laz_backend(laz_threads=None):
+    """
+    Selects the laspy backend used to decompress and compress LAZ files.
+    With the lazrs backend, the chunks of a LAZ file are (de)compressed in parallel by the thread pool of the process, whose size 
+    is set once at startup (see set_laz_threads). This function has no side effects.
+
+    Args:
+    - laz_threads (int, optional): Number of threads used for LAZ (de)compression. If 1, chunks are (de)compressed sequentially, 
+                                   otherwise in parallel by the thread pool of the process. Default is None.
+
+    Returns:
+    - backend (laspy.LazBackend): The backend to pass to laspy (None to let laspy pick any installed backend).
+    """
+    if laz_threads is not None and laz_threads < 1:
+        raise ValueError(f"laz_threads must be a positive integer, got {laz_threads}.")
+
+    available_backends = laspy.LazBackend.detect_available()
+    for backend in ((laspy.LazBackend.Lazrs,) if laz_threads == 1 else (laspy.LazBackend.LazrsParallel, laspy.LazBackend.Lazrs)):
+        if backend in available_backends:
+            return backend
+    return None
+
+
+def open_las(file_path, laz_threads=None):
+    """
+    Opens a .las or .laz file for streaming reads (see laspy.open), decompressing LAZ files with laz_threads threads.
+
+    Args:
+    - file_path (str): Path to the .las or .laz file.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression (see laz_backend). Default is None.
+
+    Returns:
+    - las_reader (laspy.LasReader): The reader of the file.
+    """
+    return laspy.open(file_path, laz_backend=laz_backend(laz_threads))
+
+
+def read_las(file_path, laz_threads=None):
+    """
+    Reads a whole .las or .laz file (see laspy.read), decompressing LAZ files with laz_threads threads.
+
+    Args:
+    - file_path (str): Path to the .las or .laz file.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression (see laz_backend). Default is None.
+
+    Returns:
+    - las_data (laspy.LasData): The points and header of the file.
+    """
+    return laspy.read(file_path, laz_backend=laz_backend(laz_threads))
+
+
+def write_las(las_data, file_path, laz_threads=None):
+    """
+    Writes a LasData object to a .las or .laz file, compressing it if the extension is .laz.
+
+    Args:
+    - las_data (laspy.LasData): The points and header to write.
+    - file_path (str): Path to the output file, whose extension sets whether it is compressed.
+    - laz_threads (int, optional): Number of threads used for LAZ compression (see laz_backend). Default is None.
+    """
+    if not is_las_file(file_path):
+        raise ValueError(f"Unsupported point cloud format for {file_path}. Please provide a .las or .laz file.")
+    compress = file_path.lower().endswith('.laz')
+    las_data.write(file_path, do_compress=compress, laz_backend=laz_backend(laz_threads) if compress else None)
+
+
+def concatenate_las(input_files, output_file, header=None, point_filter=None, chunk_size=1000000, laz_threads=None):
+    """
+    Concatenates the points of LAS (or LAZ) files into a single file, streaming them chunk by chunk: only one chunk of points
+    is held in memory at a time, whatever the size of the files.
+    Point records are copied as raw buffers, so every dimension (including extra bytes dimensions) is kept, for any point format.
+    Chunks are only converted when they do not match the output: coordinates are rescaled if the scales or offsets differ, 
+    and dimensions are copied by name if the point format differs (dimensions missing from an input are zero).
+
+    Args:
+    - input_files (list): Paths to the input .las or .laz files, concatenated in this order.
+    - output_file (str): Path to the output file, whose extension sets whether it is compressed.
+    - header (laspy.LasHeader, optional): Header of the output file (point format, version, scales and offsets). 
+                                          If None, the header of the first input file is used. Default is None.
+    - point_filter (callable, optional): Function (points, header) -> boolean mask selecting the points of a chunk to keep, 
+                                         where header is the header of the input file of the chunk. If None, all points are kept. Default is None.
+    - chunk_size (int): Number of points read at a time. Default is 1000000.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression (see laz_backend). Default is None.
+
+    Returns:
+    - num_points (int): Number of points written to the output file.
+    """
+    if not input_files:
+        raise ValueError("No input files to concatenate.")
+    if not is_las_file(output_file):
+        raise ValueError(f"Unsupported point cloud format for {output_file}. Please provide a .las or .laz file.")
+
+    if header is None:
+        with open_las(input_files[0], laz_threads=laz_threads) as las_reader:
+            header = las_reader.header
+    output_header = laspy.LasHeader(point_format=header.point_format, version=header.version)
+    output_header.offsets = header.offsets
+    output_header.scales = header.scales
+
+    compress = output_file.lower().endswith('.laz')
+    with laspy.open(output_file, mode='w', header=output_header, do_compress=compress, 
+                    laz_backend=laz_backend(laz_threads) if compress else None) as las_writer:
+        for input_file in input_files:
+            with open_las(input_file, laz_threads=laz_threads) as las_reader:
+                same_format = las_reader.header.point_format == output_header.point_format
+                for points in las_reader.chunk_iterator(chunk_size):
+                    if point_filter is not None:
+                        points = points[point_filter(points, las_reader.header)]
+                    if not same_format:
+                        converted = laspy.ScaleAwarePointRecord.zeros(len(points), header=output_header)
+                        converted.copy_fields_from(points)
+                        converted.x, converted.y, converted.z = points.x, points.y, points.z
+                        points = converted
+                    las_writer.write_points(points)     # rescaled by the writer if scales or offsets differ
+        num_points = las_writer.header.point_count
+
+    return num_points
@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class KDTreeIndex:
+    def __init__(self, points, leafsize=16):
+        """
+        Nearest-neighbor index backed by scipy's cKDTree.
+
+        Args:
+        - points (numpy.ndarray): Array of shape (num_points, 3) with the coordinates of the indexed points.
+        - leafsize (int): Leaf size of the KDTree. Default is 16.
+        """
+        self.tree = cKDTree(points, leafsize=leafsize)
+        self.n = self.tree.n
+
+    def query(self, points, distance_upper_bound=np.inf):
+        """
+        Finds the nearest indexed point of each query point.
+
+        Args:
+        - points (numpy.ndarray): Array of shape (num_queries, 3) with the query coordinates.
+        - distance_upper_bound (float): Only neighbors within this distance are returned. Default is infinity.
+
+        Returns:
+        - distances (numpy.ndarray): Distance to the nearest point (inf if there is none within the bound).
+        - indices (numpy.ndarray): Index of the nearest point (self.n if there is none within the bound).
+        """
+        return self.tree.query(points, distance_upper_bound=distance_upper_bound)
+
+
+class VoxelHashIndex:
+    def __init__(self, points, cell_size=None, points_per_cell=2.0, chunk_size=65536, max_table_size=2**26):
+        """
+        Exact nearest-neighbor index over a uniform grid of cubic voxels, stored as a sorted array of voxel keys (a voxel hash).
+        Queries look at the voxels in shells of increasing (Chebyshev) distance around the query voxel, fully vectorized
+        over the queries, until no unexplored voxel can contain a closer point.
+        When the voxel grid is small enough, voxels are looked up in a dense table instead of by binary search over the keys.
+
+        Args:
+        - points (numpy.ndarray): Array of shape (num_points, 3) with the coordinates of the indexed points.
+        - cell_size (float, optional): Edge of the voxels. If None, it is tuned to the point density so that each voxel holds
+                                       about points_per_cell points (using the planimetric density for flat point clouds).
+        - points_per_cell (float): Target number of points per voxel when cell_size is None. Default is 2.
+        - chunk_size (int): Number of queries processed at a time, to bound memory usage. Default is 65536.
+        - max_table_size (int): Maximum number of voxels for which the dense lookup table is used. Default is 2^26.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 3 or points.shape[0] == 0:
+            raise ValueError("VoxelHashIndex needs a non-empty array of 3D points.")
+
+        self.points = points
+        self.n = points.shape[0]
+        self.chunk_size = chunk_size
+
+        self.min_corner = points.min(axis=0)
+        extent = points.max(axis=0) - self.min_corner
+        if cell_size is None:
+            area = max(extent[0] * extent[1], np.finfo(np.float64).tiny)
+            cell_size = np.cbrt(points_per_cell * area * extent[2] / self.n)
+            if extent[2] < cell_size:
+                cell_size = np.sqrt(points_per_cell * area / self.n)   # flat point cloud: a single layer of voxels
+        if not cell_size > 0:
+            cell_size = 1.0     # all points coincide
+        self.cell_size = float(cell_size)
+
+        voxels = np.floor((points - self.min_corner) / self.cell_size).astype(np.int64)
+        self.dims = voxels.max(axis=0) + 1
+        if np.prod(self.dims.astype(np.float64)) >= np.iinfo(np.int64).max:
+            raise ValueError(f"Too many voxels for a cell size of {self.cell_size}: use a larger cell size.")
+
+        # sort points by voxel key, and keep where each (non-empty) voxel starts in the sorted order
+        keys = self._keys(voxels)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_points = points[self.order]
+        self.voxel_keys, self.voxel_starts, self.voxel_counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+
+        self.voxel_table = None
+        if np.prod(self.dims) <= max_table_size:
+            self.voxel_table = np.full(np.prod(self.dims), -1, dtype=np.int64)
+            self.voxel_table[self.voxel_keys] = np.arange(len(self.voxel_keys))
+
+        self._shells = {}
+
+    def _keys(self, voxels):
+        return (voxels[:, 0] * self.dims[1] + voxels[:, 1]) * self.dims[2] + voxels[:, 2]
+
+    def _shell(self, ring):
+        # voxel offsets at Chebyshev distance `ring` from the origin
+        if ring not in self._shells:
+            axis = np.arange(-ring, ring + 1)
+            offsets = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+            self._shells[ring] = offsets[np.abs(offsets).max(axis=1) == ring]
+        return self._shells[ring]
+
+    def query(self, points, distance_upper_bound=np.inf):
+        """
+        Finds the nearest indexed point of each query point (same conventions as cKDTree.query with k=1).
+
+        Args:
+        - points (numpy.ndarray): Array of shape (num_queries, 3) with the query coordinates.
+        - distance_upper_bound (float): Only neighbors within this distance are returned. Default is infinity.
+
+        Returns:
+        - distances (numpy.ndarray): Distance to the nearest point (inf if there is none within the bound).
+        - indices (numpy.ndarray): Index of the nearest point (self.n if there is none within the bound).
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        distances = np.full(points.shape[0], np.inf)
+        indices = np.full(points.shape[0], self.n, dtype=np.int64)
+
+        for start in range(0, points.shape[0], self.chunk_size):
+            stop = min(start + self.chunk_size, points.shape[0])
+            distances[start:stop], indices[start:stop] = self._query_chunk(points[start:stop], distance_upper_bound)
+
+        return distances, indices
+
+    def _query_chunk(self, points, distance_upper_bound):
+        num_queries = points.shape[0]
+        best_sq = np.full(num_queries, np.inf)
+        best_idx = np.full(num_queries, self.n, dtype=np.int64)
+
+        relative = (points - self.min_corner) / self.cell_size
+        query_voxels = np.floor(relative).astype(np.int64)
+        # distance (in cells) from each query to the closest face of its own voxel
+        face_gap = np.min(np.minimum(relative - query_voxels, query_voxels + 1 - relative), axis=1)
+
+        # rings closer than the voxel grid are empty, rings farther than its opposite corner are never needed
+        outside = np.maximum(-query_voxels, query_voxels - (self.dims - 1))
+        ring = np.maximum(outside.max(axis=1), 0)
+        last_ring = np.maximum(np.abs(query_voxels), np.abs(query_voxels - (self.dims - 1))).max(axis=1)
+
+        bound_sq = distance_upper_bound**2
+        active = np.arange(num_queries)
+        while active.size > 0:
+            for r in np.unique(ring[active]):
+                queries = active[ring[active] == r]
+                self._search_shell(points, query_voxels, queries, self._shell(int(r)), best_sq, best_idx)
+
+            # a query is done when no point in the next rings can be closer than the best one (or within the bound)
+            lower_bound_sq = ((ring[active] + face_gap[active]) * self.cell_size)**2
+            done = (best_sq[active] <= lower_bound_sq) | (lower_bound_sq > bound_sq) | (ring[active] >= last_ring[active])
+            ring[active] += 1
+            active = active[~done]
+
+        found = best_sq <= bound_sq
+        distances = np.where(found, np.sqrt(best_sq), np.inf)
+        indices = np.where(found, self.order[np.minimum(best_idx, self.n - 1)], self.n)
+
+        return distances, indices
+
+    def _search_shell(self, points, query_voxels, queries, offsets, best_sq, best_idx):
+        # candidate voxels of every (query, offset) pair, query-major
+        voxels = (query_voxels[queries, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        pair_queries = np.repeat(queries, offsets.shape[0])
+
+        inside = np.all((voxels >= 0) & (voxels < self.dims), axis=1)
+        voxels, pair_queries = voxels[inside], pair_queries[inside]
+
+        keys = self._keys(voxels)
+        if self.voxel_table is not None:
+            slots = self.voxel_table[keys]
+            occupied = slots >= 0
+        else:
+            slots = np.minimum(np.searchsorted(self.voxel_keys, keys), len(self.voxel_keys) - 1)
+            occupied = self.voxel_keys[slots] == keys
+        slots, pair_queries = slots[occupied], pair_queries[occupied]
+        if slots.size == 0:
+            return
+
+        # expand every pair into its candidate points
+        counts = self.voxel_counts[slots]
+        candidate_queries = np.repeat(pair_queries, counts)
+        pair_offsets = np.cumsum(counts) - counts
+        candidates = np.repeat(self.voxel_starts[slots] - pair_offsets, counts) + np.arange(counts.sum())
+
+        diff = self.sorted_points[candidates] - points[candidate_queries]
+        dist_sq = np.einsum('ij,ij->i', diff, diff)
+
+        # keep the closest candidate of each query (candidate_queries is sorted, as pairs are query-major)
+        segment_starts = np.flatnonzero(np.r_[True, candidate_queries[1:] != candidate_queries[:-1]])
+        segment_min = np.minimum.reduceat(dist_sq, segment_starts)
+        segment_queries = candidate_queries[segment_starts]
+        min_positions = np.flatnonzero(dist_sq == np.repeat(segment_min, np.diff(np.r_[segment_starts, len(dist_sq)])))
+        min_queries = candidate_queries[min_positions]
+        first_min = np.r_[True, min_queries[1:] != min_queries[:-1]]     # first closest candidate, on ties
+        min_candidates = candidates[min_positions[first_min]]
+
+        improved = segment_min < best_sq[segment_queries]
+        best_sq[segment_queries[improved]] = segment_min[improved]
+        best_idx[segment_queries[improved]] = min_candidates[improved]
+
+
+NEIGHBOR_INDEX_CACHE_STATS = {'hits': 0, 'misses': 0, 'load_time': 0.0, 'build_time': 0.0}
+
+
+NEIGHBOR_INDEX_BACKENDS = {
+    'kdtree': KDTreeIndex,
+    'voxel_hash': VoxelHashIndex,
+}
+
+
+def build_neighbor_index(points, backend='kdtree', **kwargs):
+    """
+    Builds a nearest-neighbor index over the given points with the chosen backend.
+    Every backend exposes the number of indexed points as `n` and a cKDTree-like `query(points, distance_upper_bound)`.
+
+    Args:
+    - points (numpy.ndarray): Array of shape (num_points, 3) with the coordinates of the indexed points.
+    - backend (str): 'kdtree' (scipy cKDTree) or 'voxel_hash' (uniform voxel grid). Default is 'kdtree'.
+    - **kwargs: Additional arguments passed to the backend (e.g., leafsize, cell_size).
+
+    Returns:
+    - index (KDTreeIndex or VoxelHashIndex): The nearest-neighbor index.
+    """
+    if backend not in NEIGHBOR_INDEX_BACKENDS:
+        raise ValueError(f"Unknown neighbor index backend '{backend}'. Choose among {list(NEIGHBOR_INDEX_BACKENDS)}.")
+
+    return NEIGHBOR_INDEX_BACKENDS[backend](points, **kwargs)
+
+
+def neighbor_index_cache_key(points, backend='kdtree', **kwargs):
+    """
+    Computes the key identifying a neighbor index: a hash of the content of the coordinate array, of the backend and of its parameters.
+
+    Args:
+    - points (numpy.ndarray): Array of shape (num_points, 3) with the coordinates of the indexed points.
+    - backend (str): Neighbor index backend. Default is 'kdtree'.
+    - **kwargs: Parameters of the backend.
+
+    Returns:
+    - key (str): Hexadecimal key of the index.
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    sha = hashlib.sha256()
+    sha.update(json.dumps({'backend': backend, 'shape': points.shape, 'params': kwargs}, sort_keys=True, default=str).encode())
+    sha.update(memoryview(points).cast('B'))
+    return sha.hexdigest()[:32]
+
+
+def load_or_build_neighbor_index(points, backend='kdtree', cache_dir=None, **kwargs):
+    """
+    Loads a neighbor index from the cache directory if one was built on the same coordinates with the same parameters,
+    otherwise builds it (and saves it in the cache directory).
+    Indices are pickled with their arrays stored out-of-band in .npy files, which are memory-mapped when loading,
+    so a cached index is loaded in a fraction of the time needed to build it. Hits, misses and times are collected in 
+    NEIGHBOR_INDEX_CACHE_STATS. Notice that the cache is trusted: only point cache_dir to directories written by this code.
+
+    Args:
+    - points (numpy.ndarray): Array of shape (num_points, 3) with the coordinates of the indexed points.
+    - backend (str): 'kdtree' or 'voxel_hash' (see build_neighbor_index). Default is 'kdtree'.
+    - cache_dir (str, optional): Directory of the cached indices. If None, the index is always built and nothing is saved.
+    - **kwargs: Additional arguments passed to the backend.
+
+    Returns:
+    - index (KDTreeIndex or VoxelHashIndex): The nearest-neighbor index.
+    """
+    if cache_dir is None:
+        return build_neighbor_index(points, backend=backend, **kwargs)
+
+    key = neighbor_index_cache_key(points, backend=backend, **kwargs)
+    index_dir = os.path.join(cache_dir, key)
+    meta_path = os.path.join(index_dir, 'index.pkl')
+
+    if os.path.exists(meta_path):
+        start_time = time.time()
+        with open(meta_path, 'rb') as f:
+            num_buffers, meta = pickle.load(f)
+        buffers = [np.load(os.path.join(index_dir, f"buffer_{i:02d}.npy"), mmap_mode='r') for i in range(num_buffers)]
+        index = pickle.loads(meta, buffers=buffers)
+        load_time = time.time() - start_time
+
+        NEIGHBOR_INDEX_CACHE_STATS['hits'] += 1
+        NEIGHBOR_INDEX_CACHE_STATS['load_time'] += load_time
+        print(f"Neighbor index cache hit ({backend}, {len(points)} points): loaded in {load_time:.2f} s "
+              f"[hits: {NEIGHBOR_INDEX_CACHE_STATS['hits']}, misses: {NEIGHBOR_INDEX_CACHE_STATS['misses']}]")
+        return index
+
+    start_time = time.time()
+    index = build_neighbor_index(points, backend=backend, **kwargs)
+    build_time = time.time() - start_time
+
+    NEIGHBOR_INDEX_CACHE_STATS['misses'] += 1
+    NEIGHBOR_INDEX_CACHE_STATS['build_time'] += build_time
+    print(f"Neighbor index cache miss ({backend}, {len(points)} points): built in {build_time:.2f} s "
+          f"[hits: {NEIGHBOR_INDEX_CACHE_STATS['hits']}, misses: {NEIGHBOR_INDEX_CACHE_STATS['misses']}]")
+
+    # write into a temporary directory first, so that concurrent or interrupted runs never leave a partial index
+    buffers = []
+    meta = pickle.dumps(index, protocol=5, buffer_callback=buffers.append)
+    tmp_dir = f"{index_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for i, buffer in enumerate(buffers):
+        np.save(os.path.join(tmp_dir, f"buffer_{i:02d}.npy"), np.frombuffer(buffer.raw(), dtype=np.uint8))
+    with open(os.path.join(tmp_dir, 'index.pkl'), 'wb') as f:
+        pickle.dump((len(buffers), meta), f)
+    try:
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)  # another run saved the same index in the meantime
+
+    return index
@@ -5,8 +5,12 @@ import os
 from tqdm import tqdm
 import csv
 from datetime import datetime
-import random
-from scipy.spatial import cKDTree
+from utils.neighbor_index import load_or_build_neighbor_index
+from utils.ingest_cache import load_or_ingest_file, load_or_ingest_columns
+from utils.table_io import read_table, read_table_columns, iter_table_chunks, TableWriter, write_table
+from utils.las_io import is_las_file, las_extension, open_las, read_las, write_las, concatenate_las
+from utils.point_matching import PointKeyIndex
+from utils.sampling import RandomKeyReservoir
 
 
 #============================================== FILE READING AND NP CONVERSIONS ================================================
@@ -21,7 +25,7 @@ def load_las_data(file_path):
     Returns:
     - np.ndarray: Coordinate XYZ dei punti.
     """
-    las = laspy.read(file_path)
+    las = read_las(file_path)
     points = np.vstack((las.x, las.y, las.z)).transpose()
     return points
 
@@ -40,58 +44,86 @@ def load_asc_data(file_path):
     return dtm_data
 
 
-def read_las_file_to_numpy(file_path, features_to_extract=None):
+def read_las_file_to_numpy(file_path, features_to_extract=None, chunk_size=1000000, max_points=None, out_file=None, dtype=np.float64, laz_threads=None):
     """
-    Reads a LAS file, extracts coordinate data (x, y, z), specific features and labels,
+    Reads a LAS (or LAZ) file, extracts coordinate data (x, y, z), specific features and labels,
     and returns them as a numpy array.
+    The file is streamed in chunks of points (laspy.open(...).chunk_iterator): only the requested dimensions of each chunk are 
+    decoded, and they are written straight into a single preallocated array (or a memory-mapped .npy file), so that the peak 
+    memory is bounded by the size of the output plus one chunk. The compressed chunks of LAZ files are decompressed in parallel.
 
     Parameters:
-    - file_path (str): The path to the LAS file.
+    - file_path (str): The path to the .las or .laz file.
     - features_to_extract (list): List of features to extract from the LAS file.
                                   If None, all available features except 'x', 'y', 'z' will be selected.
                                   Notice that 'segment_id', and 'label' are always included in the extracted features. 
+    - chunk_size (int): Number of points decoded at a time. Default is 1000000.
+    - max_points (int, optional): If set, reading stops after the first max_points points (e.g., for sampling). Default is None.
+    - out_file (str, optional): Path of a .npy file the output is written to and memory-mapped from, for files larger than RAM. Default is None.
+    - dtype (numpy.dtype): Data type of the output array. Default is float64.
+    - laz_threads (int, optional): Number of threads used to decompress LAZ files (see utils/las_io.py). If None, all cores are used. Default is None.
 
     Returns:
     - np.ndarray: A numpy array containing the extracted data from the LAS file.
     - feature_names (list of str): List of feature names corresponding to the columns in the array.
     """
-    # Read the LAS file
     # print(f"Processing {file_path}...")
-    las_data = laspy.read(file_path)
+    with open_las(file_path, laz_threads=laz_threads) as las_reader:
+        dimension_names = list(las_reader.header.point_format.dimension_names)
+        num_points = las_reader.header.point_count if max_points is None else min(las_reader.header.point_count, max_points)
 
-    # Initialize a list to store the features and their names
-    data = []
-    feature_names = ['x', 'y', 'z']  # Always include coordinates
-
-    # Check if x, y, z coordinates are present
-    if hasattr(las_data, 'x') and hasattr(las_data, 'y') and hasattr(las_data, 'z'):
-        if len(las_data.x) > 0 and len(las_data.y) > 0 and len(las_data.z) > 0:
-            # Add x, y, z as the first columns
-            data.append(las_data.x)
-            data.append(las_data.y)
-            data.append(las_data.z)
-        else:
+        # Check if x, y, z coordinates are present
+        if num_points == 0:
             print(f"Warning: One of the coordinate arrays (x, y, z) is empty in {file_path}.")
             return None
-    else:
-        print(f"Warning: LAS data in {file_path} does not have 'x', 'y', or 'z' attributes.")
-        return None
+
+        feature_names = select_las_features(dimension_names, features_to_extract)
+
+        # Preallocate the output, of shape (N, num_features)
+        shape = (num_points, len(feature_names))
+        if out_file is not None:
+            data_array = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=shape)
+        else:
+            data_array = np.empty(shape, dtype=dtype)
+
+        start = 0
+        for points in las_reader.chunk_iterator(chunk_size):
+            stop = min(start + len(points), num_points)
+            for column, feature in enumerate(feature_names):
+                # x, y, z are decoded (scaled) chunk by chunk, other dimensions are views on the chunk records
+                data_array[start:stop, column] = points[feature][:stop - start]
+            start = stop
+            if start >= num_points:
+                break   # early stop: the rest of the file is never decoded
+
+    if out_file is not None:
+        data_array.flush()
+    # print(f"Loaded NumPy array with shape: {data_array.shape}")
+
+    return data_array, feature_names
+
+
+def select_las_features(dimension_names, features_to_extract=None):
+    """
+    Selects the columns extracted from a LAS (or LAZ) point cloud: coordinates (x, y, z), the requested features, 
+    and 'segment_id' and 'label' if the point cloud has them.
+
+    Args:
+    - dimension_names (list): Names of the dimensions of the point format of the point cloud.
+    - features_to_extract (list): List of features to extract. If None, all available features except 'x', 'y', 'z' will be selected.
+
+    Returns:
+    - feature_names (list of str): List of the names of the extracted columns.
+    """
+    feature_names = ['x', 'y', 'z']  # Always include coordinates
 
     # If features_to_extract is None, select all available features except 'x', 'y', 'z', 'label', and 'segment_id'
     if features_to_extract is None:
-        features_to_extract = [dim for dim in las_data.point_format.dimension_names if dim not in ['x', 'y', 'z', 'label', 'segment_id']]
-
-    # Extract additional features
-    available_features = []
-    missing_features = []
-    for feature in features_to_extract:
-        if feature in ['x', 'y', 'z']:
-            continue  # Skip if feature is x, y, or z since they are already added
-        if feature in las_data.point_format.dimension_names:
-            data.append(las_data[feature])
-            available_features.append(feature)
-        else:
-            missing_features.append(feature)
+        features_to_extract = [dim for dim in dimension_names if dim not in ['x', 'y', 'z', 'label', 'segment_id']]
+
+    # Extract additional features (x, y, z are already added)
+    available_features = [feature for feature in features_to_extract if feature not in ['x', 'y', 'z'] and feature in dimension_names]
+    missing_features = [feature for feature in features_to_extract if feature not in ['x', 'y', 'z'] and feature not in dimension_names]
 
     # Warn if any requested features are missing
     if missing_features:
@@ -99,87 +131,97 @@ def read_las_file_to_numpy(file_path, features_to_extract=None):
 
     # Add selected features to feature_names
     feature_names += available_features
-    
+
     # Check for segment_id 
-    if 'segment_id' in las_data.point_format.dimension_names:
-        data.append(las_data['segment_id'])
+    if 'segment_id' in dimension_names:
         feature_names.append('segment_id')
 
     # Check for label field
-    if 'label' in las_data.point_format.dimension_names:
-        data.append(las_data['label'])
+    if 'label' in dimension_names:
         feature_names.append('label')
     else:
         print('***The LAS data does not contain a label column, which is needed for training. If you are training, choose a different file, with labels.***')
 
-    # Convert the data list to a numpy array and transpose to match the expected shape (N, num_features)
-    data_array = np.vstack(data).T
-    # print(f"Loaded NumPy array with shape: {data_array.shape}")
+    return feature_names
+
+
+def las_data_to_numpy(las_data, features_to_extract=None, dtype=np.float64):
+    """
+    Converts a LAS (or LAZ) point cloud already loaded in memory into a numpy array, with the same columns as read_las_file_to_numpy.
+
+    Args:
+    - las_data (laspy.LasData): The loaded point cloud.
+    - features_to_extract (list): List of features to extract. If None, all available features except 'x', 'y', 'z' will be selected.
+    - dtype (numpy.dtype): Data type of the output array. Default is float64.
 
+    Returns:
+    - np.ndarray: A numpy array containing the extracted data.
+    - feature_names (list of str): List of feature names corresponding to the columns in the array.
+    """
+    feature_names = select_las_features(list(las_data.point_format.dimension_names), features_to_extract)
+    data_array = np.empty((len(las_data.points), len(feature_names)), dtype=dtype)
+    for column, feature in enumerate(feature_names):
+        data_array[:, column] = las_data[feature]
     return data_array, feature_names
 
 
-def read_csv_file_to_numpy(file_path, features_to_extract=None):
+def read_csv_file_to_numpy(file_path, features_to_extract=None, label_filter=None):
     """
-    Reads a CSV file and extracts the specified features along with coordinates and labels.
+    Reads a CSV (or Parquet) file and extracts the specified features along with coordinates and labels.
+    Only the extracted columns are read from the file (see utils/table_io.py).
 
     Args:
-    - file_path (str): Path to the CSV file.
+    - file_path (str): Path to the CSV or Parquet file.
     - features_to_extract (list of str): List of feature names to extract. 
                                          If None, all columns will be selected.
+    - label_filter (list, optional): Labels of the points to keep. If None, all points are kept. For Parquet files 
+                                     the filter is pushed down to the reader, which skips non-matching row groups. Default is None.
 
     Returns:
     - np.ndarray: Numpy array containing the extracted features and coordinates.
     - feature_names (list of str): List of feature names corresponding to the columns in the array.
     """
-    # Read the CSV file into a pandas DataFrame
-    df = pd.read_csv(file_path)
+    # Read the column names only
+    columns = read_table_columns(file_path)
     
     # Ensure 'x', 'y', 'z' coordinates are present
-    if not all(coord in df.columns for coord in ['x', 'y', 'z']):
-        raise ValueError(f"CSV file {file_path} is missing required coordinates ('x', 'y', 'z').")
-    
-    # Always include 'x', 'y', 'z' coordinates
-    coords = df[['x', 'y', 'z']].values
+    if not all(coord in columns for coord in ['x', 'y', 'z']):
+        raise ValueError(f"File {file_path} is missing required coordinates ('x', 'y', 'z').")
     
-    # Initialize feature_names with 'x', 'y', 'z'
+    # Initialize feature_names with 'x', 'y', 'z' (always included)
     feature_names = ['x', 'y', 'z']
     
     # If features_to_extract is None, select all columns except 'x', 'y', 'z', 'segment_id' and 'label' (since these are always included)
     if features_to_extract is None:
-        features_to_extract = [col for col in df.columns if col not in ['x', 'y', 'z', 'segment_id', 'label']]
+        features_to_extract = [col for col in columns if col not in ['x', 'y', 'z', 'segment_id', 'label']]
 
     # Extract the features
-    available_features = [f for f in features_to_extract if f in df.columns]
+    available_features = [f for f in features_to_extract if f in columns]
     
-    # Check for features not present in the CSV and eventually print a warning
-    missing_features = [f for f in features_to_extract if f not in df.columns]
+    # Check for features not present in the file and eventually print a warning
+    missing_features = [f for f in features_to_extract if f not in columns]
     if missing_features:
         print(f"Warning: The following features were not found in the CSV: {missing_features}")
     
-    feature_data = df[available_features].values
-    
     # Add selected features to feature_names
     feature_names += available_features
     
     # Optionally handle segment_id if present
-    if 'segment_id' in df.columns:
-        segment_id = df[['segment_id']].values
-        combined_data = np.hstack((coords, feature_data, segment_id))
+    if 'segment_id' in columns:
         feature_names += ['segment_id']
-    else:
-        combined_data = np.hstack((coords, feature_data))
     
-    # Check if the label column exists in the CSV
-    if 'label' in df.columns:
-        labels = df[['label']].values
-        # Combine coordinates, features, segment_id and labels into a single array
-        combined_data = np.hstack((combined_data, labels))
-        # Add the label to the feature names
+    # Check if the label column exists in the file
+    if 'label' in columns:
         feature_names += ['label']
     else: 
         raise ValueError('Labels are not present in the csv files. Process aborted.')
 
+    # Read only the needed columns, and combine coordinates, features, segment_id and labels into a single array
+    df = read_table(file_path, columns=feature_names, label_filter=label_filter)
+    combined_data = np.empty((len(df), len(feature_names)), dtype=np.float64)
+    for column_index, feature in enumerate(feature_names):
+        combined_data[:, column_index] = df[feature].to_numpy()
+
     return combined_data, feature_names
 
 
@@ -241,14 +283,17 @@ def load_features_for_np(features_file_path):
         raise ValueError(f"Error loading features from {features_file_path}: {e}")
 
 
-def read_file_to_numpy(data_dir, features_to_use=None, features_file_path=None):
+def read_file_to_numpy(data_dir, features_to_use=None, features_file_path=None, ingest_cache_dir=None, laz_threads=None):
     """
-    Loads the raw data from a .npy, .las, or .csv file and returns the data array along with the known features.
+    Loads the raw data from a .npy, .las, .laz, .csv or .parquet file and returns the data array along with the known features.
 
     Args:
     - data_dir (str): Path to the raw data file.
     - features_to_use (list): List of features to extract from the file.
     - features_file_path (str): Path to the features file (only used for .npy files).
+    - ingest_cache_dir (str, optional): Directory where .las, .laz and .csv files are converted, on first use, to memory-mapped
+                                        column-major .npy files, mapped instead of parsing the file again (see utils/ingest_cache.py). Default is None.
+    - laz_threads (int, optional): Number of threads used to decompress .laz files. If None, all cores are used. Default is None.
 
     Returns:
     - data_array (np.ndarray): The raw data array (x, y, z, features).
@@ -263,16 +308,20 @@ def read_file_to_numpy(data_dir, features_to_use=None, features_file_path=None):
         except Exception as e:
             raise ValueError(f"Unable to load features from {features_file_path}: {e}")
 
-    elif data_dir.endswith('.las'):  # LAS file
+    elif ingest_cache_dir is not None and data_dir.endswith(('.las', '.laz', '.csv')):
+        data_array, known_features = load_or_ingest_file(data_dir, ingest_cache_dir, features_to_use=features_to_use,
+                                                         reader=lambda file_path, features: read_file_to_numpy(file_path, features_to_use=features, laz_threads=laz_threads))
+
+    elif is_las_file(data_dir):  # LAS or LAZ file
         # print("Loading raw data from LAS file...")
-        data_array, known_features = read_las_file_to_numpy(data_dir, features_to_extract=features_to_use)
+        data_array, known_features = read_las_file_to_numpy(data_dir, features_to_extract=features_to_use, laz_threads=laz_threads)
 
-    elif data_dir.endswith('.csv'):  # CSV file
+    elif data_dir.endswith(('.csv', '.parquet')):  # CSV or Parquet file
         # print("Loading raw data from CSV file...")
         data_array, known_features = read_csv_file_to_numpy(data_dir, features_to_extract=features_to_use)
 
     else:
-        raise ValueError("Unsupported data format. Please provide a .npy, .las, or .csv file.")
+        raise ValueError("Unsupported data format. Please provide a .npy, .las, .laz, .csv or .parquet file.")
 
     return data_array, known_features
 
@@ -280,94 +329,254 @@ def read_file_to_numpy(data_dir, features_to_use=None, features_file_path=None):
 # ============================================== SUBTILING + STITCHING ================================================
 
 
-def subtiler(file_path, tile_size=50, overlap_size=10):
+def subtiler(file_path, tile_size=50, overlap_size=10, compress=False, laz_threads=None):
     """
     Subdivides a single LAS file into smaller tiles with overlaps and saves the subtiles in a new subdirectory.
     Ensures that no strip is left out, adjusting the dimensions for northernmost and rightmost subtiles if needed.
 
     Parameters:
-    - file_path (str): Path to the LAS file to be subdivided.
+    - file_path (str): Path to the LAS (or LAZ) file to be subdivided.
     - tile_size (int): Size of each subtile in meters.
     - overlap_size (int): Size of the overlap between subtiles in meters.
+    - compress (bool): If True, subtiles are saved as compressed .laz files instead of .las files. Default is False.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression. If None, all cores are used. Default is None.
     Returns:
     - output_dir (str): Path to the directory where subtiles were saved.
     """
     
     # Load the LiDAR file
-    las_file = laspy.read(file_path)
+    las_file = read_las(file_path, laz_threads=laz_threads)
 
     # Create subdirectory for the subtiles
     output_dir = f"{os.path.splitext(file_path)[0]}_{tile_size:03d}_subtiles"
     os.makedirs(output_dir, exist_ok=True)
 
-    # Extract the lower left coordinates from the filename (assuming filename format includes coordinates)
-    parts = os.path.basename(file_path).split('_')
-    lower_left_x = int(parts[1])
-    lower_left_y = int(parts[2])
-
-    x_coords = las_file.x
-    y_coords = las_file.y
-
-    # Calculate the number of steps required, ensuring the last subtile adjusts dynamically
-    total_size = 500  # Assuming the full tile is 500x500 meters
-    steps_x = (total_size - overlap_size) // (tile_size - overlap_size)
-    steps_y = (total_size - overlap_size) // (tile_size - overlap_size)
-
-    progress_bar = tqdm(total=(steps_x * steps_y), desc="Processing subtiles")
-
-    # Loop to create subtiles
-    for i in range(steps_x + 1):  # Include an extra step for the last strip
-        for j in range(steps_y + 1):  # Include an extra step for the last strip
-            # Calculate the starting position for the subtile
-            subtile_lower_left_x = lower_left_x + i * (tile_size - overlap_size)
-            subtile_lower_left_y = lower_left_y + j * (tile_size - overlap_size)
-
-            # Determine subtile dimensions
-            subtile_upper_right_x = subtile_lower_left_x + tile_size
-            subtile_upper_right_y = subtile_lower_left_y + tile_size
-
-            # Adjust for the last subtile to ensure no strip is left out
-            if i == steps_x:
-                subtile_upper_right_x = lower_left_x + total_size
-            if j == steps_y:
-                subtile_upper_right_y = lower_left_y + total_size
-
-            # Determine points within the subtile
-            mask = (
-                (x_coords >= subtile_lower_left_x) & 
-                (x_coords < subtile_upper_right_x) & 
-                (y_coords >= subtile_lower_left_y) & 
-                (y_coords < subtile_upper_right_y)
-            )
-
-            # Create a new LAS file header and set properties
-            new_header = laspy.LasHeader(point_format=las_file.header.point_format,
-                                         version=las_file.header.version)
-            new_header.offsets = las_file.header.offsets
-            new_header.scales = las_file.header.scales
-            new_las = laspy.LasData(new_header)
-            new_las.points = las_file.points[mask]
-
-            # Only proceed if the subtile has points
-            if len(new_las.x) > 0:
-                new_las.update_header()
-
-                # Generate the filename with lower-left coordinates
-                subtile_file_name = f"{output_dir}/subtile_{subtile_lower_left_x}_{subtile_lower_left_y}"
-
-                # Save the new LAS file
-                new_las.write(f"{subtile_file_name}.las")
-
-            # Update progress bar
-            progress_bar.update(1)
+    # Save the points of each subtile (within the bounds in the header of the file), selected by their indices
+    subtiles = generate_subtile_indices(las_file.x, las_file.y, las_file.header.mins, las_file.header.maxs, tile_size, overlap_size)
+    for subtile_lower_left_x, subtile_lower_left_y, indices in tqdm(subtiles, desc="Processing subtiles"):
+        # Create a new LAS file header and set properties
+        new_header = laspy.LasHeader(point_format=las_file.header.point_format,
+                                     version=las_file.header.version)
+        new_header.offsets = las_file.header.offsets
+        new_header.scales = las_file.header.scales
+        new_las = laspy.LasData(new_header)
+        new_las.points = las_file.points[indices]
+        new_las.update_header()
+
+        # Generate the filename with lower-left coordinates
+        subtile_file_name = f"{output_dir}/subtile_{subtile_lower_left_x}_{subtile_lower_left_y}"
+
+        # Save the new LAS (or LAZ) file
+        write_las(new_las, f"{subtile_file_name}{las_extension(compress)}", laz_threads=laz_threads)
 
     print('\nSubtiles created successfully.\n')
     return output_dir
 
 
-def stitch_subtiles(subtile_folder, original_las, original_filename, model_directory, overlap_size=30):
+def generate_subtile_indices(x_coords, y_coords, mins, maxs, tile_size=50, overlap_size=10):
+    """
+    Subdivides a tile into overlapping subtiles, as subtiler does, and yields the indices of the points of each subtile 
+    instead of writing them to files: subtiles are views (index arrays) on the points of the tile, which is loaded once.
+    The extent of the tile is given by its bounds (e.g., from the LAS header), starting from the integer coordinates below its minimum.
+    Ensures that no strip is left out, extending the northernmost and rightmost subtiles to the bounds if needed. Empty subtiles are skipped.
+    Points are bucketed by subtile with a single sort (see bucket_points_by_cell), instead of one mask of all points per subtile.
+
+    Args:
+    - x_coords (numpy.ndarray): x coordinates of the points of the tile.
+    - y_coords (numpy.ndarray): y coordinates of the points of the tile.
+    - mins (array-like): Minimum (x, y) coordinates of the tile.
+    - maxs (array-like): Maximum (x, y) coordinates of the tile.
+    - tile_size (int): Size of each subtile in meters.
+    - overlap_size (int): Size of the overlap between subtiles in meters.
+
+    Yields:
+    - subtile_lower_left_x (int): x coordinate of the lower-left corner of the subtile.
+    - subtile_lower_left_y (int): y coordinate of the lower-left corner of the subtile.
+    - indices (numpy.ndarray): Sorted indices of the points of the subtile.
+    """
+    step = tile_size - overlap_size
+    if step <= 0:
+        raise ValueError(f"The tile size ({tile_size}) must be larger than the overlap size ({overlap_size}).")
+
+    cells, memberships, lower_lefts, num_subtiles = [], [], [], []
+    for coords, axis_min, axis_max in ((x_coords, mins[0], maxs[0]), (y_coords, mins[1], maxs[1])):
+        lower_left = int(np.floor(axis_min))
+        # number of steps required, the last subtile extending to the bounds
+        last = max(int((axis_max - lower_left - overlap_size) // step), 0)
+        relative = np.asarray(coords, dtype=np.float64) - lower_left
+
+        # each point is in the subtile of its step, and in the previous subtiles that overlap it
+        cell = (relative / step).astype(np.int64)
+        np.clip(cell, 0, last, out=cell)
+        axis_memberships = {0: None}
+        for offset in range(1, int(np.ceil(tile_size / step))):
+            index = cell - offset
+            axis_memberships[-offset] = (index >= 0) & ((relative < index * step + tile_size) | (index == last))
+
+        cells.append(cell)
+        memberships.append(axis_memberships)
+        lower_lefts.append(lower_left)
+        num_subtiles.append(last + 1)
+
+    for i, j, indices, _ in bucket_points_by_cell(cells[0], cells[1], num_subtiles, memberships[0], memberships[1]):
+        yield lower_lefts[0] + i * step, lower_lefts[1] + j * step, indices
+
+
+def generate_core_halo_indices(x_coords, y_coords, mins, maxs, core_size=20, halo_size=15):
+    """
+    Subdivides a tile into subtiles made of a core and a halo, and yields the indices of the points of each subtile.
+    Cores are the cells of a grid of step core_size over the bounds of the tile (e.g., from the LAS header), starting from the 
+    integer coordinates below its minimum: every point is owned by exactly one core (points outside the bounds are owned 
+    by the closest core), and is thus predicted once.
+    The halo of a core is made of the points of the neighboring cores within halo_size of it: they are only used as neighbors 
+    of the core points (e.g., in the KDTree used to build their grids) and are never predicted.
+    Points are bucketed by core with a single sort (see bucket_points_by_cell). Empty cores are skipped.
+
+    Args:
+    - x_coords (numpy.ndarray): x coordinates of the points of the tile.
+    - y_coords (numpy.ndarray): y coordinates of the points of the tile.
+    - mins (array-like): Minimum (x, y) coordinates of the tile.
+    - maxs (array-like): Maximum (x, y) coordinates of the tile.
+    - core_size (int): Size of each core in meters. Default is 20.
+    - halo_size (float): Width of the halo around each core in meters (e.g., half the largest window size). Default is 15.
+
+    Yields:
+    - core_lower_left_x (int): x coordinate of the lower-left corner of the core.
+    - core_lower_left_y (int): y coordinate of the lower-left corner of the core.
+    - indices (numpy.ndarray): Sorted indices of the points of the subtile (core and halo).
+    - core_mask (numpy.ndarray): Boolean mask of the core points among indices.
+    """
+    if core_size <= 0:
+        raise ValueError(f"The core size must be positive, got {core_size}: the tile size must be larger than the overlap size.")
+
+    cells, memberships, lower_lefts, num_cores = [], [], [], []
+    for coords, axis_min, axis_max in ((x_coords, mins[0], maxs[0]), (y_coords, mins[1], maxs[1])):
+        lower_left = int(np.floor(axis_min))
+        axis_num_cores = max(int(np.ceil((axis_max - lower_left) / core_size)), 1)
+        relative = np.asarray(coords, dtype=np.float64) - lower_left
+
+        # owning core of each point, and the neighboring cores whose halo contains it
+        cell = (relative / core_size).astype(np.int64)
+        np.clip(cell, 0, axis_num_cores - 1, out=cell)
+        axis_memberships = {0: None}
+        reach = int(np.ceil(halo_size / core_size))
+        for offset in range(1, reach + 1):
+            axis_memberships[-offset] = (cell - offset >= 0) & (relative < (cell - offset + 1) * core_size + halo_size)
+            axis_memberships[offset] = (cell + offset < axis_num_cores) & (relative >= (cell + offset) * core_size - halo_size)
+
+        cells.append(cell)
+        memberships.append(axis_memberships)
+        lower_lefts.append(lower_left)
+        num_cores.append(axis_num_cores)
+
+    for i, j, indices, core_mask in bucket_points_by_cell(cells[0], cells[1], num_cores, memberships[0], memberships[1]):
+        if not np.any(core_mask):
+            continue    # halo without core points: nothing to predict
+        yield lower_lefts[0] + i * core_size, lower_lefts[1] + j * core_size, indices, core_mask
+
+
+def bucket_points_by_cell(cell_x, cell_y, num_cells, memberships_x, memberships_y):
+    """
+    Groups points by the cell of a 2D grid they fall in, with a single (stable) sort, and yields the points of each cell 
+    together with the points of the neighboring cells that also belong to it (e.g., overlaps or halos), as sorted index arrays.
+
+    Args:
+    - cell_x (numpy.ndarray): Cell of each point along x (in [0, num_cells[0])).
+    - cell_y (numpy.ndarray): Cell of each point along y (in [0, num_cells[1])).
+    - num_cells (tuple): Number of cells along x and y.
+    - memberships_x (dict): Offset -> boolean mask of the points that also belong to the cell at that offset from their own cell 
+                            along x (None for offset 0: every point belongs to its own cell).
+    - memberships_y (dict): Same as memberships_x, along y.
+
+    Yields:
+    - i (int): Index of the cell along x.
+    - j (int): Index of the cell along y.
+    - indices (numpy.ndarray): Sorted indices of the points belonging to the cell.
+    - own_mask (numpy.ndarray): Boolean mask of the points of the cell itself among indices.
+    """
+    num_x, num_y = num_cells
+    cell_ids = cell_x * num_y + cell_y
+    # stable radix sort on small integer ids: points of each cell stay in increasing order
+    order = np.argsort(cell_ids.astype(np.uint16) if num_x * num_y <= 2**16 else cell_ids, kind='stable')
+    boundaries = np.concatenate(([0], np.cumsum(np.bincount(cell_ids, minlength=num_x * num_y))))
+
+    for i in range(num_x):
+        for j in range(num_y):
+            pieces, own_flags = [], []
+            for offset_x, mask_x in memberships_x.items():
+                for offset_y, mask_y in memberships_y.items():
+                    source_i, source_j = i - offset_x, j - offset_y     # cell whose points may belong to cell (i, j)
+                    if not (0 <= source_i < num_x and 0 <= source_j < num_y):
+                        continue
+                    source_id = source_i * num_y + source_j
+                    points = order[boundaries[source_id]:boundaries[source_id + 1]]
+                    if mask_x is not None:
+                        points = points[mask_x[points]]
+                    if mask_y is not None:
+                        points = points[mask_y[points]]
+                    pieces.append(points)
+                    own_flags.append(np.full(len(points), offset_x == 0 and offset_y == 0))
+
+            num_points = sum(len(points) for points in pieces)
+            if num_points == 0:
+                continue
+            indices = np.concatenate(pieces)
+            own_mask = np.concatenate(own_flags)
+            if len(pieces) > 1:
+                merge = np.argsort(indices, kind='stable')
+                indices, own_mask = indices[merge], own_mask[merge]
+            yield i, j, indices, own_mask
+
+
+def inner_points_mask(x_coords, y_coords, mins, maxs, cut_off):
+    """
+    Selects the points of a subtile farther than cut_off from its bounds, i.e. the points whose predictions are kept when 
+    stitching subtiles (the strips of width cut_off along the sides of the subtile are covered by the neighboring subtiles).
+
+    Args:
+    - x_coords (numpy.ndarray): x coordinates of the points of the subtile.
+    - y_coords (numpy.ndarray): y coordinates of the points of the subtile.
+    - mins (array-like): Minimum (x, y) coordinates of the subtile.
+    - maxs (array-like): Maximum (x, y) coordinates of the subtile.
+    - cut_off (float): Width of the strips cut off each side of the subtile.
+
+    Returns:
+    - mask (numpy.ndarray): Boolean mask of the inner points.
+    """
+    return (
+        (x_coords < maxs[0] - cut_off) &  
+        (y_coords < maxs[1] - cut_off) & 
+        (x_coords > mins[0] + cut_off) &
+        (y_coords > mins[1] + cut_off)
+    )
+
+
+def prediction_filepath(original_filename, model_directory, compress=False):
+    """
+    Builds the path of the file with the predictions for a point cloud, in the predictions/ subfolder of the model directory.
+
+    Args:
+    - original_filename (str): File name of the original LAS (or LAZ) file.
+    - model_directory (str): Directory where the trained PyTorch model is stored.
+    - compress (bool): If True, the path has a .laz extension instead of .las. Default is False.
+
+    Returns:
+    - output_filepath (str): Path of the prediction file (named after the original file and a timestamp).
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    model_save_dir = os.path.join(model_directory, 'predictions')
+    os.makedirs(model_save_dir, exist_ok=True)
+    base_filename = os.path.basename(original_filename)     # Get the base filename without extension
+    base_filename_without_ext = os.path.splitext(base_filename)[0]
+
+    return os.path.join(model_save_dir, f"{base_filename_without_ext}_pred_{timestamp}{las_extension(compress)}")
+
+
+def stitch_subtiles(subtile_folder, original_las, original_filename, model_directory, overlap_size=30, compress=False, laz_threads=None):
     """
     Stitches subtiles back together into the original LAS file.
+    A strip of overlap_size/2 is cut off each side of every subtile, and the remaining points are streamed chunk by chunk 
+    into the stitched file with all their dimensions (see concatenate_las), so that subtiles are never fully loaded.
     
     Args:
     - subtile_folder (str): Folder containing the sub-tile files to be stitched.
@@ -375,157 +584,37 @@ def stitch_subtiles(subtile_folder, original_las, original_filename, model_direc
     - original_filename (str) : File name of the original LAS file.
     - model_directory (str): Directory where the trained PyTorch model is stored.
     - overlap_size (int): Size of the overlap between subtiles in meters.
+    - compress (bool): If True, the stitched file is saved as a compressed .laz file instead of a .las file. Default is False.
+    - laz_threads (int, optional): Number of threads used for LAZ decompression and compression. If None, all cores are used. Default is None.
 
     Return:
     - output_filepath (str): File path to the output stitched file.
     """
-
-    # Create a new header with the correct point format, scales, and offsets 
-    new_header = laspy.LasHeader(point_format=original_las.header.point_format, version=original_las.header.version)
+    # Get all subtile files from the subtile folder
+    subtile_files = [os.path.join(subtile_folder, f) for f in os.listdir(subtile_folder) if f.endswith(('_pred.las', '_pred.laz'))]
+    if not subtile_files:
+        raise ValueError(f"No predicted subtiles found in {subtile_folder}.")
+
+    # Create a new header with the point format of the subtiles (with labels), and the version, scales, and offsets of the original file
+    with open_las(subtile_files[0], laz_threads=laz_threads) as las_reader:
+        subtile_point_format = las_reader.header.point_format
+    new_header = laspy.LasHeader(point_format=subtile_point_format, version=original_las.header.version)
     new_header.offsets = original_las.header.offsets
     new_header.scales = original_las.header.scales
 
-    # Create a new LasData object with the new header
-    stitched_las = laspy.LasData(new_header)
-    
-    if 'label' not in stitched_las.point_format.dimension_names:
-        # Add labels as a dimension to the stitched file if it does not exist
-        stitched_las.add_dimension('label')
-        
-    # Initialize lists to store points, labels, and other features
-    all_points = []
-    all_labels = []
-    all_intensitites = []
-    all_red = []
-    all_green = []
-    all_blue = []
-    all_nir = []
-    all_return_number = []
-    all_number_of_returns = []
-    all_classification = []
-
-    '''# Get the lower-left coordinates of all subtiles from their filenames
-    lower_left_coords = []'''
-
-    # Get all subtile files from the subtile folder
-    subtile_files = [os.path.join(subtile_folder, f) for f in os.listdir(subtile_folder) if f.endswith('_pred.las')]
-
-    '''for subtile_file in subtile_files:
-        # Extract coordinates from filename
-        filename = os.path.basename(subtile_file)
-
-        # Split filename to get coordinates (x, y) - expect format : "subtile_x_y.las"
-        parts = filename.split('_')
-        lower_left_x = int(parts[1])
-        lower_left_y = int(parts[2].split('.')[0])  # Extract y (before the file extension)
-        lower_left_coords.append((lower_left_x, lower_left_y))'''
-    
     # define size of strip to cut off
     cut_off = overlap_size/2
-    
-    # Iterate over each subtile
-    for subtile_file in subtile_files:
-        # Read the subtile
-        subtile_las = laspy.read(subtile_file)
-        
-        if subtile_las.point_format != original_las.point_format:
-            print(f"Warning: Point format mismatch in {subtile_file}, converting to original format.")
-            subtile_las.points = subtile_las.points.convert_to(original_las.point_format)
-        
-        filename = os.path.basename(subtile_file)
-        '''# Split filename to get coordinates (x, y)
-        parts = filename.split('_')
-        lower_left_x = int(parts[1])
-        lower_left_y = int(parts[2].split('.')[0]) ''' 
-
-        # Define upper bounds based on tile size (to cut off strips of unlabeled points)
-        min_x = subtile_las.x.min()
-        max_x = subtile_las.x.max()
-        min_y = subtile_las.y.min()
-        max_y = subtile_las.y.max()
-        
-        upper_bound_x = max_x - cut_off    
-        upper_bound_y = max_y - cut_off
-        lower_bound_x = min_x + cut_off
-        lower_bound_y = min_y + cut_off
-
-        mask = (
-            (subtile_las.x < upper_bound_x) &  
-            (subtile_las.y < upper_bound_y ) & 
-            (subtile_las.x > lower_bound_x) &
-            (subtile_las.y > lower_bound_y)
-        )
-
-        subtile_masked = subtile_las.points[mask]
-
-        # Extract only x, y, z coordinates and labels 
-        masked_points = np.vstack((subtile_masked.x, subtile_masked.y, subtile_masked.z)).T
-        masked_labels = subtile_masked.label  
-        masked_intensitites = subtile_masked.intensity
-        masked_red = subtile_masked.red
-        masked_green = subtile_masked.green
-        masked_blue = subtile_masked.blue
-        masked_nir = subtile_masked.nir
-        masked_return_number = subtile_masked.return_number
-        masked_number_of_returns = subtile_masked.number_of_returns
-        masked_classification = subtile_masked.classification
-            
-        # Append the masked points and labels to the final lists
-        all_points.append(masked_points)
-        all_labels.append(masked_labels)
-        all_intensitites.append(masked_intensitites)
-        all_red.append(masked_red)
-        all_green.append(masked_green)
-        all_blue.append(masked_blue)
-        all_nir.append(masked_nir)
-        all_return_number.append(masked_return_number)
-        all_number_of_returns.append(masked_number_of_returns)
-        all_classification.append(masked_classification)
-        
-    # Concatenate all points and labels from all sub-tiles
-    all_points = np.concatenate(all_points)
-    all_labels = np.concatenate(all_labels)
-    all_intensitites = np.concatenate(all_intensitites)
-    all_red = np.concatenate(all_red)
-    all_green = np.concatenate(all_green)
-    all_blue = np.concatenate(all_blue)
-    all_nir = np.concatenate(all_nir)
-    all_return_number = np.concatenate(all_return_number)
-    all_number_of_returns = np.concatenate(all_number_of_returns)
-    all_classification = np.concatenate(all_classification)
-
-    # Verify lengths
-    print(f"Total points: {len(all_points)}, Total labels: {len(all_labels)}")
-    assert len(all_points) == len(all_labels), "Mismatch between points and labels!"
-    
-    stitched_las.x = all_points[:, 0]
-    stitched_las.y = all_points[:, 1]
-    stitched_las.z = all_points[:, 2]
-    stitched_las.label = all_labels
-    stitched_las.intensity = all_intensitites
-    stitched_las.red = all_red
-    stitched_las.green = all_green
-    stitched_las.blue = all_blue
-    stitched_las.nir = all_nir
-    stitched_las.return_number = all_return_number 
-    stitched_las.number_of_returns = all_number_of_returns
-    stitched_las.classification = all_classification
-
-    # Update header
-    stitched_las.update_header()
 
-    # Construct the path for saving the final stitched file inside the model's directory
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    model_save_dir = os.path.join(model_directory, 'predictions')
-    os.makedirs(model_save_dir, exist_ok=True)
-    base_filename = os.path.basename(original_filename)     # Get the base filename without extension
-    base_filename_without_ext = os.path.splitext(base_filename)[0]
+    def inner_points(points, subtile_header):
+        # keep the points farther than cut_off from the bounds of their subtile (read from its header)
+        return inner_points_mask(points.x, points.y, subtile_header.mins, subtile_header.maxs, cut_off)
 
-    # Construct the final output file path
-    output_filepath = os.path.join(model_save_dir, f"{base_filename_without_ext}_pred_{timestamp}.las")
+    # Construct the path for saving the final stitched file inside the model's directory
+    output_filepath = prediction_filepath(original_filename, model_directory, compress=compress)
 
-    # Save the stitched file
-    stitched_las.write(output_filepath)
+    # Stream the inner points of the subtiles into the stitched file
+    num_points = concatenate_las(subtile_files, output_filepath, header=new_header, point_filter=inner_points, laz_threads=laz_threads)
+    print(f"Total points: {num_points}")
 
     # print(f"Stitching completed. Stitched file saved at: {output_filepath}")
 
@@ -552,15 +641,12 @@ def remap_labels(data_array, label_column_index=-1):
     # Extract the label column
     labels = data_array[:, label_column_index]
 
-    # Get the unique labels
-    unique_labels = np.unique(labels)
+    # Get the unique labels, and the position of each label among them (i.e., the remapped labels)
+    unique_labels, remapped_labels = np.unique(labels, return_inverse=True)
 
     # Create a mapping from the unique labels to continuous integers
     label_mapping = {label: idx for idx, label in enumerate(unique_labels)}
 
-    # Apply the mapping to the labels
-    remapped_labels = np.array([label_mapping[label] for label in labels])
-
     # Replace the original labels in the data array with the remapped labels
     data_array[:, label_column_index] = remapped_labels
 
@@ -577,26 +663,160 @@ def clean_nan_values(data_array, default_value=0.0):
     - default_value (numeric): The value to replace NaN and Inf values with. Default is 0.
 
     Returns:
-    - numpy.ndarray: The cleaned NumPy array.
+    - numpy.ndarray: The cleaned NumPy array (the input array itself, if it has no NaN or Inf values).
     """
-    cleaned_array = np.nan_to_num(data_array, nan=default_value, posinf=default_value, neginf=default_value)
     total_nans = np.isnan(data_array).sum()
     total_infs = np.isinf(data_array).sum()
     print(f"Cleaning data array: Replaced {total_nans} NaN values and {total_infs} Inf values with {default_value}.")
+    if total_nans == 0 and total_infs == 0:
+        return data_array   # nothing to replace: no copy (e.g., of a memory-mapped array)
+
+    cleaned_array = np.nan_to_num(data_array, nan=default_value, posinf=default_value, neginf=default_value)
     return cleaned_array
 
 
-def apply_masks_KDTree(full_data_array, window_sizes, subset_file=None, tol=1e-8):
+# Data types used along the data path for each precision policy: 'data' is the dtype of the full data array (coordinates included), 
+# 'features' the dtype of the feature matrix the grids are gathered from, and thus of the grids themselves.
+PRECISION_POLICIES = {
+    'float64': {'data': np.float64, 'features': np.float32},
+    'float32': {'data': np.float32, 'features': np.float32},
+    'float16': {'data': np.float32, 'features': np.float16},
+}
+
+
+def apply_precision_policy(data_array, precision='float64', coordinate_origin=None):
+    """
+    Casts the data array to the data type of the precision policy (see PRECISION_POLICIES).
+    With float32 data, coordinates are first shifted to the tile origin (the floored minimum of x, y, z), so that they 
+    keep a sub-millimeter resolution: absolute coordinates (e.g., UTM) would only keep a resolution of ~0.5 m in float32.
+    Other columns (labels included) are cast as they are: integer values are exact in float32 up to 2**24.
+
+    Args:
+    - data_array (numpy.ndarray): The data array, with x, y, z in the first three columns.
+    - precision (str): Precision policy, one of 'float64', 'float32' or 'float16'. Default is 'float64'.
+    - coordinate_origin (numpy.ndarray, optional): If given, the data array is already in the precision policy, with coordinates shifted 
+                                                   to this origin (e.g., by DataSource): it is returned as is, without a copy. Default is None.
+
+    Returns:
+    - data_array (numpy.ndarray): The data array, in the data type of the policy.
+    - coordinate_origin (numpy.ndarray): The (x, y, z) origin subtracted from the coordinates (zeros for float64 data).
+    """
+    if precision not in PRECISION_POLICIES:
+        raise ValueError(f"Unknown precision policy '{precision}'. Available policies: {list(PRECISION_POLICIES)}.")
+
+    if coordinate_origin is not None:
+        if data_array.dtype != PRECISION_POLICIES[precision]['data']:
+            raise ValueError(f"The data array is in {data_array.dtype}, not in the data type of the '{precision}' precision policy.")
+        return data_array, np.asarray(coordinate_origin, dtype=np.float64)
+
+    if PRECISION_POLICIES[precision]['data'] == np.float64:
+        return np.asarray(data_array, dtype=np.float64), np.zeros(3)
+
+    coordinate_origin = np.floor(data_array[:, :3].min(axis=0))
+    cast_array = np.empty(data_array.shape, dtype=np.float32)
+    cast_array[:, :3] = data_array[:, :3] - coordinate_origin   # shift in float64, then cast
+    cast_array[:, 3:] = data_array[:, 3:]
+
+    return cast_array, coordinate_origin
+
+
+def print_memory_footprint(stage, arrays):
+    """
+    Prints the memory footprint of the arrays (numpy arrays or torch tensors) held at a given stage of the data path.
+
+    Args:
+    - stage (str): Name of the stage (e.g., 'loading').
+    - arrays (dict): Dictionary of {name: array}. None entries are skipped.
+
+    Returns:
+    - total_bytes (int): Total size of the arrays, in bytes.
+    """
+    total_bytes = 0
+    descriptions = []
+    for name, array in arrays.items():
+        if array is None:
+            continue
+        num_bytes = array.nbytes if hasattr(array, 'nbytes') else array.element_size() * array.nelement()
+        total_bytes += num_bytes
+        dtype = str(array.dtype).replace('torch.', '')
+        descriptions.append(f"{name} {num_bytes / 2**20:.1f} MB ({dtype})")
+
+    print(f"Memory footprint [{stage}]: " + ", ".join(descriptions) + f" -> total {total_bytes / 2**20:.1f} MB")
+    return total_bytes
+
+
+def is_subset_index_file(subset_file):
+    """
+    Checks whether a subset file is a row-index file (see save_subset_indices) rather than a file of point coordinates.
+
+    Args:
+    - subset_file (str): Path to the subset file.
+
+    Returns:
+    - is_index_file (bool): True for .npy files.
+    """
+    return subset_file.endswith('.npy')
+
+
+def save_subset_indices(row_indices, file_path):
+    """
+    Saves the rows of the full dataset selected by a subset (e.g., a train or eval split) as a compact .npy file of sorted int64 
+    row indices, which selects the subset without reading its points nor matching their coordinates.
+
+    Args:
+    - row_indices (array-like): Row indices of the subset points in the full dataset.
+    - file_path (str): Path to the output .npy file.
+
+    Returns:
+    - file_path (str): Path to the saved file.
+    """
+    if not is_subset_index_file(file_path):
+        raise ValueError(f"Row-index subset files must be .npy files, got {file_path}.")
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    np.save(file_path, np.sort(np.asarray(row_indices, dtype=np.int64)))
+    return file_path
+
+
+def load_subset_indices(subset_file, num_points=None):
+    """
+    Loads a row-index subset file (see save_subset_indices).
+
+    Args:
+    - subset_file (str): Path to the .npy file of row indices.
+    - num_points (int, optional): Number of points of the full dataset, used to validate the indices. Default is None.
+
+    Returns:
+    - row_indices (numpy.ndarray): Sorted int64 row indices of the subset points in the full dataset.
+    """
+    row_indices = np.load(subset_file)
+    if row_indices.ndim != 1 or not np.issubdtype(row_indices.dtype, np.integer):
+        raise ValueError(f"{subset_file} is not a row-index subset file: expected a 1D array of integers, got shape {row_indices.shape} and dtype {row_indices.dtype}.")
+    row_indices = np.sort(row_indices.astype(np.int64))
+    if num_points is not None and len(row_indices) > 0 and (row_indices[0] < 0 or row_indices[-1] >= num_points):
+        raise ValueError(f"Row indices in {subset_file} are out of range for a full dataset of {num_points} points. Was it created from a different file?")
+    return row_indices
+
+
+def apply_masks_KDTree(full_data_array, window_sizes, subset_file=None, tol=1e-8, neighbor_index_backend='kdtree', tree_cache_dir=None, coordinate_origin=None, subset_matching='key', matching_scale=1e-3):
     """
     Applies masking operations on a point cloud dataset:
-    1. Selects points based on a subset file (if provided) using KDTree for fast matching.
+    1. Selects points based on a subset file (if provided): row-index files (.npy, see save_subset_indices) select rows directly;
+       otherwise the quantized coordinates of the subset points are matched on packed 64-bit keys (see utils/point_matching.py), 
+       or with a neighbor index (KDTree by default) and a distance tolerance.
     2. Computes bounds on the selected subset and masks out-of-bounds points.
 
     Args:
     - full_data_array (numpy.ndarray): Full point cloud dataset (shape: [N, features]).
     - window_sizes (list): List of tuples for grid window sizes (e.g., [('small', 2.5), ...]).
-    - subset_file (str, optional): Path to a CSV file with subset points (columns: x, y, z).
-    - tol (float): Tolerance for approximate matching.
+    - subset_file (str, optional): Path to a CSV (or Parquet) file with subset points (columns: x, y, z), or to a .npy file of row indices.
+    - tol (float): Tolerance for approximate matching (only used by 'neighbor_index' matching).
+    - neighbor_index_backend (str): Nearest-neighbor index used for 'neighbor_index' matching, 'kdtree' or 'voxel_hash' (see utils/neighbor_index.py). Default is 'kdtree'.
+    - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+    - coordinate_origin (numpy.ndarray, optional): Origin the coordinates of the data array are shifted to (see apply_precision_policy). 
+                                                   Subset points are shifted and cast the same way before matching. Default is None.
+    - subset_matching (str): How subset points are matched, 'key' (exact match of quantized coordinates, see PointKeyIndex) 
+                             or 'neighbor_index' (nearest-neighbor query within tol). Default is 'key'.
+    - matching_scale (float): Quantization step of the coordinates for 'key' matching, not coarser than the scale of the LAS files. Default is 1e-3.
 
     Returns:
     - selected_array (numpy.ndarray): The filtered data array after applying all masks.
@@ -607,15 +827,31 @@ def apply_masks_KDTree(full_data_array, window_sizes, subset_file=None, tol=1e-8
     final_mask = np.ones(full_data_array.shape[0], dtype=bool)
 
     # Step 2: Apply subset file mask (if provided)
-    if subset_file is not None:
-        subset_points = pd.read_csv(subset_file)[['x', 'y', 'z']].values  # Load x, y, z columns
-        kdtree = cKDTree(subset_points)  # Build KDTree for the subset points
-        distances, _ = kdtree.query(full_data_array[:, :3], distance_upper_bound=tol)
-        
-        subset_mask = distances <= tol  # Points within the tolerance
-        final_mask &= subset_mask
+    if subset_file is not None and is_subset_index_file(subset_file):
+        final_mask[:] = False
+        final_mask[load_subset_indices(subset_file, num_points=full_data_array.shape[0])] = True
+        print(f"Subset mask: {np.sum(final_mask)} points selected by row indices.")
+
+    elif subset_file is not None:
+        subset_points = read_table(subset_file, columns=['x', 'y', 'z']).values  # Load x, y, z columns only
+        if coordinate_origin is not None:
+            # same rounding as the data array coordinates, so that matching points stay exact matches
+            subset_points = (subset_points - coordinate_origin).astype(full_data_array.dtype)
+        if subset_matching == 'key':
+            subset_mask = PointKeyIndex(subset_points, scale=matching_scale).contains(full_data_array[:, :3])
+            final_mask &= subset_mask
+            print(f"Subset mask: {np.sum(final_mask)} points match subset at scale {matching_scale}.")
+
+        elif subset_matching == 'neighbor_index':
+            kdtree = load_or_build_neighbor_index(subset_points, backend=neighbor_index_backend, cache_dir=tree_cache_dir)  # Build the neighbor index for the subset points
+            distances, _ = kdtree.query(full_data_array[:, :3], distance_upper_bound=tol)
+
+            subset_mask = distances <= tol  # Points within the tolerance
+            final_mask &= subset_mask
+            print(f"Subset mask: {np.sum(final_mask)} points match subset within tolerance {tol}.")
 
-        print(f"Subset mask: {np.sum(final_mask)} points match subset within tolerance {tol}.")
+        else:
+            raise ValueError(f"Unknown subset matching '{subset_matching}'. Choose 'key' or 'neighbor_index'.")
 
     # Filter the full data array based on the combined mask
     selected_array = full_data_array[final_mask]
@@ -698,70 +934,92 @@ def compute_point_cloud_bounds(data_array, padding=0.0):
     return bounds_dict
 
 
+def compute_morton_codes(coordinates, bits=32):
+    """
+    Computes the Morton (Z-order) codes of 2D coordinates, by interleaving the bits of their quantized x and y values.
+    Sorting points by their Morton code keeps points that are close in space close in the ordering.
+
+    Args:
+    - coordinates (numpy.ndarray): Array of shape (num_points, 2) (or more columns, only x and y are used).
+    - bits (int): Number of bits used to quantize each coordinate (at most 32). Default is 32.
+
+    Returns:
+    - codes (numpy.ndarray): uint64 array with the Morton code of each point.
+    """
+    if not 0 < bits <= 32:
+        raise ValueError(f"Morton codes can use between 1 and 32 bits per coordinate, got {bits}.")
+
+    xy = np.asarray(coordinates, dtype=np.float64)[:, :2]
+    xy_min = xy.min(axis=0)
+    extent = np.maximum(xy.max(axis=0) - xy_min, np.finfo(np.float64).tiny)
+    max_cell = 2**bits - 1
+    cells = np.minimum(((xy - xy_min) / extent * max_cell).astype(np.uint64), np.uint64(max_cell))
+
+    def spread_bits(values):
+        # insert a zero bit between each of the (32) lower bits of the values
+        values = values & np.uint64(0x00000000FFFFFFFF)
+        values = (values | (values << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+        values = (values | (values << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+        values = (values | (values << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        values = (values | (values << np.uint64(2))) & np.uint64(0x3333333333333333)
+        values = (values | (values << np.uint64(1))) & np.uint64(0x5555555555555555)
+        return values
+
+    return spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << np.uint64(1))
+
+
 # ============================================== CSV OPERATIONS ================================================
 
 
 def clean_and_combine_csv_files(csv_files, output_csv, default_replacement=0.0):
     """
-    Combines multiple CSV files into a single CSV file efficiently, processing them in chunks,
-    and cleans the final combined file of NaN/Inf values by overwriting it with a default value.
+    Combines multiple CSV (or Parquet) files into a single file efficiently, processing them in chunks,
+    and cleans the combined data of NaN/Inf values by overwriting them with a default value.
+    Input and output formats are set by the file extensions, so e.g. CSV files can be combined straight into a Parquet file.
 
     Args:
-    - csv_files (list of str): List of paths to CSV files to combine.
-    - output_csv (str): Path to save the combined CSV file.
+    - csv_files (list of str): List of paths to CSV or Parquet files to combine.
+    - output_csv (str): Path to save the combined file (.csv or .parquet).
     - default_replacement (numeric): Value to replace nan/inf with. Default is 0.0
 
     Returns:
-    - output_csv (str): Path to the saved combined CSV file.
+    - output_csv (str): Path to the saved combined file.
     """
     # Ensure the output folder exists
     os.makedirs(os.path.dirname(output_csv), exist_ok=True)
 
-    # Combine CSV files
-    with tqdm(total=len(csv_files), desc="Combining CSV files", unit="file") as pbar:
-        for i, file in enumerate(csv_files):
-            for chunk in pd.read_csv(file, chunksize=10_000):
-                # Append to the output CSV, writing the header only for the first chunk
-                chunk.to_csv(output_csv, index=False, header=(i == 0 and chunk.index.start == 0), mode='a')
+    # Combine files, cleaning every chunk from nan/inf values before it is written (a single pass over the data)
+    with TableWriter(output_csv) as writer, tqdm(total=len(csv_files), desc="Combining files", unit="file") as pbar:
+        for file in csv_files:
+            for chunk in iter_table_chunks(file, chunk_size=10_000):
+                chunk = chunk.replace([np.inf, -np.inf], default_replacement)
+                chunk = chunk.fillna(default_replacement)
+                writer.write(chunk)
             pbar.update(1)
 
-    print(f"Combined CSV saved to {output_csv}")
-
-    # Clean the combined file in chunks and overwrite it
-    print("\nCleaning csv file from nan/inf values...")
-    temp_file = f"{output_csv}.tmp"  # Temporary file to write cleaned data
-    with open(temp_file, 'w') as outfile:
-        for chunk in pd.read_csv(output_csv, chunksize=10_000):
-            # clean file from nan/inf values
-            chunk.replace([np.inf, -np.inf], default_replacement, inplace=True)
-            chunk.fillna(default_replacement, inplace=True)
-            chunk.to_csv(outfile, index=False, header=(outfile.tell() == 0), mode='a')
-
-    # Overwrite the original file
-    os.replace(temp_file, output_csv)  # Replace the original CSV with the cleaned version
-
-    print(f"\nCleaned combined CSV saved to {output_csv}")
+    print(f"\nCleaned combined file saved to {output_csv}")
 
     return output_csv
 
 
-def las_to_csv(las_file, output_folder, selected_classes = None):
+def las_to_csv(las_file, output_folder, selected_classes = None, file_format='csv'):
     """
-    Converts a LAS file to a CSV file by extracting its data and features.
+    Converts a LAS file to a CSV (or Parquet) file by extracting its data and features.
 
     This function reads a LAS file, cleans it from out of bound points, converts its contents into a NumPy array, 
     drops out rows corresponding to labels not specified in input, and finally
     transforms the array into a Pandas DataFrame. The DataFrame is then saved as a CSV file at the specified output location.
 
     Args:
-    - las_file (str): Path to the input LAS file.
+    - las_file (str): Path to the input LAS (or LAZ) file.
     - output_folder (str): Folder to save the output CSV file. The file name is derived
-                           from the LAS file name by replacing .las with .csv.
+                           from the LAS file name by replacing .las (or .laz) with .csv (or .parquet).
     - selected classes (list): List of the selcted classes to keep in the csv file. The others will be discarded.
                                If None (default) all classes will be included. 
+    - file_format (str): Format of the output file, 'csv' or 'parquet'. Default is 'csv'.
 
     Returns:
-    - output_csv_filepath (str): Path to the saved CSV file.
+    - output_csv_filepath (str): Path to the saved file.
     """
     # clean subtiles by removing points outside of the coordinates specified in file name
     clean_bugged_las(las_file)  # necessary because some of the files contain bugged points outside p.c. bounds
@@ -785,12 +1043,12 @@ def las_to_csv(las_file, output_folder, selected_classes = None):
 
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
-    # Derive the output CSV file path
+    # Derive the output file path
     las_filename = os.path.basename(las_file)  # Extract file name
-    csv_filename = os.path.splitext(las_filename)[0] + ".csv"  # Replace .las with .csv
+    csv_filename = os.path.splitext(las_filename)[0] + f".{file_format}"  # Replace .las with .csv (or .parquet)
     output_csv_filepath = os.path.join(output_folder, csv_filename)
-    # Save the DataFrame to a CSV file
-    df.to_csv(output_csv_filepath, index=False)
+    # Save the DataFrame to a CSV or Parquet file
+    write_table(df, output_csv_filepath)
 
     print(f"Converted {las_file} to {output_csv_filepath}")
     return output_csv_filepath
@@ -798,7 +1056,8 @@ def las_to_csv(las_file, output_folder, selected_classes = None):
 
 def sample_data(input_file, sample_size, save=False, save_dir='data/sampled_data', feature_to_use=None, features_file_path=None):
     """
-    Samples a subset of the data from a CSV, NumPy, or LAS file. Optionally saves the sampled data as a CSV file.
+    Samples a subset of the data from a CSV, NumPy, or LAS file. Optionally saves the sampled data as a CSV file,
+    together with the row indices of the sampled points in the input file (see save_subset_indices).
 
     Args:
     - input_file (str): Path to the input file (either a CSV, NumPy file, or LAS file).
@@ -824,7 +1083,8 @@ def sample_data(input_file, sample_size, save=False, save_dir='data/sampled_data
 
     # Sample the data
     print(f"Sampling {sample_size} rows from the dataset...")
-    sampled_data = data_array[np.random.choice(data_array.shape[0], sample_size, replace=False)]
+    sample_indices = np.random.choice(data_array.shape[0], sample_size, replace=False)
+    sampled_data = data_array[sample_indices]
 
     # Optionally save the sampled data as a CSV file
     if save:
@@ -832,14 +1092,17 @@ def sample_data(input_file, sample_size, save=False, save_dir='data/sampled_data
         sample_file_path = os.path.join(save_dir, f'sampled_data_{sample_size}.csv')
         df_sample = pd.DataFrame(sampled_data, columns=feature_names)
         df_sample.to_csv(sample_file_path, index=False)
-        print(f"Sampled data saved to {sample_file_path}")
+        indices_file_path = save_subset_indices(sample_indices, os.path.join(save_dir, f'sampled_indices_{sample_size}.npy'))
+        print(f"Sampled data saved to {sample_file_path} (row indices: {indices_file_path})")
 
     return sampled_data
 
 
-def reservoir_sample_with_subset(input_file, sample_size, subset_file, save=False, save_dir='data/sampled_data', feature_to_use=None, chunk_size=100000, tol=1e-10):
+def reservoir_sample_with_subset(input_file, sample_size, subset_file, save=False, save_dir='data/sampled_data', feature_to_use=None, chunk_size=100000, matching_scale=1e-3, seed=None):
     """
-    Samples a random subset of the data from a large CSV file, ensuring no overlap with a provided subset file using tolerance-based matching.
+    Samples a random subset of the data from a large CSV file, ensuring no overlap with a provided subset file 
+    by exact matching of quantized coordinates (see PointKeyIndex). Points are sampled chunk by chunk with random keys (see RandomKeyReservoir). 
+    If saved, the row indices of the combined points in the input file are saved too (see save_subset_indices).
 
     Args:
     - input_file (str): Path to the input CSV file.
@@ -849,7 +1112,8 @@ def reservoir_sample_with_subset(input_file, sample_size, subset_file, save=Fals
     - save_dir (str): Directory where the sampled data will be saved. Default is 'data/sampled_data'.
     - feature_to_use (list): List of feature names to select from the data.
     - chunk_size (int): Number of rows to process per chunk. Default is 100000.
-    - tol (float): Tolerance for approximate matching.
+    - matching_scale (float): Quantization step of the coordinates used for matching, not coarser than the scale of the LAS files. Default is 1e-3.
+    - seed (int, optional): Seed of the random sampling, for reproducible samples. Default is None.
 
     Returns:
     - pd.DataFrame: The combined sampled data DataFrame (subset + additional sampled points).
@@ -857,36 +1121,31 @@ def reservoir_sample_with_subset(input_file, sample_size, subset_file, save=Fals
     # Load subset points
     subset_points = pd.read_csv(subset_file, usecols=feature_to_use).values.astype(np.float64)
 
-    # Build KDTree for fast exclusion of subset points
-    subset_kdtree = cKDTree(subset_points[:, :3])
+    # Index the subset coordinates once, for fast exclusion of subset points
+    subset_index = PointKeyIndex(subset_points[:, :3], scale=matching_scale)
 
-    reservoir = []  # List to store additional sampled rows
-    total_processed_points = 0  # Total number of processed points
+    reservoir = RandomKeyReservoir(max(sample_size - len(subset_points), 0), rng=np.random.default_rng(seed))  # additional sampled rows
+    subset_rows = np.full(len(subset_points), -1, dtype=np.int64)  # Row indices of the subset points in the input file
+    row_offset = 0  # Row of the first point of the chunk in the input file
 
     # Iterate over chunks of the full data
     for chunk in tqdm(pd.read_csv(input_file, chunksize=chunk_size, usecols=feature_to_use), desc="Processing chunks"):
         chunk_values = chunk.values.astype(np.float64)
+        chunk_rows = np.arange(row_offset, row_offset + len(chunk))
+        row_offset += len(chunk)
 
-        # Apply KDTree filtering to exclude duplicates with the subset
-        distances, _ = subset_kdtree.query(chunk_values[:, :3], distance_upper_bound=tol)
-        is_not_duplicate = distances > tol
-
-        unique_points = chunk[is_not_duplicate]
-        total_processed_points += len(unique_points)
+        # Exclude duplicates with the subset (and record where the subset points are in the input file)
+        matches = subset_index.lookup(chunk_values[:, :3])
+        is_not_duplicate = matches == subset_index.n
+        subset_rows[matches[~is_not_duplicate]] = chunk_rows[~is_not_duplicate]
 
-        for row in unique_points.itertuples(index=False):
-            if len(reservoir) < sample_size - len(subset_points):
-                # If the reservoir is not full, add the row
-                reservoir.append(row)
-            else:
-                # Randomly decide whether to replace an existing element in the reservoir
-                replace_idx = random.randint(0, total_processed_points - 1)
-                if replace_idx < sample_size - len(subset_points):
-                    reservoir[replace_idx] = row
+        reservoir.add(chunk[is_not_duplicate], chunk_rows[is_not_duplicate])
 
     # Combine subset and additional sampled points
     print(f"\nConcatenating sampled points and existing points...")
-    sampled_data = pd.DataFrame(reservoir, columns=chunk.columns)
+    sampled_data, reservoir_rows = reservoir.sample()
+    if sampled_data is None:
+        sampled_data = pd.DataFrame(columns=chunk.columns)
     combined_data = pd.concat([pd.DataFrame(subset_points, columns=chunk.columns), sampled_data], ignore_index=True)
 
     # Inspection: Print dataset summary
@@ -901,14 +1160,19 @@ def reservoir_sample_with_subset(input_file, sample_size, subset_file, save=Fals
         os.makedirs(save_dir, exist_ok=True)
         sample_file_path = os.path.join(save_dir, f'sampled_data_{sample_size}.csv')
         combined_data.to_csv(sample_file_path, index=False)
-        print(f"Combined sampled data saved to {sample_file_path}")
+        if np.any(subset_rows < 0):
+            print(f"Warning: {np.sum(subset_rows < 0)} subset points were not found in {input_file}, and are left out of the row indices.")
+        combined_rows = np.concatenate((subset_rows[subset_rows >= 0], reservoir_rows))
+        indices_file_path = save_subset_indices(combined_rows, os.path.join(save_dir, f'sampled_indices_{sample_size}.npy'))
+        print(f"Combined sampled data saved to {sample_file_path} (row indices: {indices_file_path})")
 
     return combined_data
 
 
-def reservoir_sample_data(input_file, sample_size, save=False, save_dir='data/sampled_data', feature_to_use=None, chunk_size=100000):
+def reservoir_sample_data(input_file, sample_size, save=False, save_dir='data/sampled_data', feature_to_use=None, chunk_size=100000, seed=None):
     """
-    Samples a random subset of the data from a large CSV file using reservoir sampling.
+    Samples a random subset of the data from a large CSV file using reservoir sampling, vectorized over chunks with random keys 
+    (see RandomKeyReservoir). If saved, the row indices of the sampled points in the input file are saved too (see save_subset_indices).
 
     Args:
     - input_file (str): Path to the input CSV file.
@@ -917,49 +1181,44 @@ def reservoir_sample_data(input_file, sample_size, save=False, save_dir='data/sa
     - save_dir (str): Directory where the sampled data will be saved. Default is 'data/sampled_data'.
     - feature_to_use (list): List of feature names to select from the data.
     - chunk_size (int): Number of rows to process per chunk. Default is 100000.
+    - seed (int, optional): Seed of the random sampling, for reproducible samples. Default is None.
 
     Returns:
     - pd.DataFrame: The sampled data DataFrame.
     """
-    reservoir = []  # List to store the sampled rows
+    reservoir = RandomKeyReservoir(sample_size, rng=np.random.default_rng(seed))
     total_rows = 0  # Total number of rows processed
 
     # Iterate over chunks of the data and add tqdm for the progress bar
     for chunk in tqdm(pd.read_csv(input_file, chunksize=chunk_size, usecols=feature_to_use), desc="Processing chunks"):
+        reservoir.add(chunk, np.arange(total_rows, total_rows + len(chunk)))
         total_rows += len(chunk)
 
-        for row in chunk.itertuples(index=False):
-            if len(reservoir) < sample_size:
-                # If the reservoir is not full, add the row
-                reservoir.append(row)
-            else:
-                # Randomly decide whether to replace an existing element in the reservoir
-                replace_idx = random.randint(0, total_rows - 1)
-                if replace_idx < sample_size:
-                    reservoir[replace_idx] = row
-
-    # Convert the reservoir to a DataFrame
-    sampled_data = pd.DataFrame(reservoir, columns=chunk.columns)
+    # Sampled rows, in the order of the input file
+    sampled_data, reservoir_rows = reservoir.sample()
+    if sampled_data is None:
+        sampled_data = pd.DataFrame(columns=chunk.columns)
 
     # Optionally save the sampled data
     if save:
         os.makedirs(save_dir, exist_ok=True)
         sample_file_path = os.path.join(save_dir, f'sampled_data_{sample_size}.csv')
         sampled_data.to_csv(sample_file_path, index=False)
-        print(f"Sampled data saved to {sample_file_path}")
+        indices_file_path = save_subset_indices(reservoir_rows, os.path.join(save_dir, f'sampled_indices_{sample_size}.npy'))
+        print(f"Sampled data saved to {sample_file_path} (row indices: {indices_file_path})")
 
     return sampled_data
 
 
 def filter_features_in_csv(input_csv, output_csv, required_columns=None, suffix='_b', chunk_size=100000):
     """
-    Filters columns in a large CSV file in chunks, keeping only those with the specified suffix
+    Filters columns in a large CSV (or Parquet) file in chunks, keeping only those with the specified suffix
     and additional required columns. Renames the filtered columns to remove the suffix
-    and saves the cleaned DataFrame to a new CSV file.
+    and saves the cleaned DataFrame to a new CSV (or Parquet) file. Only the kept columns are read from the input file.
 
     Args:
-    - input_csv (str): Path to the input CSV file.
-    - output_csv (str): Path to save the cleaned CSV file.
+    - input_csv (str): Path to the input CSV or Parquet file.
+    - output_csv (str): Path to save the cleaned file (.csv or .parquet).
     - required_columns (list, optional): List of additional columns to keep. Defaults to:
                                         ['x', 'y', 'z', 'intensity', 'return_number', 'number_of_returns', 'classification',  
                                         'red', 'green', 'blue', 'nir', 'ndvi', 'ndwi', 'ssi', 'N_h', 'delta_z_fl', 'segment_id', 'label'].
@@ -973,10 +1232,9 @@ def filter_features_in_csv(input_csv, output_csv, required_columns=None, suffix=
         required_columns = ['x', 'y', 'z', 'intensity', 'return_number', 'number_of_returns', 'classification',  
                             'red', 'green', 'blue', 'nir', 'ndvi', 'ndwi', 'ssi', 'N_h', 'delta_z_fl', 'segment_id', 'label']
 
-    # Get the column names from the first chunk to determine which ones to keep
-    first_chunk = pd.read_csv(input_csv, nrows=1)
-    initial_columns = first_chunk.columns.tolist()
-    filtered_columns = [col for col in first_chunk.columns if col.endswith(suffix) or col in required_columns]
+    # Get the column names (without reading the rows) to determine which ones to keep
+    initial_columns = read_table_columns(input_csv)
+    filtered_columns = [col for col in initial_columns if col.endswith(suffix) or col in required_columns]
     rename_columns = {col: col[:-len(suffix)] for col in filtered_columns if col.endswith(suffix)}
     
     # Print before and after column selection
@@ -987,22 +1245,14 @@ def filter_features_in_csv(input_csv, output_csv, required_columns=None, suffix=
 
     # Prepare to write to the output file
     os.makedirs(os.path.dirname(output_csv), exist_ok=True)
-    with pd.read_csv(input_csv, chunksize=chunk_size) as reader:
-        for i, chunk in enumerate(reader):
-            # Filter and rename columns
-            filtered_chunk = chunk[filtered_columns].rename(columns=rename_columns)
-
-            # Write to the output file
-            if i == 0:
-                # Write header for the first chunk
-                filtered_chunk.to_csv(output_csv, index=False, mode='w')
-            else:
-                # Append without writing the header
-                filtered_chunk.to_csv(output_csv, index=False, mode='a', header=False)
+    with TableWriter(output_csv) as writer:
+        for i, chunk in enumerate(iter_table_chunks(input_csv, chunk_size=chunk_size, columns=filtered_columns)):
+            # Rename columns and write to the output file
+            writer.write(chunk.rename(columns=rename_columns))
 
             print(f"Processed chunk {i + 1} of size {len(chunk)}.")
 
-    print(f"Filtered CSV saved to: {output_csv}")
+    print(f"Filtered file saved to: {output_csv}")
 
 
 # ================================================= OTHERS ====================================================
@@ -1012,7 +1262,7 @@ def clean_bugged_las(bugged_las_path):
     Cleans a bugged LAS file by removing points outside the valid bounds inferred from its filename.
 
     Args:
-    - bugged_las_path (str): Path to the bugged LAS file.
+    - bugged_las_path (str): Path to the bugged LAS (or LAZ) file, which is overwritten in the same format.
 
     Returns:
     - None
@@ -1027,7 +1277,7 @@ def clean_bugged_las(bugged_las_path):
         raise ValueError(f"Invalid filename format for bugged LAS file: {bugged_las_path}")
 
     # Load the LAS file
-    las_data = laspy.read(bugged_las_path)
+    las_data = read_las(bugged_las_path)
     
     print(f"\nFrom tile name: xmin: {xmin}, ymin:{ymin}")
     print(f"From .min() and .max() -> xmin:{las_data.x.min()}, ymin:{las_data.y.min()}")
@@ -1044,19 +1294,20 @@ def clean_bugged_las(bugged_las_path):
     
     cleaned_las.update_header()
     
-    cleaned_las.write(bugged_las_path)
+    write_las(cleaned_las, bugged_las_path)
 
     # Print the number of points before and after cleaning
     print(f"Cleaned LAS file: {bugged_las_path}")
     print(f"Original points: {len(las_data.points)}, Cleaned points: {len(cleaned_points)}")
 
 
-def extract_num_classes(raw_file_path=None):
+def extract_num_classes(raw_file_path=None, ingest_cache_dir=None):
     """
-    Extracts the number of unique classes from raw data (LAS, CSV, or NPY).
+    Extracts the number of unique classes from raw data (LAS, LAZ, CSV, Parquet or NPY).
 
     Args:
-    - raw_file_path (str): Path to the input LAS, CSV, or NPY file.
+    - raw_file_path (str): Path to the input LAS, LAZ, CSV, Parquet or NPY file.
+    - ingest_cache_dir (str, optional): Directory of the ingested copies of .las, .laz and .csv files (see read_file_to_numpy). Default is None.
 
     Returns:
     - int: The number of unique classes.
@@ -1065,11 +1316,16 @@ def extract_num_classes(raw_file_path=None):
     if raw_file_path is None: 
         raise ValueError('ERROR: File path to raw data must be provided to extract the number of classes.')
 
-    # Load data from raw files
-    data_array, _ = read_file_to_numpy(raw_file_path, features_to_use=None, features_file_path=None)
+    if ingest_cache_dir is not None and raw_file_path.endswith(('.las', '.laz', '.csv')):
+        # only the (memory-mapped) last column is read from the ingested copy
+        columns, feature_names = load_or_ingest_columns(raw_file_path, ingest_cache_dir, reader=read_file_to_numpy)
+        class_labels = columns[feature_names[-1]]
+    else:
+        # Load data from raw files
+        data_array, _ = read_file_to_numpy(raw_file_path, features_to_use=None, features_file_path=None)
     
-    # Extract class labels from the last column of the data array
-    class_labels = data_array[:, -1]
+        # Extract class labels from the last column of the data array
+        class_labels = data_array[:, -1]
 
     # Extract the unique number of classes
     num_classes = len(np.unique(class_labels))
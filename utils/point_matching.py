@@ -0,0 +1,91 @@
+import numpy as np
+
+
+class PointKeyIndex:
+    def __init__(self, points, scale=1e-3, chunk_size=2**22):
+        """
+        Exact matching of points by their coordinates, as a sort-based join on packed 64-bit keys.
+        Coordinates are quantized to a grid of step `scale` (relative to the minimum corner of the indexed points), the three
+        quantized coordinates are packed into a single 64-bit key, and keys are sorted once: each query is then a binary search
+        (np.searchsorted, over the sorted query keys) instead of a nearest-neighbor query.
+        LAS coordinates are scaled integers, so two points are the same point if and only if they have the same key, provided that
+        `scale` is not coarser than the scale of the files (e.g., 0.01 for centimeter coordinates).
+
+        Args:
+        - points (numpy.ndarray): Array of shape (num_points, >=3) whose first three columns are the coordinates of the indexed points.
+        - scale (float): Quantization step of the coordinates. Default is 1e-3 (millimeters).
+        - chunk_size (int): Number of queries processed at a time, to bound memory usage. Default is 2^22.
+        """
+        if not scale > 0:
+            raise ValueError(f"The quantization scale must be positive, got {scale}.")
+        points = np.asarray(points)
+        if points.ndim != 2 or points.shape[1] < 3:
+            raise ValueError("PointKeyIndex needs an array of 3D points.")
+
+        self.scale = float(scale)
+        self.chunk_size = chunk_size
+        self.n = points.shape[0]
+        self.origin = points[:, :3].min(axis=0).astype(np.float64) if self.n > 0 else np.zeros(3)
+
+        quantized = self._quantize(points)
+        self.max_cell = quantized.max(axis=0) if self.n > 0 else np.zeros(3, dtype=np.int64)
+        self.bits = [max(int(extent).bit_length(), 1) for extent in self.max_cell]
+        if sum(self.bits) > 64:
+            raise ValueError(f"The extent of the points does not fit in a 64-bit key at a scale of {self.scale}: use a coarser scale.")
+
+        keys = self._pack(quantized)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def _quantize(self, points):
+        return np.rint((np.asarray(points[:, :3], dtype=np.float64) - self.origin) / self.scale).astype(np.int64)
+
+    def _pack(self, quantized):
+        keys = quantized[:, 0].astype(np.uint64)
+        for axis in (1, 2):
+            keys = (keys << np.uint64(self.bits[axis])) | quantized[:, axis].astype(np.uint64)
+        return keys
+
+    def lookup(self, points):
+        """
+        Finds, for each query point, an indexed point with the same quantized coordinates.
+
+        Args:
+        - points (numpy.ndarray): Array of shape (num_queries, >=3) whose first three columns are the query coordinates.
+
+        Returns:
+        - indices (numpy.ndarray): Index of a matching indexed point (self.n if there is none).
+        """
+        points = np.asarray(points)
+        indices = np.full(points.shape[0], self.n, dtype=np.int64)
+        if self.n == 0:
+            return indices
+
+        for start in range(0, points.shape[0], self.chunk_size):
+            stop = min(start + self.chunk_size, points.shape[0])
+            quantized = self._quantize(points[start:stop])
+
+            # points outside the extent of the indexed points cannot match (and would not fit in the key)
+            inside = np.all((quantized >= 0) & (quantized <= self.max_cell), axis=1)
+            keys = self._pack(np.where(inside[:, None], quantized, 0))
+
+            # sorted queries make the binary searches walk the sorted keys in order (several times faster than random queries)
+            query_order = np.argsort(keys)
+            sorted_query_keys = keys[query_order]
+            positions = np.minimum(np.searchsorted(self.sorted_keys, sorted_query_keys), self.n - 1)
+            found = inside[query_order] & (self.sorted_keys[positions] == sorted_query_keys)
+            indices[start + query_order[found]] = self.order[positions[found]]
+
+        return indices
+
+    def contains(self, points):
+        """
+        Checks which query points match an indexed point.
+
+        Args:
+        - points (numpy.ndarray): Array of shape (num_queries, >=3) whose first three columns are the query coordinates.
+
+        Returns:
+        - mask (numpy.ndarray): Boolean mask, True for the query points with a matching indexed point.
+        """
+        return self.lookup(points) < self.n
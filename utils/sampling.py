@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+
+class RandomKeyReservoir:
+    def __init__(self, capacity, rng=None):
+        """
+        Reservoir sampling by random keys, vectorized over chunks of rows: every row gets an independent uniform random key, and
+        the reservoir keeps the `capacity` rows with the smallest keys seen so far. The kept rows are a uniform random sample
+        without replacement of all the rows added, as with the classic one-row-at-a-time reservoir sampling (Algorithm R).
+        Once the reservoir is full, only the rows of a chunk whose key is below the largest kept key are considered, so that
+        most rows of long streams are rejected with a single vectorized comparison.
+
+        Args:
+        - capacity (int): Maximum number of rows kept.
+        - rng (numpy.random.Generator, optional): Random generator drawing the keys. If None, a new unseeded generator is used.
+        """
+        if capacity < 0:
+            raise ValueError(f"The capacity of the reservoir must be non-negative, got {capacity}.")
+        self.capacity = capacity
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.num_seen = 0
+
+        self.keys = np.empty(0)
+        self.row_indices = np.empty(0, dtype=np.int64)
+        self.rows = None
+        self.threshold = np.inf     # largest kept key, once the reservoir is full
+
+        # candidate rows buffered until the next compaction, so that kept rows are not copied at every chunk
+        self.pending = []
+        self.num_pending = 0
+
+    def add(self, chunk, row_indices):
+        """
+        Offers a chunk of rows to the reservoir.
+
+        Args:
+        - chunk (pd.DataFrame): The rows.
+        - row_indices (numpy.ndarray): Indices of the rows in the stream (e.g., their rows in the input file).
+        """
+        self.num_seen += len(chunk)
+        keys = self.rng.random(len(chunk))
+        if self.capacity == 0:
+            return
+
+        candidates = keys < self.threshold     # rows that could enter the reservoir
+        if not np.any(candidates):
+            return
+        if not np.all(candidates):
+            chunk, keys, row_indices = chunk[candidates], keys[candidates], np.asarray(row_indices)[candidates]
+
+        self.pending.append((keys, np.asarray(row_indices, dtype=np.int64), chunk.reset_index(drop=True)))
+        self.num_pending += len(keys)
+        if self.num_pending >= self.capacity:
+            self._compact()
+
+    def _compact(self):
+        # keep the rows with the smallest keys among the kept and the pending ones
+        if not self.pending:
+            return
+        all_keys = np.concatenate([self.keys] + [keys for keys, _, _ in self.pending])
+        all_row_indices = np.concatenate([self.row_indices] + [row_indices for _, row_indices, _ in self.pending])
+        all_rows = pd.concat(([self.rows] if self.rows is not None else []) + [rows for _, _, rows in self.pending], ignore_index=True)
+        self.pending, self.num_pending = [], 0
+
+        if len(all_keys) > self.capacity:
+            kept = np.argpartition(all_keys, self.capacity - 1)[:self.capacity]
+            all_keys, all_row_indices, all_rows = all_keys[kept], all_row_indices[kept], all_rows.iloc[kept].reset_index(drop=True)
+
+        self.keys, self.row_indices, self.rows = all_keys, all_row_indices, all_rows
+        if len(self.keys) == self.capacity:
+            self.threshold = self.keys.max()
+
+    def sample(self):
+        """
+        Returns the sampled rows, in the order of the stream.
+
+        Returns:
+        - rows (pd.DataFrame): The sampled rows (None if no row was added).
+        - row_indices (numpy.ndarray): Indices of the sampled rows in the stream.
+        """
+        self._compact()
+        order = np.argsort(self.row_indices, kind='stable')
+        rows = self.rows.iloc[order].reset_index(drop=True) if self.rows is not None else None
+        return rows, self.row_indices[order]
+
+
+def hash_to_unit_interval(values, seed=0):
+    """
+    Maps integers (e.g., row indices) to pseudo-random numbers in [0, 1) with a seeded 64-bit hash (the SplitMix64 finalizer).
+    The numbers only depend on the values and the seed, so that they can be computed chunk by chunk, in any order, 
+    e.g., to assign points to a train/eval split on the fly and reproducibly.
+
+    Args:
+    - values (numpy.ndarray): Integer values to hash.
+    - seed (int): Seed of the hash. Default is 0.
+
+    Returns:
+    - numbers (numpy.ndarray): Float64 numbers in [0, 1), one per value.
+    """
+    with np.errstate(over='ignore'):
+        z = np.asarray(values).astype(np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
@@ -0,0 +1,198 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+TABLE_FORMATS = {'.csv': 'csv', '.parquet': 'parquet'}
+
+
+def import_pyarrow():
+    """
+    Imports pyarrow, which is only needed to read and write Parquet files.
+
+    Returns:
+    - pa (module): The pyarrow module.
+    - pq (module): The pyarrow.parquet module.
+    - ds (module): The pyarrow.dataset module.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        import pyarrow.dataset as ds
+    except ImportError as e:
+        raise ImportError("Parquet files require the optional dependency pyarrow (pip install pyarrow).") from e
+    return pa, pq, ds
+
+
+def table_format(file_path):
+    """
+    Returns the format of a tabular point cloud file from its extension.
+
+    Args:
+    - file_path (str): Path to the file.
+
+    Returns:
+    - file_format (str): 'csv' or 'parquet'.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in TABLE_FORMATS:
+        raise ValueError(f"Unsupported table format '{extension}' for {file_path}. Please provide a .csv or .parquet file.")
+    return TABLE_FORMATS[extension]
+
+
+def read_table_columns(file_path):
+    """
+    Reads the column names of a .csv or .parquet file, without reading its rows.
+
+    Args:
+    - file_path (str): Path to the file.
+
+    Returns:
+    - columns (list): Names of the columns of the file.
+    """
+    if table_format(file_path) == 'parquet':
+        _, pq, _ = import_pyarrow()
+        return pq.read_schema(file_path).names
+    return pd.read_csv(file_path, nrows=0).columns.tolist()
+
+
+def read_table(file_path, columns=None, label_filter=None):
+    """
+    Reads a .csv or .parquet file into a DataFrame, loading only the given columns.
+    For Parquet files the label filter is pushed down to the reader, so that row groups whose label statistics
+    do not match any of the labels are skipped without being decoded.
+
+    Args:
+    - file_path (str): Path to the file.
+    - columns (list, optional): Columns to read, in the order they are returned. If None, all columns are read. Default is None.
+    - label_filter (list, optional): Labels of the rows to keep (matched against the 'label' column). If None, all rows are kept. Default is None.
+
+    Returns:
+    - df (pd.DataFrame): The selected rows and columns.
+    """
+    return pd.concat(list(iter_table_chunks(file_path, chunk_size=None, columns=columns, label_filter=label_filter)), ignore_index=True)
+
+
+def iter_table_chunks(file_path, chunk_size=100000, columns=None, label_filter=None, with_row_indices=False):
+    """
+    Reads a .csv or .parquet file in chunks of rows, loading only the given columns and rows (see read_table).
+    With with_row_indices, the rows of the chunk in the file are yielded too: for Parquet files with a label filter they are found
+    from a separate scan of the (small) label column, so that the filter is still pushed down for the other columns.
+
+    Args:
+    - file_path (str): Path to the file.
+    - chunk_size (int, optional): Number of rows per chunk. If None, the file is read as a single chunk. Default is 100000.
+    - columns (list, optional): Columns to read, in the order they are returned. If None, all columns are read. Default is None.
+    - label_filter (list, optional): Labels of the rows to keep (matched against the 'label' column). If None, all rows are kept. Default is None.
+    - with_row_indices (bool): If True, (chunk, row_indices) pairs are yielded. Default is False.
+
+    Yields:
+    - chunk (pd.DataFrame): The selected rows and columns of the next chunk.
+    - row_indices (numpy.ndarray): Rows of the chunk in the file (only if with_row_indices is True).
+    """
+    if with_row_indices:
+        yield from _iter_table_chunks_with_row_indices(file_path, chunk_size, columns, label_filter)
+        return
+
+    columns_to_read = columns
+    if columns is not None and label_filter is not None and 'label' not in columns:
+        columns_to_read = list(columns) + ['label']    # needed for filtering only
+
+    if table_format(file_path) == 'parquet':
+        _, _, ds = import_pyarrow()
+        dataset = ds.dataset(file_path, format='parquet')
+        row_filter = ds.field('label').isin(list(label_filter)) if label_filter is not None else None
+        if chunk_size is None:
+            yield dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+            return
+        for batch in dataset.to_batches(columns=columns, filter=row_filter, batch_size=chunk_size):
+            if batch.num_rows > 0:
+                yield batch.to_pandas()
+        return
+
+    chunks = pd.read_csv(file_path, usecols=columns_to_read, chunksize=chunk_size)
+    for chunk in (chunks if chunk_size is not None else [chunks]):
+        if label_filter is not None:
+            chunk = chunk[chunk['label'].isin(label_filter)]
+        yield chunk[columns] if columns is not None else chunk
+
+
+class TableWriter:
+    def __init__(self, file_path):
+        """
+        Writes a .csv or .parquet file chunk by chunk (e.g., the chunks of iter_table_chunks), without holding the whole table in memory.
+        Every chunk must have the same columns as the first one; each chunk becomes a row group of the Parquet file.
+
+        Args:
+        - file_path (str): Path to the output file, whose extension sets the format.
+        """
+        self.file_path = file_path
+        self.file_format = table_format(file_path)
+        self.parquet_writer = None
+        self.schema = None
+        self.num_rows = 0
+
+    def write(self, df):
+        if self.file_format == 'parquet':
+            pa, pq, _ = import_pyarrow()
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            if self.parquet_writer is None:
+                self.schema = table.schema
+                self.parquet_writer = pq.ParquetWriter(self.file_path, self.schema)
+            self.parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.file_path, index=False, mode='w' if self.num_rows == 0 else 'a', header=(self.num_rows == 0))
+        self.num_rows += len(df)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_table(df, file_path):
+    """
+    Saves a DataFrame to a .csv or .parquet file, depending on the extension of file_path.
+
+    Args:
+    - df (pd.DataFrame): The DataFrame to save.
+    - file_path (str): Path to the output file.
+    """
+    with TableWriter(file_path) as writer:
+        writer.write(df)
+
+
+def _iter_table_chunks_with_row_indices(file_path, chunk_size, columns, label_filter):
+    if table_format(file_path) == 'parquet' and label_filter is not None:
+        # rows of the kept labels, from a scan of the label column alone (rows are returned in file order)
+        kept_rows = _iter_kept_rows(file_path, chunk_size, label_filter)
+        pending_rows = np.empty(0, dtype=np.int64)
+        for chunk in iter_table_chunks(file_path, chunk_size=chunk_size, columns=columns, label_filter=label_filter):
+            while len(pending_rows) < len(chunk):
+                pending_rows = np.concatenate((pending_rows, next(kept_rows)))
+            yield chunk, pending_rows[:len(chunk)]
+            pending_rows = pending_rows[len(chunk):]
+        return
+
+    # CSV files are filtered after reading, so the rows are known chunk by chunk
+    columns_to_read = list(columns) + (['label'] if label_filter is not None and 'label' not in columns else []) if columns is not None else None
+    row_offset = 0
+    for chunk in iter_table_chunks(file_path, chunk_size=chunk_size, columns=columns_to_read):
+        row_indices = np.arange(row_offset, row_offset + len(chunk))
+        row_offset += len(chunk)
+        if label_filter is not None:
+            kept = np.isin(chunk['label'].values, list(label_filter))
+            chunk, row_indices = chunk[kept], row_indices[kept]
+        yield (chunk[columns] if columns is not None else chunk), row_indices
+
+
+def _iter_kept_rows(file_path, chunk_size, label_filter):
+    row_offset = 0
+    for chunk in iter_table_chunks(file_path, chunk_size=chunk_size, columns=['label']):
+        yield row_offset + np.flatnonzero(np.isin(chunk['label'].values, list(label_filter)))
+        row_offset += len(chunk)
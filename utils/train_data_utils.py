@@ -1,11 +1,12 @@
 import torch
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, random_split, BatchSampler, RandomSampler, SequentialSampler, Sampler, Subset
 import os
-from utils.point_cloud_data_utils import read_file_to_numpy, remap_labels, clean_nan_values, apply_masks_KDTree
-from scripts.point_cloud_to_image import generate_multiscale_grids_masked
+from utils.point_cloud_data_utils import read_file_to_numpy, remap_labels, clean_nan_values, apply_masks_KDTree, compute_morton_codes, compute_point_cloud_bounds, apply_precision_policy, print_memory_footprint, PRECISION_POLICIES
+from scripts.point_cloud_to_image import generate_multiscale_grids_masked, compute_neighbor_index_grids, gather_grids_from_neighbor_indices, build_feature_matrix, build_raster_pyramid, compute_neighbor_index_grids_from_rasters
+from utils.grid_store import grid_store_params, find_grid_store, GridStoreDataset, NeighborIndexCache
 from datetime import datetime
 import pandas as pd
-from scipy.spatial import cKDTree
+from utils.neighbor_index import load_or_build_neighbor_index
 import csv
 from models.mcnn import MultiScaleCNN
 import ast
@@ -13,9 +14,12 @@ import numpy as np
 
 
 class PointCloudDataset(Dataset):
-    def __init__(self, full_data_array, window_sizes, grid_resolution, features_to_use, known_features, subset_file=None):
+    def __init__(self, full_data_array, window_sizes, grid_resolution, features_to_use, known_features, subset_file=None, index_cache_bytes=None, approximate_grids=False, neighbor_index_backend='kdtree', tree_cache_dir=None, precision='float64', selected_indices=None, coordinate_origin=None):
         """
         Dataset class for streaming multiscale grid generation from point cloud data.
+        Grids are generated from the nearest-neighbor index grids of each point, which can optionally be cached in memory:
+        they do not depend on the selected features and are C times smaller than the feature grids.
+        In approximate mode, index grids are sliced from rasters of the whole point cloud, built once per scale (see build_raster_pyramid).
 
         Args:
         - full_data_array (numpy.ndarray): The entire point cloud data array (already remapped).
@@ -23,26 +27,65 @@ class PointCloudDataset(Dataset):
         - grid_resolution (int): Grid resolution (e.g., 128x128).
         - features_to_use (list): List of feature names for generating grids.
         - known_features (list): All known feature names in the data array.
-        - subset_file (str, optional): Path to a csv file containing coordinates of points to be selected from the full data. If None, all are selected.
+        - subset_file (str, optional): Path to a csv file containing coordinates of points to be selected from the full data, or to a .npy file of their row indices (selected without matching, see save_subset_indices). If None, all are selected.
+        - index_cache_bytes (int, optional): Memory budget (in bytes) for caching the nearest-neighbor index grids. If None, no cache is used.
+        - approximate_grids (bool): If True, batched grids are sliced from per-scale rasters of the point cloud, with a positional
+                                    error of at most half a cell. Default is False.
+        - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash' (see utils/neighbor_index.py). Default is 'kdtree'.
+        - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+        - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PRECISION_POLICIES). With 'float32' and 'float16' 
+                           the data array is stored in float32, with coordinates shifted to the tile origin; grids are float16 with 'float16'. Default is 'float64'.
+        - selected_indices (numpy.ndarray, optional): Indices of the points to generate grids for, e.g. the core points of a subtile, whose 
+                                                      other (halo) points are only used as neighbors. If given, subset_file is ignored and 
+                                                      selected points close to the bounds of the point cloud are kept. Default is None.
+        - coordinate_origin (numpy.ndarray, optional): If given, full_data_array is already in the precision policy, with coordinates shifted 
+                                                       to this origin (see DataSource), and is used without a copy. Default is None.
         """
+        full_data_array, self.coordinate_origin = apply_precision_policy(full_data_array, precision=precision, coordinate_origin=coordinate_origin)
         self.full_data_array = full_data_array
         self.window_sizes = window_sizes
         self.grid_resolution = grid_resolution
         self.features_to_use = features_to_use
         self.known_features = known_features
         
-        # Build KDTree once for the entire dataset
-        self.kdtree = cKDTree(full_data_array[:, :3])  # Use full data coordinates for KDTree (use full point cloud for neighbors feature assignment)
+        # Build the neighbor index (KDTree by default) once for the entire dataset
+        self.kdtree = load_or_build_neighbor_index(full_data_array[:, :3], backend=neighbor_index_backend, cache_dir=tree_cache_dir)  # Use full data coordinates (use full point cloud for neighbors feature assignment)
         self.feature_indices = [known_features.index(feature) for feature in features_to_use]
+        # Contiguous copy of the selected features only (float32, or float16): grids are gathered from it, not from the full data rows
+        self.feature_matrix = build_feature_matrix(full_data_array, self.feature_indices, dtype=PRECISION_POLICIES[precision]['features'], feature_names=features_to_use)
         
-        # Apply masking and compute bounds
-        self.selected_array, mask, point_cloud_bounds = apply_masks_KDTree(
-            full_data_array=full_data_array,
-            window_sizes=window_sizes,
-            subset_file=subset_file
-        )
-
-        self.original_indices = np.where(mask)[0]
+        if selected_indices is not None:
+            # every selected point is kept: its grids are built from the neighbors available, even close to the bounds
+            self.original_indices = np.sort(np.asarray(selected_indices, dtype=np.int64))
+            self.selected_array = full_data_array[self.original_indices]
+        else:
+            # Apply masking and compute bounds
+            self.selected_array, mask, point_cloud_bounds = apply_masks_KDTree(
+                full_data_array=full_data_array,
+                window_sizes=window_sizes,
+                subset_file=subset_file,
+                neighbor_index_backend=neighbor_index_backend,
+                tree_cache_dir=tree_cache_dir,
+                coordinate_origin=self.coordinate_origin if precision != 'float64' else None
+            )
+
+            self.original_indices = np.where(mask)[0]
+
+        self.index_cache = None
+        if index_cache_bytes is not None:
+            self.index_cache = NeighborIndexCache(num_points=len(self.selected_array),
+                                                  index_grid_shape=(len(window_sizes), grid_resolution, grid_resolution),
+                                                  max_bytes=index_cache_bytes)
+
+        self.raster_pyramid = None
+        if approximate_grids:
+            self.raster_pyramid = build_raster_pyramid(full_data_array, window_sizes=window_sizes, grid_resolution=grid_resolution)
+
+        grid_shape = (len(window_sizes), len(self.feature_indices), grid_resolution, grid_resolution)
+        print_memory_footprint('dataset', {'data array': self.full_data_array,
+                                           'selected array': self.selected_array,
+                                           'feature matrix': self.feature_matrix,
+                                           'grids of one point': np.empty(grid_shape, dtype=self.feature_matrix.dtype)})
     
 
     def __len__(self):
@@ -51,7 +94,11 @@ class PointCloudDataset(Dataset):
     def __getitem__(self, idx):
         """
         Generates multiscale grids for the point at index `idx` and returns them as PyTorch tensors, along with the index.
+        If `idx` is a list (or array) of indices, as yielded by a BatchSampler, the whole batch is generated at once (see get_batch).
         """
+        if isinstance(idx, (list, tuple, np.ndarray, torch.Tensor)):
+            return self.get_batch(idx)
+
         # Extract the single point's data from the selected array using `idx`
         center_point = self.selected_array[idx, :3]  # Get the x, y, z coordinates
         label = self.selected_array[idx, -1]  # Get the label for this point
@@ -62,15 +109,16 @@ class PointCloudDataset(Dataset):
                                                       window_sizes=self.window_sizes, 
                                                       grid_resolution=self.grid_resolution, 
                                                       feature_indices=self.feature_indices, 
-                                                      kdtree=self.kdtree) 
+                                                      kdtree=self.kdtree,
+                                                      dtype=self.feature_matrix.dtype) 
         
-        # Convert grids to PyTorch tensors
-        small_grid = torch.tensor(grids_dict['small'], dtype=torch.float32)
-        medium_grid = torch.tensor(grids_dict['medium'], dtype=torch.float32)
-        large_grid = torch.tensor(grids_dict['large'], dtype=torch.float32)
+        # Convert grids to PyTorch tensors (grids are already in the dtype of the precision policy: no conversion)
+        small_grid = torch.from_numpy(grids_dict['small'])
+        medium_grid = torch.from_numpy(grids_dict['medium'])
+        large_grid = torch.from_numpy(grids_dict['large'])
 
         # Convert label to tensor
-        label = torch.tensor(label, dtype=torch.long)
+        label = torch.tensor(int(label), dtype=torch.long)
         
         # Return the grids, label, and original index 
         original_idx = self.original_indices[idx]  # Map back to the original data_array index
@@ -79,11 +127,297 @@ class PointCloudDataset(Dataset):
         return small_grid, medium_grid, large_grid, label, original_idx
     
 
+    def get_batch(self, indices):
+        """
+        Generates the multiscale grids of a whole batch of points with a single KDTree query (or a cache lookup) and a single feature gather.
+        The grids of all scales are stored in one (batch_size, scales, channels, H, W) tensor, so no per-sample collation is needed.
+
+        Args:
+        - indices (list): Indices of the points (in the selected array) to be included in the batch.
+
+        Returns:
+        - small_grids, medium_grids, large_grids (torch.Tensor): Views on the batched grids tensor, each of shape (batch_size, channels, H, W).
+        - labels (torch.Tensor): Labels of the points in the batch.
+        - original_indices (torch.Tensor): Indices of the points in the original data array.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+
+        labels = torch.as_tensor(self.selected_array[indices, -1], dtype=torch.long)
+
+        index_grids = self.get_neighbor_index_batch(indices)
+        grids = gather_grids_from_neighbor_indices(index_grids, feature_matrix=self.feature_matrix)
+        grids = torch.from_numpy(grids)   # shape: (batch_size, scales, channels, H, W), channels-last in memory (no copy)
+
+        original_indices = torch.from_numpy(self.original_indices[indices])
+
+        return grids[:, 0], grids[:, 1], grids[:, 2], labels, original_indices
+    
+
+    def get_neighbor_index_batch(self, indices):
+        """
+        Returns the nearest-neighbor index grids of a batch of points, reading them from the index cache when available.
+        In approximate mode, index grids are sliced from the raster pyramid instead of being queried from the KDTree.
+
+        Args:
+        - indices (numpy.ndarray): Indices of the points (in the selected array).
+
+        Returns:
+        - index_grids (numpy.ndarray): int32 array of shape (batch_size, scales, H, W) with indices into the full data array.
+        """
+        def compute_index_grids(point_indices):
+            if self.raster_pyramid is not None:
+                return compute_neighbor_index_grids_from_rasters(self.selected_array[point_indices, :3],
+                                                                 raster_pyramid=self.raster_pyramid,
+                                                                 grid_resolution=self.grid_resolution)
+            return compute_neighbor_index_grids(self.selected_array[point_indices, :3],
+                                                window_sizes=self.window_sizes,
+                                                grid_resolution=self.grid_resolution,
+                                                kdtree=self.kdtree)
+
+        if self.index_cache is None:
+            return compute_index_grids(indices)
+
+        return self.index_cache.get(indices, compute_index_grids)
+
+
+class MortonBlockSampler(Sampler):
+    def __init__(self, coordinates, block_size=4096, shuffle=True, seed=None):
+        """
+        Sampler yielding points in Morton (Z-order) order, so that consecutive KDTree queries hit nearby parts of the tree.
+        When shuffling, the Z-ordered points are split into blocks of block_size points and only the order of the blocks
+        is shuffled (at every epoch): points inside a block stay spatially coherent.
+
+        Args:
+        - coordinates (numpy.ndarray): Coordinates of the points of the dataset, of shape (num_points, 2) or (num_points, 3).
+        - block_size (int): Number of consecutive Z-ordered points that are kept together when shuffling. Default is 4096.
+        - shuffle (bool): Whether to shuffle the order of the blocks. If False, points are yielded in strict Z-order. Default is True.
+        - seed (int, optional): Seed of the block shuffling. Default is None.
+        """
+        if block_size < 1:
+            raise ValueError(f"block_size must be a positive integer, got {block_size}.")
+
+        self.order = np.argsort(compute_morton_codes(coordinates), kind='stable')
+        self.block_size = block_size
+        self.shuffle = shuffle
+        self.generator = np.random.default_rng(seed)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(self.order.tolist())
+
+        num_blocks = int(np.ceil(len(self.order) / self.block_size))
+        blocks = [self.order[i * self.block_size:(i + 1) * self.block_size] for i in self.generator.permutation(num_blocks)]
+        return iter(np.concatenate(blocks).tolist() if blocks else [])
+
+
+def get_point_coordinates(dataset):
+    """
+    Returns the coordinates of the points of a PointCloudDataset (or of a subset of it), in the dataset's order.
+
+    Args:
+    - dataset (Dataset): The dataset (or subset).
+
+    Returns:
+    - coordinates (numpy.ndarray or None): Array of shape (len(dataset), 3), or None if the dataset holds no coordinates.
+    """
+    if isinstance(dataset, Subset):
+        coordinates = get_point_coordinates(dataset.dataset)
+        return coordinates[np.asarray(dataset.indices)] if coordinates is not None else None
+
+    if isinstance(dataset, PointCloudDataset):
+        return dataset.selected_array[:, :3]
+
+    return None
+
+
+def has_index_cache(dataset):
+    """
+    Checks whether a PointCloudDataset (or a subset of it) caches its nearest-neighbor index grids (see NeighborIndexCache).
+
+    Args:
+    - dataset (Dataset): The dataset (or subset).
+
+    Returns:
+    - has_cache (bool): True if the dataset has an index cache.
+    """
+    if isinstance(dataset, Subset):
+        return has_index_cache(dataset.dataset)
+    return isinstance(dataset, PointCloudDataset) and dataset.index_cache is not None
+
+
+def create_dataloader(dataset, batch_size, shuffle=False, num_workers=0, batched_grids=True, spatial_block_size=None):
+    """
+    Creates a DataLoader for a PointCloudDataset (or a subset of it).
+    With an index cache and num_workers > 0, workers are kept alive across epochs (persistent_workers): each worker holds its own 
+    copy of the cache, which would otherwise be thrown away at the end of every epoch.
+
+    Args:
+    - dataset (Dataset): The dataset (or subset) to load.
+    - batch_size (int): The batch size.
+    - shuffle (bool): Whether to shuffle the data. Default is False.
+    - num_workers (int): Number of workers for parallelized process. Default is 0.
+    - batched_grids (bool): If True, whole batches of indices are passed to the dataset through a BatchSampler, so that
+                            grids are generated batch-wise instead of point by point. Default is True.
+    - spatial_block_size (int, optional): If set, points are sampled in Morton (Z-order) order, shuffled at the level of blocks 
+                                          of spatial_block_size points (strict Z-order if shuffle is False). See MortonBlockSampler. Default is None.
+
+    Returns:
+    - loader (DataLoader): The DataLoader.
+    """
+    sampler = None
+    if spatial_block_size is not None:
+        coordinates = get_point_coordinates(dataset)
+        if coordinates is not None:
+            sampler = MortonBlockSampler(coordinates, block_size=spatial_block_size, shuffle=shuffle)
+        else:
+            print("Spatial sampling order is only available for datasets generating grids on the fly: using the default order.")
+
+    # workers (and their copies of the index cache) survive across epochs
+    persistent_workers = num_workers > 0 and has_index_cache(dataset)
+
+    if not batched_grids:
+        if sampler is not None:
+            return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, persistent_workers=persistent_workers)
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, persistent_workers=persistent_workers)
+
+    if sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=False)
+
+    # batch_size=None disables automatic collation: the dataset already returns whole batches
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=num_workers, persistent_workers=persistent_workers)
+    
+
+class DataSource:
+    def __init__(self, data_filepath, features_file_path=None, ingest_cache_dir=None, precision='float64'):
+        """
+        Point cloud data loaded once: the raw data is read, its labels are remapped and it is cleaned from nan/inf values.
+        The data is then cast to the precision policy (see apply_precision_policy), and only the cast array is kept: datasets 
+        built on the data source share it instead of holding their own copy.
+        Facts derived from the data (number of classes, bounds, known features and label mapping) are cached, so that 
+        training, evaluation and grid materialization can share a single load of the same file.
+
+        Args:
+        - data_filepath (str): Path to the raw data (e.g., .las or .csv file).
+        - features_file_path: File path to feature metadata, needed if using raw data in .npy format. Default is None.
+        - ingest_cache_dir (str, optional): Directory where .las and .csv inputs are converted to memory-mapped column-major .npy files on first use (see read_file_to_numpy). Default is None.
+        - precision (str): Precision policy of the data array, 'float64', 'float32' or 'float16' (see PRECISION_POLICIES). Default is 'float64'.
+        """
+        # Check if data directory was passed as input
+        if data_filepath is None:
+            raise ValueError('ERROR: Data filepath was not passed as input to the dataloader.')
+
+        self.data_filepath = data_filepath
+
+        # Read the raw point cloud data 
+        data_array, self.known_features = read_file_to_numpy(data_dir=data_filepath, features_to_use=None, features_file_path=features_file_path, ingest_cache_dir=ingest_cache_dir)
+
+        # Remap labels to ensure they vary continuously (needed for CrossEntropyLoss)
+        data_array, self.label_mapping = remap_labels(data_array=data_array)
+        # clean data fom nan/inf values (replace them w/ 0.0)
+        data_array = clean_nan_values(data_array=data_array)
+        # cast once to the precision policy (coordinates are shifted to coordinate_origin with float32 data)
+        self.precision = precision
+        self.data_array, self.coordinate_origin = apply_precision_policy(data_array, precision=precision)
+        del data_array
+        print_memory_footprint('loading', {'data array': self.data_array})
+
+        self.num_classes = len(self.label_mapping)
+        self._bounds = None
+
+    @property
+    def num_points(self):
+        return len(self.data_array)
+
+    @property
+    def bounds(self):
+        """
+        Bounds of the point cloud (see compute_point_cloud_bounds), computed on first access, in the (possibly shifted) coordinates of data_array.
+        """
+        if self._bounds is None:
+            self._bounds = compute_point_cloud_bounds(self.data_array)
+        return self._bounds
+
+
+def load_point_cloud_data(data_filepath, features_file_path=None, ingest_cache_dir=None, data_source=None):
+    """
+    Loads the raw data, remaps its labels and cleans it from nan/inf values.
+
+    Args:
+    - data_filepath (str): Path to the raw data (e.g., .las or .csv file).
+    - features_file_path: File path to feature metadata, needed if using raw data in .npy format. Default is None.
+    - ingest_cache_dir (str, optional): Directory where .las and .csv inputs are converted to memory-mapped column-major .npy files on first use (see read_file_to_numpy). Default is None.
+    - data_source (DataSource, optional): Already loaded data. If passed, the data is not read again. Default is None.
+
+    Returns:
+    - data_array (numpy.ndarray): The cleaned data array.
+    - known_features (list): Names of the columns of the data array.
+    """
+    if data_source is None:
+        data_source = DataSource(data_filepath, features_file_path=features_file_path, ingest_cache_dir=ingest_cache_dir)
+
+    return data_source.data_array, data_source.known_features
+
+
+def create_point_cloud_dataset(data_filepath, window_sizes, grid_resolution, features_to_use, features_file_path=None, subset_file=None, index_cache_bytes=None, approximate_grids=False, neighbor_index_backend='kdtree', tree_cache_dir=None, precision='float64', ingest_cache_dir=None, data_source=None):
+    """
+    Loads the raw data, remaps its labels, cleans it from nan/inf values and creates the corresponding PointCloudDataset.
+
+    Args:
+    - data_filepath (str): Path to the raw data (e.g., .las or .csv file).
+    - window_sizes (list): List of window sizes to use for grid generation.
+    - grid_resolution (int): Resolution of the grid (e.g., 128x128).
+    - features_to_use (list): List of feature names to use for grid generation.
+    - features_file_path: File path to feature metadata, needed if using raw data in .npy format. Default is None.
+    - subset_file (str, optional): Path to a csv file containing coordinates of points to be selected from the full data, or to a .npy file of their row indices (selected without matching, see save_subset_indices). If None, all are selected.
+    - index_cache_bytes (int, optional): Memory budget (in bytes) for caching the nearest-neighbor index grids. If None, no cache is used.
+    - approximate_grids (bool): If True, grids are sliced from per-scale rasters of the point cloud (see PointCloudDataset). Default is False.
+    - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'. Default is 'kdtree'.
+    - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+    - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
+    - ingest_cache_dir (str, optional): Directory where .las and .csv inputs are converted to memory-mapped column-major .npy files on first use (see read_file_to_numpy). Default is None.
+    - data_source (DataSource, optional): Already loaded data (see DataSource). If passed, the data is not read again. Default is None.
+
+    Returns:
+    - dataset (PointCloudDataset): The dataset.
+    """
+    if data_source is None:
+        data_source = DataSource(data_filepath, features_file_path=features_file_path, ingest_cache_dir=ingest_cache_dir, precision=precision)
+    elif data_source.precision != precision:
+        raise ValueError(f"The data source was loaded with the '{data_source.precision}' precision policy, not '{precision}'.")
+
+    # Create the dataset on the array of the data source (already in the precision policy: not copied)
+    dataset = PointCloudDataset(
+        full_data_array=data_source.data_array,
+        window_sizes=window_sizes,
+        grid_resolution=grid_resolution,
+        features_to_use=features_to_use,
+        known_features=data_source.known_features,
+        subset_file=subset_file,
+        index_cache_bytes=index_cache_bytes,
+        approximate_grids=approximate_grids,
+        neighbor_index_backend=neighbor_index_backend,
+        tree_cache_dir=tree_cache_dir,
+        precision=precision,
+        coordinate_origin=data_source.coordinate_origin
+    )
+
+    return dataset
+
+
 def prepare_dataloader(batch_size, data_filepath=None, 
                        window_sizes=None, grid_resolution=128, features_to_use=None, 
-                       train_split=None, features_file_path=None, num_workers=4, shuffle_train=True, subset_file=None):
+                       train_split=None, features_file_path=None, num_workers=4, shuffle_train=True, subset_file=None, batched_grids=True,
+                       grid_store_dir=None, index_cache_bytes=None, approximate_grids=False, spatial_block_size=None, neighbor_index_backend='kdtree', tree_cache_dir=None,
+                       precision='float64', ingest_cache_dir=None, data_source=None):
     """
     Prepares the DataLoader by loading the raw data and streaming multiscale grid generation.
+    If a grid store matching the data and grid parameters exists, grids are read from it instead of being generated.
+    A store of feature grids only matches if its dtype is the feature dtype of the precision policy (see PRECISION_POLICIES).
+    A store of feature grids is looked up first, then a store of nearest-neighbor index grids (which is valid for any feature selection).
     
     Args:
     - batch_size (int): The batch size to be used for training.
@@ -95,34 +429,67 @@ def prepare_dataloader(batch_size, data_filepath=None,
     - features_file_path: File path to feature metadata, needed if using raw data in .npy format. Default is None.
     - num_workers (int): number of workers for parallelized process. Default is 4.
     - shuffle_train (bool): Whether to shuffle the data for training. Default is True.
-    - subset_file (str, optional): Path to a csv file containing coordinates of points to be selected from the full data. If None, all are selected.
+    - subset_file (str, optional): Path to a csv file containing coordinates of points to be selected from the full data, or to a .npy file of their row indices (selected without matching, see save_subset_indices). If None, all are selected.
+    - batched_grids (bool): Whether to generate grids batch-wise (one KDTree query per batch) instead of point by point. Default is True.
+    - grid_store_dir (str, optional): Root directory of the materialized grid stores (see scripts/materialize_grids.py). Default is None.
+    - index_cache_bytes (int, optional): Memory budget (in bytes) for caching the nearest-neighbor index grids when generating on the fly. Default is None.
+    - approximate_grids (bool): If True, grids generated on the fly are sliced from per-scale rasters of the point cloud, with a 
+                                positional error of at most half a cell. Default is False.
+    - spatial_block_size (int, optional): If set, points are sampled in Morton (Z-order) order, shuffled in blocks of this size 
+                                          (strict Z-order for unshuffled loaders). Default is None.
+    - neighbor_index_backend (str): Nearest-neighbor index used to fill the grids, 'kdtree' or 'voxel_hash'. Default is 'kdtree'.
+    - tree_cache_dir (str, optional): Directory where neighbor indices are cached across runs (see load_or_build_neighbor_index). Default is None.
+    - precision (str): Precision policy of the data path, 'float64', 'float32' or 'float16' (see PointCloudDataset). Default is 'float64'.
+    - ingest_cache_dir (str, optional): Directory where .las and .csv inputs are converted to memory-mapped column-major .npy files on first use (see read_file_to_numpy). Default is None.
+    - data_source (DataSource, optional): Already loaded data (see DataSource). If passed, the data is not read again. Default is None.
 
     Returns:
     - train_loader (DataLoader): DataLoader for training.
     - eval_loader (DataLoader): DataLoader for validation (if train_split is not None, else eval_loader=None).
     """
     
+    if data_filepath is None and data_source is not None:
+        data_filepath = data_source.data_filepath
+
     # Check if data directory was passed as input
     if data_filepath is None:
         raise ValueError('ERROR: Data filepath was not passed as input to the dataloader.')
 
-    # Read the raw point cloud data 
-    data_array, known_features = read_file_to_numpy(data_dir=data_filepath, features_to_use=None, features_file_path=features_file_path)
-
-    # Remap labels to ensure they vary continuously (needed for CrossEntropyLoss)
-    data_array, _ = remap_labels(data_array=data_array)
-    # clean data fom nan/inf values (replace them w/ 0.0)
-    data_array = clean_nan_values(data_array=data_array)
-
-    # Create the dataset 
-    full_dataset = PointCloudDataset(
-        full_data_array=data_array,
-        window_sizes=window_sizes,
-        grid_resolution=grid_resolution,
-        features_to_use=features_to_use,
-        known_features=known_features,
-        subset_file=subset_file
-    )
+    store_dir, index_store_dir = None, None
+    if grid_store_dir is not None:
+        # only a store with the feature dtype of the precision policy matches
+        store_dtype = np.dtype(PRECISION_POLICIES[precision]['features']).name
+        params = grid_store_params(data_filepath, window_sizes, grid_resolution, features_to_use, subset_file=subset_file, dtype=store_dtype)
+        store_dir = find_grid_store(grid_store_dir, params)
+        if store_dir is None:
+            index_params = grid_store_params(data_filepath, window_sizes, grid_resolution, features_to_use, subset_file=subset_file, mode='indices')
+            index_store_dir = find_grid_store(grid_store_dir, index_params)
+        if store_dir is None and index_store_dir is None:
+            print(f"No grid store matching the data and grid parameters found in {grid_store_dir}: grids will be generated on the fly.")
+
+    if store_dir is not None:
+        print(f"Reading pre-computed grids from grid store {store_dir}")
+        full_dataset = GridStoreDataset(store_dir)
+    elif index_store_dir is not None:
+        print(f"Reading pre-computed neighbor indices from grid store {index_store_dir}")
+        data_array, known_features = load_point_cloud_data(data_filepath, features_file_path=features_file_path, ingest_cache_dir=ingest_cache_dir, data_source=data_source)
+        feature_indices = [known_features.index(feature) for feature in features_to_use]
+        feature_matrix = build_feature_matrix(data_array, feature_indices, dtype=PRECISION_POLICIES[precision]['features'], feature_names=features_to_use)
+        full_dataset = GridStoreDataset(index_store_dir, feature_matrix=feature_matrix)
+    else:
+        full_dataset = create_point_cloud_dataset(data_filepath=data_filepath,
+                                                  window_sizes=window_sizes,
+                                                  grid_resolution=grid_resolution,
+                                                  features_to_use=features_to_use,
+                                                  features_file_path=features_file_path,
+                                                  subset_file=subset_file,
+                                                  index_cache_bytes=index_cache_bytes,
+                                                  approximate_grids=approximate_grids,
+                                                  neighbor_index_backend=neighbor_index_backend,
+                                                  tree_cache_dir=tree_cache_dir,
+                                                  precision=precision,
+                                                  ingest_cache_dir=ingest_cache_dir,
+                                                  data_source=data_source)
 
     # Split the dataset into training and evaluation sets (if train_split is provided)
     if train_split is not None:
@@ -131,11 +498,11 @@ def prepare_dataloader(batch_size, data_filepath=None,
         train_dataset, eval_dataset = random_split(full_dataset, [train_size, eval_size])
 
         # Create DataLoaders for training and evaluation
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle_train, num_workers=num_workers) #collate_fn=custom_collate_fn,
-        eval_loader = DataLoader(eval_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        train_loader = create_dataloader(train_dataset, batch_size=batch_size, shuffle=shuffle_train, num_workers=num_workers, batched_grids=batched_grids, spatial_block_size=spatial_block_size)
+        eval_loader = create_dataloader(eval_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, batched_grids=batched_grids, spatial_block_size=spatial_block_size)
     else:
         # If no train/test split, create one DataLoader for the full dataset
-        train_loader = DataLoader(full_dataset, batch_size=batch_size, shuffle=shuffle_train, num_workers=num_workers)
+        train_loader = create_dataloader(full_dataset, batch_size=batch_size, shuffle=shuffle_train, num_workers=num_workers, batched_grids=batched_grids, spatial_block_size=spatial_block_size)
         eval_loader = None
 
     return train_loader, eval_loader